@@ -1,13 +1,23 @@
+import time
 from datetime import datetime, timedelta, UTC
-from passlib.context import CryptContext
 from jose import JWTError, jwt
 from fastapi import HTTPException, Request, Cookie
 
-from config import SECRET_KEY, ALGORITHM, ACCESS_TOKEN_EXPIRE_MINUTES, TAGS
+from config import SECRET_KEY, ALGORITHM, ACCESS_TOKEN_EXPIRE_MINUTES, TOKEN_CACHE_SIZE, TOKEN_CACHE_TTL_SECONDS
+from backplane import backplane, AUTH_CHANNEL
 from database import get_user_by_username, get_username_by_uuid
+from lru import LRUCache
+from metrics import Gauge
+from passwords import password_hasher, PasswordHasherBusy
+from logs import get_logger
 
-# Configure the password hashing context
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+app_logger = get_logger("app")
+
+# Every page load and WebSocket connect verifies the same few tokens again and again.
+# Verified tokens are remembered until their 'exp' (capped by TOKEN_CACHE_TTL_SECONDS).
+token_cache = LRUCache(TOKEN_CACHE_SIZE)  # token -> (user_uuid, cache expiry timestamp)
+# Tokens revoked by logout, kept until they would have expired anyway
+revoked_tokens: dict[str, float] = {}
 
 def create_access_token(data: dict, expires_delta: timedelta | None = None):
     """
@@ -27,18 +37,65 @@ def create_access_token(data: dict, expires_delta: timedelta | None = None):
 def verify_token(token: str | None): 
     """
     Verifies a JWT token and returns the subject (user_uuid) if valid.
+    Verified tokens are answered from token_cache; revoked tokens are always rejected.
     Args:
         token (str | None): The JWT token to verify.
     Returns:
         str | None: The user_uuid if the token is valid, otherwise None.
     """
-    if not token:
+    if not token or token in revoked_tokens:
         return None
+    now = time.time()
+    cached = token_cache.get(token)
+    if cached is not None:
+        user_uuid, expires_at = cached
+        if now < expires_at:
+            return user_uuid
+        token_cache.pop(token)
     try:
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        return payload.get("sub")
     except JWTError:
         return None
+    user_uuid = payload.get("sub")
+    if user_uuid:
+        expires_at = now + TOKEN_CACHE_TTL_SECONDS
+        if isinstance(payload.get("exp"), (int, float)):
+            expires_at = min(expires_at, payload["exp"])
+        token_cache.put(token, (user_uuid, expires_at))
+    return user_uuid
+
+def revoke_token(token: str | None):
+    """
+    Invalidates a token before its expiry (e.g. on logout).
+    The token stays on the denylist only until its own 'exp' has passed.
+    """
+    # Only tokens we issued can be revoked, so forged ones cannot grow the denylist
+    if not verify_token(token):
+        return
+    now = time.time()
+    exp = jwt.get_unverified_claims(token).get("exp")
+    token_cache.pop(token)
+    revoked_tokens[token] = exp if isinstance(exp, (int, float)) else now + ACCESS_TOKEN_EXPIRE_MINUTES * 60
+    # Forget revoked tokens that have expired on their own
+    for expired in [t for t, expiry in revoked_tokens.items() if expiry <= now]:
+        del revoked_tokens[expired]
+
+async def revoke_token_everywhere(token: str | None):
+    """Revokes a token on every worker sharing the backplane."""
+    if verify_token(token):
+        await backplane.publish(AUTH_CHANNEL, {"type": "token_revoked", "token": token})
+
+async def on_auth_message(message: dict, origin: str):
+    """Backplane subscriber for the auth channel."""
+    if message.get("type") == "token_revoked":
+        revoke_token(message.get("token"))
+
+backplane.subscribe(AUTH_CHANNEL, on_auth_message)
+
+Gauge("dnd_token_cache_lookups_total", "Verified-token cache lookups by result.",
+      lambda: {("hit",): token_cache.hits, ("miss",): token_cache.misses}, ("result",), metric_type="counter")
+Gauge("dnd_token_cache_entries", "Tokens held by the verified-token cache and the revocation list.",
+      lambda: {("verified",): len(token_cache), ("revoked",): len(revoked_tokens)}, ("cache",))
 
 def get_current_user(request: Request):
     """
@@ -55,12 +112,16 @@ async def authenticate_user(username: str, password: str):
     """Authenticates a user by checking username and password."""
     user_data = await get_user_by_username(username)
     if not user_data:
-        print(f"{TAGS['app_error']} Usuario: {username} no existe.")
+        app_logger.warning("Usuario: %s no existe.", username)
         return None, "El usuario no existe"
 
     hashed_password_from_db, user_uuid = user_data
-    if not pwd_context.verify(password, hashed_password_from_db):
-        print(f"{TAGS['app_error']} Usuario: {username} o contraseña invalidos.")
+    try:
+        password_ok = await password_hasher.verify(password, hashed_password_from_db)
+    except PasswordHasherBusy:
+        return None, "El servidor está ocupado, inténtalo de nuevo en unos segundos."
+    if not password_ok:
+        app_logger.warning("Usuario: %s o contraseña invalidos.", username)
         return None, "Usuario o contraseña inválidos"
     
     return user_uuid, None # Return UUID and no error message on success
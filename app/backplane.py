@@ -0,0 +1,155 @@
+import asyncio
+import uuid
+
+from codec import dumps, loads
+from config import BACKPLANE, BACKPLANE_BROKER_HOST, BACKPLANE_BROKER_PORT
+from logs import get_logger
+
+server_logger = get_logger("server")
+app_logger = get_logger("app")
+
+# Channels shared by every worker
+MASTERS_CHANNEL = "masters"   # Player panel updates for every master (players_delta, player_patch, presence)
+LOBBIES_CHANNEL = "lobbies"   # Lobby lifecycle events (created, started, ended, deleted)
+AUTH_CHANNEL = "auth"         # Token revocations
+PAGES_CHANNEL = "pages"       # Page cache invalidations (changed characters, lobbies and users)
+
+# Largest line accepted from the broker (a presence message can carry many full states)
+MAX_LINE_BYTES = 16 * 1024 * 1024
+
+class Backplane:
+    """
+    Publish/subscribe channel between the workers serving the application.
+    publish() runs the local subscribers first, so a worker always sees its own
+    events immediately and in order, then hands the message to the other workers.
+    Subscribers are coroutines called as handler(message, origin) where origin is
+    the worker_id of the publisher.
+    """
+
+    distributed = False
+
+    def __init__(self):
+        self.worker_id = uuid.uuid4().hex[:12]
+        self._handlers: dict[str, list] = {}
+
+    def subscribe(self, channel: str, handler):
+        """Registers a coroutine called for every message published on a channel."""
+        self._handlers.setdefault(channel, []).append(handler)
+
+    async def _dispatch(self, channel: str, message: dict, origin: str):
+        for handler in self._handlers.get(channel, ()):
+            try:
+                await handler(message, origin)
+            except Exception as e:
+                app_logger.error("Backplane handler for '%s' failed: %s", channel, e)
+
+    async def publish(self, channel: str, message: dict):
+        """Delivers a message to the subscribers of a channel on every worker."""
+        await self._dispatch(channel, message, self.worker_id)
+        await self._forward(channel, message)
+
+    async def _forward(self, channel: str, message: dict):
+        """Sends a message to the other workers. Nothing to do for a single process."""
+
+    async def start(self):
+        pass
+
+    async def stop(self):
+        pass
+
+class InProcessBackplane(Backplane):
+    """Backplane for a single worker: messages only reach local subscribers."""
+
+class SocketBackplane(Backplane):
+    """
+    Backplane that relays messages through a broker process (see broker.py)
+    over a plain TCP connection, so several uvicorn workers, or several hosts,
+    share lobby and master events.
+    The broker speaks a line protocol:
+        SUB <channel>\\n                   client -> broker
+        PUB <channel> <payload>\\n         client -> broker
+        MSG <channel> <payload>\\n         broker -> every other subscriber
+    where payload is {"origin": worker_id, "data": message} as JSON.
+    While the broker is unreachable messages only reach local subscribers and
+    the connection is retried in the background.
+    """
+
+    distributed = True
+
+    def __init__(self, host: str = BACKPLANE_BROKER_HOST, port: int = BACKPLANE_BROKER_PORT, retry_seconds: float = 1.0):
+        super().__init__()
+        self.host = host
+        self.port = port
+        self.retry_seconds = retry_seconds
+        self._writer: asyncio.StreamWriter | None = None
+        self._task: asyncio.Task | None = None
+        self._connected = asyncio.Event()
+
+    async def start(self):
+        self._task = asyncio.create_task(self._run())
+        try:
+            # Give the first connection a moment so early events are not only local
+            await asyncio.wait_for(self._connected.wait(), timeout=5)
+        except asyncio.TimeoutError:
+            app_logger.warning("Backplane broker %s:%s unreachable; running local-only until it is.", self.host, self.port)
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _forward(self, channel: str, message: dict):
+        writer = self._writer
+        if writer is None:
+            return
+        payload = dumps({"origin": self.worker_id, "data": message})
+        try:
+            writer.write(f"PUB {channel} {payload}\n".encode())
+            await writer.drain()
+        except (ConnectionError, RuntimeError) as e:
+            app_logger.error("Backplane publish on '%s' failed: %s", channel, e)
+
+    async def _run(self):
+        while True:
+            try:
+                reader, writer = await asyncio.open_connection(self.host, self.port, limit=MAX_LINE_BYTES)
+            except OSError:
+                await asyncio.sleep(self.retry_seconds)
+                continue
+            try:
+                for channel in self._handlers:
+                    writer.write(f"SUB {channel}\n".encode())
+                await writer.drain()
+                self._writer = writer
+                self._connected.set()
+                server_logger.info("Backplane connected to broker %s:%s as worker %s", self.host, self.port, self.worker_id)
+                await self._read(reader)
+            except (ConnectionError, asyncio.IncompleteReadError, ValueError) as e:
+                app_logger.error("Backplane connection lost: %s", e)
+            finally:
+                self._writer = None
+                self._connected.clear()
+                writer.close()
+            await asyncio.sleep(self.retry_seconds)
+
+    async def _read(self, reader: asyncio.StreamReader):
+        while True:
+            line = await reader.readline()
+            if not line:
+                raise ConnectionError("broker closed the connection")
+            kind, channel, payload = line.decode().rstrip("\n").split(" ", 2)
+            if kind != "MSG":
+                continue
+            envelope = loads(payload)
+            await self._dispatch(channel, envelope["data"], envelope["origin"])
+
+def create_backplane(kind: str = BACKPLANE) -> Backplane:
+    """Builds the backplane selected by the BACKPLANE setting ('memory' or 'socket')."""
+    if kind == "socket":
+        return SocketBackplane()
+    if kind != "memory":
+        raise ValueError(f"Unknown backplane: {kind}")
+    return InProcessBackplane()
+
+backplane = create_backplane()
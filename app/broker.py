@@ -0,0 +1,84 @@
+"""
+Minimal pub/sub broker for running several application workers together.
+
+Every worker connects with a SocketBackplane (BACKPLANE=socket) and the broker
+relays each published line to the other subscribers of its channel without
+decoding the payload. Start it before the workers:
+
+    python broker.py --host 127.0.0.1 --port 8766
+    BACKPLANE=socket uvicorn main:app --workers 4
+"""
+import argparse
+import asyncio
+
+from config import BACKPLANE_BROKER_HOST, BACKPLANE_BROKER_PORT
+from logs import get_logger, setup_logging
+
+server_logger = get_logger("server")
+app_logger = get_logger("app")
+
+MAX_LINE_BYTES = 16 * 1024 * 1024
+# Bytes allowed to pile up for a subscriber before it is dropped as too slow
+MAX_SUBSCRIBER_BUFFER = 64 * 1024 * 1024
+
+class Broker:
+    """Routes PUB lines to the writers subscribed to the same channel."""
+
+    def __init__(self):
+        self._subscribers: dict[str, set[asyncio.StreamWriter]] = {}
+
+    def _unsubscribe_all(self, writer: asyncio.StreamWriter):
+        for channel in [channel for channel, writers in self._subscribers.items() if writer in writers]:
+            self._subscribers[channel].discard(writer)
+            if not self._subscribers[channel]:
+                del self._subscribers[channel]
+
+    def _relay(self, sender: asyncio.StreamWriter, channel: str, line: bytes):
+        out = b"MSG" + line[3:]
+        for writer in list(self._subscribers.get(channel, ())):
+            if writer is sender:
+                continue
+            if writer.transport.get_write_buffer_size() > MAX_SUBSCRIBER_BUFFER:
+                app_logger.warning("Dropping slow subscriber %s", writer.get_extra_info("peername"))
+                self._unsubscribe_all(writer)
+                writer.close()
+                continue
+            writer.write(out)
+
+    async def handle_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        peer = writer.get_extra_info("peername")
+        server_logger.info("Broker client connected: %s", peer)
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                parts = line.split(b" ", 2)
+                if parts[0] == b"SUB" and len(parts) == 2:
+                    self._subscribers.setdefault(parts[1].strip().decode(), set()).add(writer)
+                elif parts[0] == b"PUB" and len(parts) == 3:
+                    self._relay(writer, parts[1].decode(), line)
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError) as e:
+            app_logger.error("Broker client %s failed: %s", peer, e)
+        finally:
+            self._unsubscribe_all(writer)
+            writer.close()
+            server_logger.info("Broker client disconnected: %s", peer)
+
+async def serve(host: str, port: int):
+    broker = Broker()
+    server = await asyncio.start_server(broker.handle_client, host, port, limit=MAX_LINE_BYTES)
+    server_logger.info("Broker listening on %s:%s", host, port)
+    async with server:
+        await server.serve_forever()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Pub/sub broker for multi-worker deployments.")
+    parser.add_argument("--host", default=BACKPLANE_BROKER_HOST)
+    parser.add_argument("--port", type=int, default=BACKPLANE_BROKER_PORT)
+    args = parser.parse_args()
+    setup_logging()
+    try:
+        asyncio.run(serve(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
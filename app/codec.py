@@ -0,0 +1,102 @@
+import json
+
+# Fast JSON codec shared by the WebSocket layer and the database layer.
+# Uses orjson or msgspec when installed and falls back to the standard library.
+try:
+    import orjson
+
+    JSON_BACKEND = "orjson"
+
+    def dumps(obj) -> str:
+        """Serializes obj to a JSON string."""
+        return orjson.dumps(obj).decode()
+
+    loads = orjson.loads
+except ImportError:
+    try:
+        import msgspec
+
+        JSON_BACKEND = "msgspec"
+        _encoder = msgspec.json.Encoder()
+        _decoder = msgspec.json.Decoder()
+
+        def dumps(obj) -> str:
+            """Serializes obj to a JSON string."""
+            return _encoder.encode(obj).decode()
+
+        loads = _decoder.decode
+    except ImportError:
+        JSON_BACKEND = "json"
+        _encoder = json.JSONEncoder(ensure_ascii=False, separators=(",", ":"))
+
+        def dumps(obj) -> str:
+            """Serializes obj to a JSON string."""
+            return _encoder.encode(obj)
+
+        loads = json.loads
+
+# MessagePack codec for clients that negotiate binary frames (encoding "msgpack"
+# in the connect message). Uses msgspec or the msgpack package; without either
+# only JSON is offered.
+try:
+    import msgspec
+
+    MSGPACK_BACKEND = "msgspec"
+    packb = msgspec.msgpack.Encoder().encode
+    unpackb = msgspec.msgpack.Decoder().decode
+except ImportError:
+    try:
+        import msgpack
+
+        MSGPACK_BACKEND = "msgpack"
+
+        def packb(obj) -> bytes:
+            """Serializes obj to MessagePack bytes."""
+            return msgpack.packb(obj)
+
+        def unpackb(data: bytes):
+            """Deserializes MessagePack bytes."""
+            return msgpack.unpackb(data)
+    except ImportError:
+        MSGPACK_BACKEND = None
+        packb = unpackb = None
+
+# Wire formats this server can speak; JSON is the default
+ENCODINGS = ("json", "msgpack") if MSGPACK_BACKEND else ("json",)
+
+class Frame:
+    """
+    A message serialized once per wire format and shared by every recipient of
+    a broadcast, instead of being re-encoded for each socket.
+    """
+
+    __slots__ = ("message", "_text", "_binary")
+
+    def __init__(self, message: dict):
+        self.message = message
+        self._text: str | None = None
+        self._binary: bytes | None = None
+
+    @property
+    def text(self) -> str:
+        """The message as JSON text, encoded on first use."""
+        if self._text is None:
+            self._text = dumps(self.message)
+        return self._text
+
+    @property
+    def binary(self) -> bytes:
+        """The message as MessagePack bytes, encoded on first use."""
+        if self._binary is None:
+            self._binary = packb(self.message)
+        return self._binary
+
+def encode(message: dict | Frame, encoding: str) -> str | bytes:
+    """
+    Serializes a message for a connection's negotiated wire format.
+    Returns:
+        str | bytes: JSON text for "json", MessagePack bytes for "msgpack".
+    """
+    if encoding == "msgpack":
+        return message.binary if isinstance(message, Frame) else packb(message)
+    return message.text if isinstance(message, Frame) else dumps(message)
@@ -4,9 +4,70 @@ import os
 SECRET_KEY = os.getenv("SECRET_KEY", "Llave de fallback")
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 60 * 24  # 1 día
+TOKEN_CACHE_SIZE = int(os.getenv("TOKEN_CACHE_SIZE", "4096"))  # Verified tokens kept in memory
+TOKEN_CACHE_TTL_SECONDS = int(os.getenv("TOKEN_CACHE_TTL_SECONDS", "300"))  # Re-verify cached tokens at least this often, even before 'exp'
+
+# Password Hashing Configuration
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", "12"))  # bcrypt cost factor for new hashes (each +1 doubles the work)
+PASSWORD_HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", str(min(4, os.cpu_count() or 1))))  # Concurrent bcrypt operations
+PASSWORD_HASH_MAX_PENDING = int(os.getenv("PASSWORD_HASH_MAX_PENDING", "64"))  # Operations allowed to wait for a worker before logins are refused
 
 # Database Configuration
 DB_FILE = "data/sessions.db" # La base de datos se guardará en la carpeta 'data'
+DB_POOL_READERS = int(os.getenv("DB_POOL_READERS", "4"))  # Read-only connections kept open alongside the single writer
+DB_CACHED_STATEMENTS = int(os.getenv("DB_CACHED_STATEMENTS", "256"))  # Prepared statements cached per connection
+DB_CACHE_SIZE_KB = int(os.getenv("DB_CACHE_SIZE_KB", "16384"))  # SQLite page cache per connection
+DB_MMAP_SIZE = int(os.getenv("DB_MMAP_SIZE", str(64 * 1024 * 1024)))  # Bytes of the database file to memory-map
+DB_BUSY_TIMEOUT_MS = int(os.getenv("DB_BUSY_TIMEOUT_MS", "5000"))
+DB_WRITE_BATCH_MAX = int(os.getenv("DB_WRITE_BATCH_MAX", "64"))  # Writes committed together by the group-commit writer (1 = one commit per write)
+DB_WRITE_BATCH_DELAY_MS = float(os.getenv("DB_WRITE_BATCH_DELAY_MS", "0"))  # Extra wait for more writes before a commit; 0 only groups writes queued during the previous one
+USERNAME_CACHE_SIZE = int(os.getenv("USERNAME_CACHE_SIZE", "4096"))  # Cached uuid->username and player_id->owner mappings
+
+# Player State Cache Configuration
+PLAYER_CACHE_FLUSH_SECONDS = float(os.getenv("PLAYER_CACHE_FLUSH_SECONDS", "5"))  # Write-behind interval for dirty character states
+PLAYER_SNAPSHOT_EVERY = int(os.getenv("PLAYER_SNAPSHOT_EVERY", "50"))  # Logged changes per character before its stored state is rewritten as a snapshot
+REPLAY_PAGE_SIZE = int(os.getenv("REPLAY_PAGE_SIZE", "200"))  # Default events per page of a lobby replay
+
+# Lobby Directory Configuration
+LOBBY_PAGE_SIZE = int(os.getenv("LOBBY_PAGE_SIZE", "20"))  # Active lobbies listed per page on /player
+
+# HTML Page Configuration
+PAGE_FRAGMENT_CACHE_SIZE = int(os.getenv("PAGE_FRAGMENT_CACHE_SIZE", "4096"))  # Rendered fragments (lobby lists, character cards) kept in memory
+TEMPLATES_AUTO_RELOAD = os.getenv("TEMPLATES_AUTO_RELOAD", "0") == "1"  # Recompile templates edited on disk; off, they are compiled once at startup
+
+# Static Asset Configuration
+STATIC_DIR = os.getenv("STATIC_DIR", "static")  # Read, fingerprinted and precompressed once at startup (restart to pick up edits)
+STATIC_MAX_AGE_SECONDS = int(os.getenv("STATIC_MAX_AGE_SECONDS", str(365 * 24 * 3600)))  # Browser cache lifetime of fingerprinted asset URLs
+
+# Master Broadcast Configuration
+MASTER_RESYNC_SECONDS = float(os.getenv("MASTER_RESYNC_SECONDS", "60"))  # Full players_state resync for masters; 0 disables it
+
+# Outbound Queue Configuration
+OUTBOX_MAX_MESSAGES = int(os.getenv("OUTBOX_MAX_MESSAGES", "256"))  # Pending messages per connection before the slow-consumer policy applies
+# Slow-consumer policies: 'drop_oldest', 'coalesce' (replace queued state updates with one fresh snapshot) or 'disconnect'
+OUTBOX_POLICY_MASTER = os.getenv("OUTBOX_POLICY_MASTER", "coalesce")
+OUTBOX_POLICY_PLAYER = os.getenv("OUTBOX_POLICY_PLAYER", "disconnect")
+
+# Multi-Worker Backplane Configuration
+BACKPLANE = os.getenv("BACKPLANE", "memory")  # 'memory' for a single worker, 'socket' to share events through broker.py
+BACKPLANE_BROKER_HOST = os.getenv("BACKPLANE_BROKER_HOST", "127.0.0.1")
+BACKPLANE_BROKER_PORT = int(os.getenv("BACKPLANE_BROKER_PORT", "8766"))
+BACKPLANE_PRESENCE_SECONDS = float(os.getenv("BACKPLANE_PRESENCE_SECONDS", "10"))  # How often workers republish their active players
+
+# Metrics Configuration
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "1") == "1"  # Serve /metrics and record latencies; 0 removes the instrumentation
+METRICS_LOOP_LAG_INTERVAL = float(os.getenv("METRICS_LOOP_LAG_INTERVAL", "0.5"))  # Seconds between event-loop lag probes
+
+# Logging Configuration
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()  # Default level for every subsystem
+# Per-subsystem overrides, e.g. LOG_LEVEL_WEBSOCKET=DEBUG shows every received message
+LOG_LEVELS = {
+    subsystem: os.getenv(f"LOG_LEVEL_{subsystem.upper()}", "").upper() or None
+    for subsystem in ("server", "db", "websocket", "app")
+}
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text")  # 'text' (tagged console lines) or 'json' (one object per line)
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))  # Records waiting to be written before new ones are dropped
+LOG_SAMPLE_PER_SECOND = float(os.getenv("LOG_SAMPLE_PER_SECOND", "5"))  # Per-message logs allowed per second and kind
 
 # Console Tags for logging
 TAGS = {
@@ -0,0 +1,152 @@
+from typing import Awaitable, Callable
+
+from fastapi import WebSocket
+
+from codec import Frame
+from config import OUTBOX_POLICY_MASTER, OUTBOX_POLICY_PLAYER
+from outbox import Outbox
+
+class Connection:
+    """A live WebSocket session of a player or master."""
+
+    __slots__ = ("user_uuid", "ws", "role", "selected_player_id", "player_status", "current_lobby_id", "username", "encoding", "outbox")
+
+    def __init__(
+        self,
+        user_uuid: str,
+        ws: WebSocket,
+        role: str,
+        selected_player_id: str | None = None,
+        player_status: str | None = None,
+        current_lobby_id: str | None = None,
+        snapshot: Callable[[], Awaitable[dict]] | None = None,
+        encoding: str = "json",
+    ):
+        self.user_uuid = user_uuid
+        self.ws = ws
+        self.role = role # "player" or "master"
+        self.selected_player_id = selected_player_id
+        self.player_status = player_status # "connected", "ready" or "in_game" for players
+        self.current_lobby_id = current_lobby_id
+        self.username: str | None = None # Resolved lazily for the master panels
+        self.encoding = encoding # "json" (text frames) or "msgpack" (binary frames)
+        policy = OUTBOX_POLICY_MASTER if role == "master" else OUTBOX_POLICY_PLAYER
+        self.outbox = Outbox(ws, f"{role} {user_uuid}", policy, snapshot, encoding=encoding)
+
+    def send(self, message: dict | Frame, state_update: bool = False) -> bool:
+        """Queues a message on this connection's outbox without waiting for the socket."""
+        return self.outbox.send(message, state_update)
+
+class LobbyRoom:
+    """The player connections currently tied to a lobby."""
+
+    __slots__ = ("lobby_id", "players")
+
+    def __init__(self, lobby_id: str):
+        self.lobby_id = lobby_id
+        self.players: set[Connection] = set()
+
+class ConnectionRegistry:
+    """
+    Indexes live connections by user, character, role and lobby so lookups
+    and lobby-wide notifications never scan the whole server population.
+    Each user has at most one registered connection; a new one replaces the old.
+    """
+
+    def __init__(self):
+        self._by_user: dict[str, Connection] = {}
+        self._by_player: dict[str, Connection] = {}
+        self._by_role: dict[str, dict[str, Connection]] = {"player": {}, "master": {}}
+        self._rooms: dict[str, LobbyRoom] = {}
+
+    def __len__(self):
+        return len(self._by_user)
+
+    def __contains__(self, user_uuid: str):
+        return user_uuid in self._by_user
+
+    def get(self, user_uuid: str) -> Connection | None:
+        return self._by_user.get(user_uuid)
+
+    def is_registered(self, conn: Connection) -> bool:
+        """Returns True if conn is still its user's registered connection."""
+        return self._by_user.get(conn.user_uuid) is conn
+
+    def by_player(self, player_id: str) -> Connection | None:
+        """Returns the connection playing a character, if any."""
+        return self._by_player.get(player_id)
+
+    def masters(self) -> list[Connection]:
+        return list(self._by_role["master"].values())
+
+    def players(self) -> list[Connection]:
+        return list(self._by_role["player"].values())
+
+    def has_masters(self) -> bool:
+        return bool(self._by_role["master"])
+
+    def outbox_depths(self) -> dict[str, list[int]]:
+        """Returns the outbound queue depth of every connection, grouped by role."""
+        return {role: [conn.outbox.depth for conn in conns.values()] for role, conns in self._by_role.items()}
+
+    def room(self, lobby_id: str) -> LobbyRoom | None:
+        return self._rooms.get(lobby_id)
+
+    def room_players(self, lobby_id: str) -> list[Connection]:
+        """Returns the player connections tied to a lobby."""
+        room = self._rooms.get(lobby_id)
+        return list(room.players) if room else []
+
+    def add(self, conn: Connection):
+        """Registers a connection, replacing any previous connection of the same user."""
+        previous = self._by_user.get(conn.user_uuid)
+        if previous is not None:
+            self.remove(previous)
+        self._by_user[conn.user_uuid] = conn
+        self._by_role[conn.role][conn.user_uuid] = conn
+        if conn.selected_player_id:
+            self._by_player[conn.selected_player_id] = conn
+        if conn.role == "player" and conn.current_lobby_id:
+            self._join_room(conn, conn.current_lobby_id)
+
+    def remove(self, conn: Connection) -> bool:
+        """
+        Unregisters a connection. Does nothing if the user has since been
+        registered with a different connection.
+        Returns:
+            bool: True if the connection was registered and has been removed.
+        """
+        if not self.is_registered(conn):
+            return False
+        del self._by_user[conn.user_uuid]
+        self._by_role[conn.role].pop(conn.user_uuid, None)
+        if conn.selected_player_id and self._by_player.get(conn.selected_player_id) is conn:
+            del self._by_player[conn.selected_player_id]
+        if conn.current_lobby_id:
+            self._leave_room(conn, conn.current_lobby_id)
+        return True
+
+    def set_lobby(self, conn: Connection, lobby_id: str | None):
+        """Moves a connection to another lobby (or out of any lobby with None)."""
+        if conn.current_lobby_id == lobby_id:
+            return
+        registered = self.is_registered(conn) and conn.role == "player"
+        if registered and conn.current_lobby_id:
+            self._leave_room(conn, conn.current_lobby_id)
+        conn.current_lobby_id = lobby_id
+        if registered and lobby_id:
+            self._join_room(conn, lobby_id)
+
+    def _join_room(self, conn: Connection, lobby_id: str):
+        room = self._rooms.get(lobby_id)
+        if room is None:
+            room = self._rooms[lobby_id] = LobbyRoom(lobby_id)
+        room.players.add(conn)
+
+    def _leave_room(self, conn: Connection, lobby_id: str):
+        room = self._rooms.get(lobby_id)
+        if room is None:
+            return
+        room.players.discard(conn)
+        if not room.players:
+            del self._rooms[lobby_id]
@@ -1,216 +1,770 @@
+import asyncio
 import aiosqlite
-import json
+import operator
+import time
 import uuid
+from contextlib import asynccontextmanager
 
-from config import DB_FILE, TAGS
+from config import (
+    DB_FILE,
+    DB_POOL_READERS,
+    DB_CACHED_STATEMENTS,
+    DB_CACHE_SIZE_KB,
+    DB_MMAP_SIZE,
+    DB_BUSY_TIMEOUT_MS,
+    DB_WRITE_BATCH_MAX,
+    DB_WRITE_BATCH_DELAY_MS,
+    USERNAME_CACHE_SIZE,
+    METRICS_ENABLED,
+)
+from codec import dumps, loads
+from lru import LRUCache
+from metrics import Gauge, Histogram, SIZE_BUCKETS, db_call_seconds, timed
+from migrations import CHARACTER_STAT_COLUMNS, run_migrations
+from patches import apply_patch, PatchError
+from logs import get_logger
 
-async def init_db():
-    """Initializes the SQLite database, creating tables if they don't exist."""
-    async with aiosqlite.connect(DB_FILE) as db:
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS players (
-                player_id TEXT PRIMARY KEY,
-                owner_uuid TEXT,
-                state TEXT
-            )
-        """)
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS users (
-                uuid TEXT PRIMARY KEY,
-                username TEXT UNIQUE,
-                password TEXT
-            )
-        """)
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS lobbies (
-                lobby_id TEXT PRIMARY KEY,
-                master_uuid TEXT NOT NULL,
-                lobby_name TEXT NOT NULL DEFAULT 'Partida Sin Nombre', -- New column for lobby name
-                status TEXT DEFAULT 'waiting', -- 'waiting', 'in_progress', 'finished'
-                players_in_lobby TEXT DEFAULT '[]', -- JSON array of player_ids
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
+db_logger = get_logger("db")
+
+db_write_batch_size = Histogram("dnd_db_write_batch_size", "Writes committed together by each group commit.", buckets=SIZE_BUCKETS)
+db_write_queue_seconds = Histogram("dnd_db_write_queue_seconds", "Time a write waited in the group-commit queue before its batch started.")
+
+# Queued by close() to stop the group-commit writer once everything before it is committed
+_STOP_WRITES = object()
+
+class ConnectionPool:
+    """
+    Long-lived SQLite connections shared by the whole application.
+    Holds a single writer connection (SQLite only allows one writer at a time)
+    and a fixed set of read-only connections that can run concurrently under WAL.
+    Mutations go through write(): a single writer task takes them from a queue
+    and commits up to `write_batch_max` of them in one transaction (group commit),
+    so concurrent writers share one fsync instead of queueing for the lock one by one.
+    """
+
+    def __init__(
+        self,
+        db_file: str,
+        readers: int = DB_POOL_READERS,
+        cached_statements: int = DB_CACHED_STATEMENTS,
+        write_batch_max: int = DB_WRITE_BATCH_MAX,
+        write_batch_delay: float = DB_WRITE_BATCH_DELAY_MS / 1000,
+    ):
+        self.db_file = db_file
+        self.reader_count = max(1, readers)
+        self.cached_statements = cached_statements
+        self.write_batch_max = max(1, write_batch_max)
+        self.write_batch_delay = max(0.0, write_batch_delay)
+        self._write_queue: asyncio.Queue | None = None
+        self._write_task: asyncio.Task | None = None
+        self._writer: aiosqlite.Connection | None = None
+        self._writer_lock = asyncio.Lock()
+        self._open_lock = asyncio.Lock()
+        self._readers: asyncio.Queue[aiosqlite.Connection] | None = None
+        self._all_readers: list[aiosqlite.Connection] = []
+
+    @property
+    def is_open(self) -> bool:
+        return self._writer is not None
+
+    async def _connect(self, read_only: bool) -> aiosqlite.Connection:
+        """Opens a connection with the performance pragmas applied."""
+        db = await aiosqlite.connect(self.db_file, cached_statements=self.cached_statements)
+        # executescript runs every statement to completion, so no pragma cursor is left holding a lock.
+        await db.executescript(f"""
+            PRAGMA busy_timeout = {DB_BUSY_TIMEOUT_MS};
+            PRAGMA synchronous = NORMAL;
+            PRAGMA cache_size = -{DB_CACHE_SIZE_KB};
+            PRAGMA mmap_size = {DB_MMAP_SIZE};
+            PRAGMA temp_store = MEMORY;
+            {"PRAGMA query_only = ON;" if read_only else ""}
         """)
-        await db.commit()
-    print(f"{TAGS['db']} Database initialized.")
-
-async def save_player_state(player_id: str, state: dict):
-    """Saves or updates a player's state in the database."""
-    async with aiosqlite.connect(DB_FILE) as db:
-        await db.execute(
-            "INSERT OR REPLACE INTO players (player_id, state) VALUES (?, ?)",
-            (player_id, json.dumps(state))
-        )
-        await db.commit()
+        return db
+
+    async def open(self):
+        """Opens the writer and reader connections. Safe to call more than once."""
+        async with self._open_lock:
+            if self.is_open:
+                return
+            writer = await self._connect(read_only=False)
+            # WAL is persistent in the database file, so it only needs to be set from the writer.
+            await writer.executescript("PRAGMA journal_mode = WAL;")
+            readers = asyncio.Queue()
+            for _ in range(self.reader_count):
+                reader = await self._connect(read_only=True)
+                self._all_readers.append(reader)
+                readers.put_nowait(reader)
+            self._readers = readers
+            self._writer = writer
+        db_logger.info("Connection pool opened (1 writer, %s readers).", self.reader_count)
+
+    async def close(self):
+        """Commits any queued writes, then closes every pooled connection."""
+        if self._write_task is not None:
+            self._write_queue.put_nowait(_STOP_WRITES)
+            await asyncio.gather(self._write_task, return_exceptions=True)
+            self._write_task = None
+            self._write_queue = None
+        if not self.is_open:
+            return
+        async with self._writer_lock:
+            await self._writer.close()
+            self._writer = None
+        for reader in self._all_readers:
+            await reader.close()
+        self._all_readers.clear()
+        self._readers = None
+        db_logger.info("Connection pool closed.")
+
+    @asynccontextmanager
+    async def reader(self):
+        """Borrows a read-only connection for the duration of the block."""
+        if not self.is_open:
+            await self.open()
+        db = await self._readers.get()
+        try:
+            yield db
+        finally:
+            self._readers.put_nowait(db)
+
+    @asynccontextmanager
+    async def writer(self):
+        """
+        Holds the writer connection exclusively for the duration of the block.
+        Any transaction left open by a failing block is rolled back.
+        """
+        if not self.is_open:
+            await self.open()
+        async with self._writer_lock:
+            try:
+                yield self._writer
+            except BaseException:
+                if self._writer.in_transaction:
+                    await self._writer.rollback()
+                raise
+
+    @property
+    def write_queue_depth(self) -> int:
+        """Writes waiting for the group-commit writer."""
+        return self._write_queue.qsize() if self._write_queue is not None else 0
+
+    async def write(self, operation):
+        """
+        Runs `await operation(db)` on the writer connection as part of the next group
+        commit and returns its result once the commit is done. The operation must not
+        commit or roll back itself; if it raises, only its own changes are undone and
+        the exception is re-raised to this caller.
+        """
+        if self._write_task is None or self._write_task.done():
+            if self._write_task is not None:
+                db_logger.warning("Group-commit writer had stopped; restarting it.")
+            self._write_queue = asyncio.Queue()
+            self._write_task = asyncio.create_task(self._run_writes())
+        future = asyncio.get_running_loop().create_future()
+        self._write_queue.put_nowait((operation, future, time.perf_counter()))
+        return await future
+
+    async def execute_write(self, sql: str, parameters=()) -> int:
+        """Queues one statement for group commit. Returns the number of rows it changed."""
+        async def operation(db):
+            cursor = await db.execute(sql, parameters)
+            return cursor.rowcount
+        return await self.write(operation)
+
+    async def executemany_write(self, sql: str, seq_of_parameters) -> int:
+        """Queues a statement run once per parameter set for group commit. Returns the rows changed."""
+        async def operation(db):
+            cursor = await db.executemany(sql, seq_of_parameters)
+            return cursor.rowcount
+        return await self.write(operation)
+
+    async def _run_writes(self):
+        """
+        Writer task: takes queued writes and commits them in groups.
+        However it exits (stopped, cancelled or crashed), every write it has not
+        committed is failed, so no caller is left waiting.
+        """
+        queue = self._write_queue
+        batch = []
+        try:
+            while True:
+                first = await queue.get()
+                if first is _STOP_WRITES:
+                    return
+                batch = [first]
+                if self.write_batch_delay and len(batch) < self.write_batch_max and queue.empty():
+                    await asyncio.sleep(self.write_batch_delay)
+                stopping = False
+                while len(batch) < self.write_batch_max and not queue.empty():
+                    item = queue.get_nowait()
+                    if item is _STOP_WRITES:
+                        stopping = True
+                        break
+                    batch.append(item)
+                await self._commit_batch(batch)
+                batch = []
+                if stopping:
+                    return
+        finally:
+            self._fail_pending_writes(batch, queue)
+
+    def _fail_pending_writes(self, batch: list, queue: asyncio.Queue):
+        """Fails the writes of an unfinished batch and any still queued."""
+        pending = list(batch)
+        while not queue.empty():
+            item = queue.get_nowait()
+            if item is not _STOP_WRITES:
+                pending.append(item)
+        pending = [future for _, future, _ in pending if not future.done()]
+        for future in pending:
+            future.set_exception(RuntimeError("The database writer stopped before committing this write."))
+        if pending:
+            db_logger.error("Group-commit writer stopped with %s uncommitted writes.", len(pending))
+
+    async def _commit_batch(self, batch: list):
+        """Runs a group of writes in one transaction, each under its own savepoint."""
+        started = time.perf_counter()
+        outcomes = []
+        try:
+            async with self.writer() as db:
+                await db.execute("BEGIN IMMEDIATE")
+                for operation, _, _ in batch:
+                    await db.execute("SAVEPOINT group_write")
+                    try:
+                        outcomes.append((True, await operation(db)))
+                    except Exception as e:
+                        await db.execute("ROLLBACK TO group_write")
+                        outcomes.append((False, e))
+                    await db.execute("RELEASE group_write")
+                await db.commit()
+        except Exception as e:
+            db_logger.error("Group commit of %s writes failed: %s", len(batch), e)
+            outcomes = [(False, e)] * len(batch)
+        for (_, future, _), (succeeded, value) in zip(batch, outcomes):
+            if future.done():
+                continue # The caller stopped waiting; the write itself still happened
+            if succeeded:
+                future.set_result(value)
+            else:
+                future.set_exception(value)
+        if METRICS_ENABLED:
+            db_write_batch_size.observe(len(batch))
+            for _, _, queued_at in batch:
+                db_write_queue_seconds.observe(started - queued_at)
+
+pool = ConnectionPool(DB_FILE)
+
+Gauge("dnd_db_write_queue_depth", "Writes waiting for the group-commit writer.", lambda: pool.write_queue_depth)
+
+# Usernames are read on every page and master panel but change only when a user is created or renamed.
+# Characters never change owner, so player_id -> owner_uuid never needs invalidating.
+username_cache = LRUCache(USERNAME_CACHE_SIZE)   # user_uuid -> username
+player_owner_cache = LRUCache(USERNAME_CACHE_SIZE)  # player_id -> owner_uuid
+
+# Maximum number of ids bound into a single IN (...) query
+IN_QUERY_CHUNK = 500
+
+def _chunks(items: list, size: int = IN_QUERY_CHUNK):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+def invalidate_username(user_uuid: str):
+    """Drops a cached username. Must be called whenever a user is created or renamed."""
+    username_cache.pop(user_uuid)
+
+async def open_db_pool():
+    """Opens the shared connection pool. Called once at application startup."""
+    await pool.open()
+
+async def close_db_pool():
+    """Closes the shared connection pool. Called once at application shutdown."""
+    await pool.close()
+
+async def init_db():
+    """Initializes the SQLite database, applying any pending schema migrations."""
+    async with pool.writer() as db:
+        await run_migrations(db)
+    db_logger.info("Database initialized.")
 
+# Writes a full state as the character's snapshot: it supersedes every event logged so far.
+SAVE_PLAYER_STATE_SQL = """
+    INSERT INTO players (player_id, state, snapshot_event_id)
+    VALUES (?, ?, (SELECT COALESCE(MAX(event_id), 0) FROM character_events WHERE player_id = ?))
+    ON CONFLICT (player_id) DO UPDATE SET state = excluded.state, snapshot_event_id = excluded.snapshot_event_id
+"""
+
+APPEND_CHARACTER_EVENT_SQL = """
+    INSERT INTO character_events (player_id, lobby_id, kind, payload, created_at) VALUES (?, ?, ?, ?, ?)
+"""
+
+def _replay_events(player_id: str, state: dict, events) -> dict:
+    """Applies logged (kind, payload) events, oldest first, on top of a snapshot."""
+    for kind, payload in events:
+        if kind == "patch":
+            try:
+                state = apply_patch(state, loads(payload))
+            except PatchError as e:
+                db_logger.error("Skipping unreplayable event of %s: %s", player_id, e)
+        else:
+            state = loads(payload)
+    return state
+
+# Current states: each snapshot joined with the events logged after it (usually none)
+CURRENT_STATES_SQL = """
+    SELECT T1.player_id, T1.state, T2.kind, T2.payload
+    FROM players AS T1 LEFT JOIN character_events AS T2
+        ON T2.player_id = T1.player_id AND T2.event_id > T1.snapshot_event_id
+    WHERE {condition}
+    ORDER BY T2.event_id
+"""
+
+def _fold_current_states(rows, states: dict[str, dict]):
+    """Builds current states from CURRENT_STATES_SQL rows, parsing each snapshot only once."""
+    tails: dict[str, list] = {}
+    for player_id, state, kind, payload in rows:
+        if player_id not in states:
+            states[player_id] = loads(state)
+        if kind is not None:
+            tails.setdefault(player_id, []).append((kind, payload))
+    for player_id, events in tails.items():
+        states[player_id] = _replay_events(player_id, states[player_id], events)
+
+@timed(db_call_seconds)
+async def append_character_events(events: list, snapshots: dict[str, dict] | None = None):
+    """
+    Appends state changes to the character event log in one transaction,
+    optionally compacting some characters into a fresh snapshot afterwards.
+    Args:
+        events (list): (player_id, lobby_id, kind, payload, created_at) tuples, oldest first.
+        snapshots (dict | None): player_id -> current state of the characters to compact.
+    """
+    if not events and not snapshots:
+        return
+    event_rows = [(player_id, lobby_id, kind, dumps(payload), created_at) for player_id, lobby_id, kind, payload, created_at in events]
+    snapshot_rows = [(player_id, dumps(state), player_id) for player_id, state in (snapshots or {}).items()]
+
+    async def operation(db):
+        await db.executemany(APPEND_CHARACTER_EVENT_SQL, event_rows)
+        if snapshot_rows:
+            await db.executemany(SAVE_PLAYER_STATE_SQL, snapshot_rows)
+    await pool.write(operation)
+
+async def _load_player_states(player_ids) -> dict[str, dict]:
+    states = {}
+    player_ids = list(dict.fromkeys(player_ids))
+    if not player_ids:
+        return states
+    async with pool.reader() as db:
+        for chunk in _chunks(player_ids):
+            placeholders = ", ".join("?" * len(chunk))
+            async with db.execute(
+                CURRENT_STATES_SQL.format(condition=f"T1.player_id IN ({placeholders})"), chunk
+            ) as cursor:
+                _fold_current_states(await cursor.fetchall(), states)
+    return states
+
+@timed(db_call_seconds)
 async def load_player_state_by_id(player_id: str):
-    """Loads a single player's state from the database by player_id."""
-    async with aiosqlite.connect(DB_FILE) as db:
-        cursor = await db.execute("SELECT state FROM players WHERE player_id = ?", (player_id,))
-        row = await cursor.fetchone()
-        if row:
-            return json.loads(row[0])
-        return None
+    """Loads a single player's current state: its latest snapshot plus the events logged after it."""
+    return (await _load_player_states([player_id])).get(player_id)
+
+@timed(db_call_seconds)
+async def load_player_states(player_ids):
+    """
+    Loads several players' current states (snapshot plus event tail) in one query per chunk.
+    Returns:
+        dict: player_id -> state, for the player_ids that exist.
+    """
+    return await _load_player_states(player_ids)
 
+@timed(db_call_seconds)
+async def get_lobby_events_db(lobby_id: str, after_event_id: int = 0, limit: int = 200):
+    """
+    Returns one page of a lobby's character history, oldest first.
+    Pages are keyed by event_id: pass the last event_id received to get the next page.
+    Returns:
+        list: Dictionaries with event_id, player_id, kind, payload and created_at.
+    """
+    async with pool.reader() as db:
+        async with db.execute(
+            """
+            SELECT event_id, player_id, kind, payload, created_at
+            FROM character_events
+            WHERE lobby_id = ? AND event_id > ?
+            ORDER BY event_id LIMIT ?
+            """,
+            (lobby_id, after_event_id, limit)
+        ) as cursor:
+            rows = await cursor.fetchall()
+    return [
+        {"event_id": row[0], "player_id": row[1], "kind": row[2], "payload": loads(row[3]), "created_at": row[4]}
+        for row in rows
+    ]
+
+@timed(db_call_seconds)
 async def get_user_by_username(username: str):
     """Retrieves a user's password hash and UUID by username."""
-    async with aiosqlite.connect(DB_FILE) as db:
-        cursor = await db.execute("SELECT password, uuid FROM users WHERE username = ?", (username,))
-        return await cursor.fetchone()
+    async with pool.reader() as db:
+        async with db.execute("SELECT password, uuid FROM users WHERE username = ?", (username,)) as cursor:
+            return await cursor.fetchone()
 
+@timed(db_call_seconds)
 async def get_username_by_uuid(user_uuid: str):
     """Retrieves a username by user UUID."""
-    async with aiosqlite.connect(DB_FILE) as db:
-        cursor = await db.execute("SELECT username FROM users WHERE uuid = ?", (user_uuid,))
-        row = await cursor.fetchone()
-        return row[0] if row else None
+    username = username_cache.get(user_uuid)
+    if username is not None:
+        return username
+    async with pool.reader() as db:
+        async with db.execute("SELECT username FROM users WHERE uuid = ?", (user_uuid,)) as cursor:
+            row = await cursor.fetchone()
+    if not row:
+        return None
+    username_cache.put(user_uuid, row[0])
+    return row[0]
 
+@timed(db_call_seconds)
 async def create_new_user(username: str, hashed_password: str, user_uuid: str):
     """Inserts a new user into the database."""
-    async with aiosqlite.connect(DB_FILE) as db:
-        await db.execute(
-            "INSERT INTO users (uuid, username, password) VALUES (?, ?, ?)",
-            (user_uuid, username, hashed_password)
-        )
-        await db.commit()
+    await pool.execute_write(
+        "INSERT INTO users (uuid, username, password) VALUES (?, ?, ?)",
+        (user_uuid, username, hashed_password)
+    )
+    invalidate_username(user_uuid)
 
+@timed(db_call_seconds)
 async def create_initial_player_character(player_id: str, owner_uuid: str, character_state: dict):
     """Inserts a new player character into the database."""
-    async with aiosqlite.connect(DB_FILE) as db:
-        await db.execute(
-            "INSERT INTO players (player_id, owner_uuid, state) VALUES (?, ?, ?)",
-            (player_id, owner_uuid, json.dumps(character_state))
-        )
-        await db.commit()
+    await pool.execute_write(
+        "INSERT INTO players (player_id, owner_uuid, state) VALUES (?, ?, ?)",
+        (player_id, owner_uuid, dumps(character_state))
+    )
 
+@timed(db_call_seconds)
 async def get_characters_by_owner_uuid(owner_uuid: str):
     """Retrieves all characters owned by a specific user UUID."""
-    async with aiosqlite.connect(DB_FILE) as db:
-        cursor = await db.execute(
-            "SELECT player_id, state FROM players WHERE owner_uuid = ?", (owner_uuid,)
-        )
-        rows = await cursor.fetchall()
-        return [{"player_id": r[0], "state": json.loads(r[1])} for r in rows]
+    async with pool.reader() as db:
+        async with db.execute(
+            CURRENT_STATES_SQL.format(condition="T1.owner_uuid = ?"), (owner_uuid,)
+        ) as cursor:
+            rows = await cursor.fetchall()
+    states = {}
+    _fold_current_states(rows, states)
+    return [{"player_id": player_id, "state": state} for player_id, state in states.items()]
 
+@timed(db_call_seconds)
 async def check_player_ownership(player_id: str, owner_uuid: str):
     """Checks if a player_id belongs to a specific owner_uuid."""
-    async with aiosqlite.connect(DB_FILE) as db:
-        cursor = await db.execute(
+    async with pool.reader() as db:
+        async with db.execute(
             "SELECT 1 FROM players WHERE player_id = ? AND owner_uuid = ?",
             (player_id, owner_uuid)
-        )
-        return await cursor.fetchone() is not None
+        ) as cursor:
+            return await cursor.fetchone() is not None
 
 # --- Lobby Functions ---
 
+@timed(db_call_seconds)
 async def create_lobby_db(master_uuid: str, lobby_name: str):
     """Creates a new game lobby in the database."""
     lobby_id = str(uuid.uuid4())
-    async with aiosqlite.connect(DB_FILE) as db:
-        await db.execute(
-            "INSERT INTO lobbies (lobby_id, master_uuid, lobby_name) VALUES (?, ?, ?)",
-            (lobby_id, master_uuid, lobby_name)
-        )
-        await db.commit()
+    await pool.execute_write(
+        "INSERT INTO lobbies (lobby_id, master_uuid, lobby_name) VALUES (?, ?, ?)",
+        (lobby_id, master_uuid, lobby_name)
+    )
     return lobby_id
 
+@timed(db_call_seconds)
 async def get_lobby_db(lobby_id: str):
     """Retrieves a lobby's information by its ID."""
-    async with aiosqlite.connect(DB_FILE) as db:
-        cursor = await db.execute(
-            "SELECT lobby_id, master_uuid, lobby_name, status, players_in_lobby FROM lobbies WHERE lobby_id = ?",
+    async with pool.reader() as db:
+        async with db.execute(
+            """
+            SELECT lobby_id, master_uuid, lobby_name, status,
+                (SELECT json_group_array(player_id) FROM (
+                    SELECT player_id FROM lobby_players
+                    WHERE lobby_players.lobby_id = lobbies.lobby_id
+                    ORDER BY joined_at, rowid
+                ))
+            FROM lobbies WHERE lobby_id = ?
+            """,
             (lobby_id,)
-        )
-        row = await cursor.fetchone()
-        if row:
-            return {
-                "lobby_id": row[0],
-                "master_uuid": row[1],
-                "lobby_name": row[2],
-                "status": row[3],
-                "players_in_lobby": json.loads(row[4]) # Parse JSON string back to list
-            }
-        return None
+        ) as cursor:
+            row = await cursor.fetchone()
+            if row:
+                return {
+                    "lobby_id": row[0],
+                    "master_uuid": row[1],
+                    "lobby_name": row[2],
+                    "status": row[3],
+                    "players_in_lobby": loads(row[4]) # Parse JSON string back to list
+                }
+            return None
 
+@timed(db_call_seconds)
 async def update_lobby_status_db(lobby_id: str, status: str):
     """Updates the status of a lobby."""
-    async with aiosqlite.connect(DB_FILE) as db:
-        await db.execute(
-            "UPDATE lobbies SET status = ? WHERE lobby_id = ?",
-            (status, lobby_id)
-        )
-        await db.commit()
+    await pool.execute_write(
+        "UPDATE lobbies SET status = ? WHERE lobby_id = ?",
+        (status, lobby_id)
+    )
 
+@timed(db_call_seconds)
 async def add_player_to_lobby_db(lobby_id: str, player_id: str):
-    """Adds a player to a lobby's players_in_lobby list."""
-    async with aiosqlite.connect(DB_FILE) as db:
-        # Get current players list
-        cursor = await db.execute("SELECT players_in_lobby FROM lobbies WHERE lobby_id = ?", (lobby_id,))
-        row = await cursor.fetchone()
-        if row:
-            players_in_lobby = json.loads(row[0])
-            if player_id not in players_in_lobby:
-                players_in_lobby.append(player_id)
-                await db.execute(
-                    "UPDATE lobbies SET players_in_lobby = ? WHERE lobby_id = ?",
-                    (json.dumps(players_in_lobby), lobby_id)
-                )
-                await db.commit()
-                return True
-        return False
+    """
+    Adds a player to a lobby's member list.
+    Returns True only if the lobby exists and the player was not already in it.
+    """
+    inserted = await pool.execute_write(
+        """
+        INSERT OR IGNORE INTO lobby_players (lobby_id, player_id)
+        SELECT ?, ? WHERE EXISTS (SELECT 1 FROM lobbies WHERE lobby_id = ?)
+        """,
+        (lobby_id, player_id, lobby_id)
+    )
+    return inserted > 0
 
+@timed(db_call_seconds)
 async def remove_player_from_lobby_db(lobby_id: str, player_id: str):
-    """Removes a player from a lobby's players_in_lobby list."""
-    async with aiosqlite.connect(DB_FILE) as db:
-        cursor = await db.execute("SELECT players_in_lobby FROM lobbies WHERE lobby_id = ?", (lobby_id,))
-        row = await cursor.fetchone()
-        if row:
-            players_in_lobby = json.loads(row[0])
-            if player_id in players_in_lobby:
-                players_in_lobby.remove(player_id)
-                await db.execute(
-                    "UPDATE lobbies SET players_in_lobby = ? WHERE lobby_id = ?",
-                    (json.dumps(players_in_lobby), lobby_id)
-                )
-                await db.commit()
-                return True
-        return False
+    """Removes a player from a lobby's member list. Returns True if they were in it."""
+    deleted = await pool.execute_write(
+        "DELETE FROM lobby_players WHERE lobby_id = ? AND player_id = ?",
+        (lobby_id, player_id)
+    )
+    return deleted > 0
 
+@timed(db_call_seconds)
 async def get_lobbies_by_master_uuid(master_uuid: str):
     """Retrieves all lobbies created by a specific master."""
-    async with aiosqlite.connect(DB_FILE) as db:
-        cursor = await db.execute(
+    async with pool.reader() as db:
+        async with db.execute(
             "SELECT lobby_id, lobby_name, status FROM lobbies WHERE master_uuid = ? ORDER BY created_at DESC",
             (master_uuid,)
-        )
-        rows = await cursor.fetchall()
-        return [{"lobby_id": row[0], "lobby_name": row[1], "status": row[2]} for row in rows]
+        ) as cursor:
+            rows = await cursor.fetchall()
+            return [{"lobby_id": row[0], "lobby_name": row[1], "status": row[2]} for row in rows]
+
+@timed(db_call_seconds)
+async def get_active_lobbies_db():
+    """
+    Retrieves every joinable lobby ('waiting' or 'in_progress') together with
+    its master's username in a single query, oldest first.
+    """
+    async with pool.reader() as db:
+        async with db.execute(
+            """
+            SELECT T1.lobby_id, T1.master_uuid, T1.lobby_name, T1.status, T2.username
+            FROM lobbies AS T1 LEFT JOIN users AS T2 ON T1.master_uuid = T2.uuid
+            WHERE T1.status IN ('waiting', 'in_progress')
+            ORDER BY T1.created_at, T1.rowid
+            """
+        ) as cursor:
+            rows = await cursor.fetchall()
+            return [
+                {
+                    "lobby_id": row[0],
+                    "master_uuid": row[1],
+                    "lobby_name": row[2],
+                    "status": row[3],
+                    "master_username": row[4] if row[4] else "Unknown Master"
+                }
+                for row in rows
+            ]
 
+@timed(db_call_seconds)
 async def get_username_for_player_id(player_id: str):
     """Retrieves the username associated with a player_id."""
-    async with aiosqlite.connect(DB_FILE) as db:
-        cursor = await db.execute(
-            "SELECT T2.username FROM players AS T1 JOIN users AS T2 ON T1.owner_uuid = T2.uuid WHERE T1.player_id = ?",
-            (player_id,)
-        )
-        row = await cursor.fetchone()
-        return row[0] if row else "Unknown Player"
+    usernames = await _get_usernames_for_player_ids([player_id])
+    return usernames[player_id]
+
+@timed(db_call_seconds)
+async def get_usernames_for_player_ids(player_ids):
+    """
+    Retrieves the usernames of the owners of several characters in one query.
+    Cached mappings are answered from memory; only the misses hit the database.
+    Returns:
+        dict: player_id -> username ("Unknown Player" if it cannot be resolved).
+    """
+    return await _get_usernames_for_player_ids(player_ids)
+
+async def _get_usernames_for_player_ids(player_ids) -> dict[str, str]:
+    usernames = {}
+    missing = []
+    for player_id in dict.fromkeys(player_ids):
+        owner_uuid = player_owner_cache.get(player_id)
+        username = username_cache.get(owner_uuid) if owner_uuid is not None else None
+        if username is not None:
+            usernames[player_id] = username
+        else:
+            missing.append(player_id)
 
+    if missing:
+        async with pool.reader() as db:
+            for chunk in _chunks(missing):
+                placeholders = ", ".join("?" * len(chunk))
+                async with db.execute(
+                    f"""
+                    SELECT T1.player_id, T1.owner_uuid, T2.username
+                    FROM players AS T1 JOIN users AS T2 ON T1.owner_uuid = T2.uuid
+                    WHERE T1.player_id IN ({placeholders})
+                    """,
+                    chunk
+                ) as cursor:
+                    for player_id, owner_uuid, username in await cursor.fetchall():
+                        player_owner_cache.put(player_id, owner_uuid)
+                        username_cache.put(owner_uuid, username)
+                        usernames[player_id] = username
+
+    for player_id in missing:
+        usernames.setdefault(player_id, "Unknown Player")
+    return usernames
+
+@timed(db_call_seconds)
 async def delete_lobby_db(lobby_id: str):
-    """Deletes a lobby from the database."""
-    async with aiosqlite.connect(DB_FILE) as db:
+    """Deletes a lobby and its memberships from the database."""
+    async def operation(db):
+        await db.execute("DELETE FROM lobby_players WHERE lobby_id = ?", (lobby_id,))
         await db.execute("DELETE FROM lobbies WHERE lobby_id = ?", (lobby_id,))
-        await db.commit()
-        return True
-    return False
+    await pool.write(operation)
+    return True
 
+@timed(db_call_seconds)
 async def clear_lobby_players_db(lobby_id: str):
-    """Clears the players_in_lobby list for a given lobby."""
-    async with aiosqlite.connect(DB_FILE) as db:
-        await db.execute(
-            "UPDATE lobbies SET players_in_lobby = '[]' WHERE lobby_id = ?",
+    """Removes every player from a given lobby."""
+    await pool.execute_write("DELETE FROM lobby_players WHERE lobby_id = ?", (lobby_id,))
+    return True
+
+# Stats that can be aggregated, filtered and sorted in SQL (generated columns of the players table)
+NUMERIC_STATS = tuple(column for column, column_type in CHARACTER_STAT_COLUMNS.items() if column_type == "INTEGER")
+STAT_FILTER_OPERATORS = {"lt": "<", "le": "<=", "eq": "=", "ge": ">=", "gt": ">"}
+STAT_FILTER_FUNCTIONS = {"lt": operator.lt, "le": operator.le, "eq": operator.eq, "ge": operator.ge, "gt": operator.gt}
+
+# The stat columns are generated from the stored snapshot, so they lag behind characters
+# with events logged after it. Those few are read through CURRENT_STATES_SQL instead.
+HAS_EVENT_TAIL_SQL = """EXISTS (
+    SELECT 1 FROM character_events AS E
+    WHERE E.player_id = {alias}.player_id AND E.event_id > {alias}.snapshot_event_id
+)"""
+
+async def _load_event_tail_states(lobby_id: str) -> dict[str, dict]:
+    """Loads the current states of a lobby's characters whose stat columns lag behind."""
+    async with pool.reader() as db:
+        async with db.execute(
+            f"""
+            SELECT T1.player_id
+            FROM players AS T1 JOIN lobby_players AS T2 ON T2.player_id = T1.player_id AND T2.lobby_id = ?
+            WHERE {HAS_EVENT_TAIL_SQL.format(alias='T1')}
+            """,
             (lobby_id,)
-        )
-        await db.commit()
-        return True
-    return False
+        ) as cursor:
+            player_ids = [row[0] for row in await cursor.fetchall()]
+    return await _load_player_states(player_ids)
+
+def _stat_matches(value, operator_name: str, target) -> bool:
+    """Evaluates a stat filter on a state value the way SQLite would (NULL never matches)."""
+    try:
+        return value is not None and STAT_FILTER_FUNCTIONS[operator_name](value, target)
+    except TypeError:
+        return False
+
+@timed(db_call_seconds)
+async def get_lobby_stats_db(lobby_id: str):
+    """
+    Aggregates the core stats of the characters in a lobby inside SQLite,
+    reading only the indexed stat columns (no state is deserialized) except
+    for characters with events logged after their snapshot.
+    Returns:
+        dict: {"players": count, "stats": {stat: {"avg", "min", "max", "sum"}}, "clases": {clase: count}}
+    """
+    aggregates = ", ".join(f"COUNT(T2.{stat}), MIN(T2.{stat}), MAX(T2.{stat}), SUM(T2.{stat})" for stat in NUMERIC_STATS)
+    fresh = f"NOT {HAS_EVENT_TAIL_SQL.format(alias='T2')}"
+    async with pool.reader() as db:
+        async with db.execute(
+            f"""
+            SELECT COUNT(*), {aggregates}
+            FROM lobby_players AS T1 JOIN players AS T2 ON T1.player_id = T2.player_id
+            WHERE T1.lobby_id = ? AND {fresh}
+            """,
+            (lobby_id,)
+        ) as cursor:
+            row = await cursor.fetchone()
+        async with db.execute(
+            f"""
+            SELECT T2.clase, COUNT(*)
+            FROM lobby_players AS T1 JOIN players AS T2 ON T1.player_id = T2.player_id
+            WHERE T1.lobby_id = ? AND {fresh}
+            GROUP BY T2.clase
+            """,
+            (lobby_id,)
+        ) as cursor:
+            clases = {clase: count for clase, count in await cursor.fetchall()}
+    tail_states = await _load_event_tail_states(lobby_id)
+    stats = {}
+    for index, stat in enumerate(NUMERIC_STATS):
+        count, minimum, maximum, total = row[1 + index * 4:5 + index * 4]
+        for state in tail_states.values():
+            value = state.get(stat)
+            if isinstance(value, (int, float)):
+                count += 1
+                minimum = value if minimum is None else min(minimum, value)
+                maximum = value if maximum is None else max(maximum, value)
+                total = value if total is None else total + value
+        stats[stat] = {"avg": total / count if count else None, "min": minimum, "max": maximum, "sum": total}
+    for state in tail_states.values():
+        clases[state.get("clase")] = clases.get(state.get("clase"), 0) + 1
+    clases = dict(sorted(clases.items(), key=lambda item: item[1], reverse=True))
+    return {"players": row[0] + len(tail_states), "stats": stats, "clases": clases}
+
+@timed(db_call_seconds)
+async def find_characters_db(lobby_id: str, filters=(), order_by: str | None = None, descending: bool = False, limit: int = 50):
+    """
+    Finds a lobby's characters by their core stats using the indexed stat columns,
+    e.g. everyone under 10 vida, or the richest character of the lobby.
+    Characters with events logged after their snapshot are matched on their current state.
+    Args:
+        lobby_id (str): The lobby whose players are searched.
+        filters: (stat, operator, value) tuples combined with AND, e.g. ("vida", "lt", 10).
+            Operators are the keys of STAT_FILTER_OPERATORS.
+        order_by (str | None): Stat to sort by.
+        descending (bool): Sort from highest to lowest.
+        limit (int): Maximum number of characters returned.
+    Returns:
+        list: Dictionaries with player_id, nombre and the core stats of each match.
+    Raises:
+        ValueError: If a stat or operator is unknown.
+    """
+    conditions, params = [f"NOT {HAS_EVENT_TAIL_SQL.format(alias='T1')}"], [lobby_id]
+    for stat, operator_name, value in filters:
+        if stat not in CHARACTER_STAT_COLUMNS or operator_name not in STAT_FILTER_OPERATORS:
+            raise ValueError(f"Filtro no válido: {stat} {operator_name}")
+        conditions.append(f"T1.{stat} {STAT_FILTER_OPERATORS[operator_name]} ?")
+        params.append(value)
+    if order_by is not None and order_by not in CHARACTER_STAT_COLUMNS:
+        raise ValueError(f"No se puede ordenar por: {order_by}")
+    order = f"ORDER BY T1.{order_by} {'DESC' if descending else 'ASC'}, T1.player_id" if order_by else "ORDER BY T1.player_id"
+    columns = ", ".join(f"T1.{column}" for column in CHARACTER_STAT_COLUMNS)
+    params.append(limit)
+    async with pool.reader() as db:
+        async with db.execute(
+            f"""
+            SELECT T1.player_id, json_extract(T1.state, '$.nombre'), {columns}
+            FROM players AS T1 JOIN lobby_players AS T2 ON T2.player_id = T1.player_id AND T2.lobby_id = ?
+            WHERE {' AND '.join(conditions)} {order} LIMIT ?
+            """,
+            params
+        ) as cursor:
+            rows = await cursor.fetchall()
+    characters = [
+        {"player_id": row[0], "nombre": row[1], **dict(zip(CHARACTER_STAT_COLUMNS, row[2:]))}
+        for row in rows
+    ]
+    tail_states = await _load_event_tail_states(lobby_id)
+    for player_id, state in tail_states.items():
+        if all(_stat_matches(state.get(stat), operator_name, value) for stat, operator_name, value in filters):
+            characters.append({"player_id": player_id, "nombre": state.get("nombre"), **{column: state.get(column) for column in CHARACTER_STAT_COLUMNS}})
+    if tail_states:
+        # Same order as SQLite: NULLs first when ascending, ties broken by player_id
+        characters.sort(key=lambda character: character["player_id"])
+        if order_by:
+            characters.sort(key=lambda character: (character[order_by] is not None, character[order_by]), reverse=descending)
+        characters = characters[:limit]
+    return characters
@@ -0,0 +1,80 @@
+import asyncio
+from itertools import islice
+
+from config import LOBBY_PAGE_SIZE
+from database import get_active_lobbies_db
+from logs import get_logger
+
+app_logger = get_logger("app")
+
+# Lobby statuses players can still join
+JOINABLE_LOBBY_STATUSES = ("waiting", "in_progress")
+
+class LobbyDirectory:
+    """
+    In-memory list of joinable lobbies shown on the /player page.
+    Loaded from the database once with a single query and then kept current by
+    the lobby create/start/end/delete handlers, so listing lobbies costs no
+    database work. Lobbies are kept in creation order and listed newest first.
+    """
+
+    def __init__(self, page_size: int = LOBBY_PAGE_SIZE):
+        self.page_size = page_size
+        self._lobbies: dict[str, dict] = {}
+        self._loaded = False
+        self._load_lock = asyncio.Lock()
+
+    async def load(self):
+        """(Re)loads the directory from the database."""
+        async with self._load_lock:
+            lobbies = await get_active_lobbies_db()
+            self._lobbies = {lobby["lobby_id"]: lobby for lobby in lobbies}
+            self._loaded = True
+        app_logger.info("Lobby directory loaded with %s active lobbies.", len(self._lobbies))
+
+    async def _ensure_loaded(self):
+        if not self._loaded:
+            await self.load()
+
+    def add(self, lobby_id: str, master_uuid: str, lobby_name: str, master_username: str | None, status: str = "waiting"):
+        """Registers a newly created lobby."""
+        self._lobbies[lobby_id] = {
+            "lobby_id": lobby_id,
+            "master_uuid": master_uuid,
+            "lobby_name": lobby_name,
+            "status": status,
+            "master_username": master_username if master_username else "Unknown Master"
+        }
+
+    def set_status(self, lobby_id: str, status: str):
+        """Updates a lobby's status, dropping it once it is no longer joinable."""
+        if status not in JOINABLE_LOBBY_STATUSES:
+            self.remove(lobby_id)
+            return
+        lobby = self._lobbies.get(lobby_id)
+        if lobby is not None:
+            # Entries are shared with rendered pages, so replace instead of mutating
+            self._lobbies[lobby_id] = {**lobby, "status": status}
+
+    def remove(self, lobby_id: str):
+        """Drops a finished or deleted lobby."""
+        self._lobbies.pop(lobby_id, None)
+
+    async def page(self, page: int = 1, page_size: int | None = None):
+        """
+        Returns one page of active lobbies, newest first.
+        Args:
+            page (int): 1-based page number; out of range values are clamped.
+            page_size (int): Lobbies per page, defaults to LOBBY_PAGE_SIZE.
+        Returns:
+            tuple: (lobbies on the page, current page, total pages)
+        """
+        await self._ensure_loaded()
+        page_size = max(1, page_size or self.page_size)
+        total_pages = max(1, -(-len(self._lobbies) // page_size))
+        page = min(max(1, page), total_pages)
+        start = (page - 1) * page_size
+        lobbies = list(islice(reversed(self._lobbies.values()), start, start + page_size))
+        return lobbies, page, total_pages
+
+lobby_directory = LobbyDirectory()
@@ -0,0 +1,131 @@
+import atexit
+import logging
+import queue
+import sys
+import time
+from datetime import datetime, UTC
+from logging.handlers import QueueHandler, QueueListener
+
+from codec import dumps
+from config import LOG_LEVEL, LOG_LEVELS, LOG_FORMAT, LOG_QUEUE_SIZE, LOG_SAMPLE_PER_SECOND, TAGS
+
+# One logger per subsystem, matching the console tags in config.TAGS
+SUBSYSTEMS = ("server", "db", "websocket", "app")
+ROOT_LOGGER = "dnd"
+
+def get_logger(subsystem: str) -> logging.Logger:
+    """Returns the logger of a subsystem ('server', 'db', 'websocket' or 'app')."""
+    if subsystem not in SUBSYSTEMS:
+        raise ValueError(f"Unknown log subsystem: {subsystem}")
+    return logging.getLogger(f"{ROOT_LOGGER}.{subsystem}")
+
+class TaggedFormatter(logging.Formatter):
+    """Formats records like the original console output: the subsystem's colored tag, then the message."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        subsystem = record.name.rpartition(".")[2]
+        if subsystem == "app":
+            tag = TAGS["app_error"] if record.levelno >= logging.WARNING else TAGS["app_log"]
+        else:
+            tag = TAGS.get(subsystem, TAGS["app_log"])
+        line = f"{tag} {record.getMessage()}"
+        if record.exc_info:
+            line = f"{line}\n{self.formatException(record.exc_info)}"
+        return line
+
+class JsonFormatter(logging.Formatter):
+    """Formats records as one JSON object per line for log collectors."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, UTC).isoformat(timespec="milliseconds"),
+            "level": record.levelname.lower(),
+            "subsystem": record.name.rpartition(".")[2],
+            "message": record.getMessage(),
+        }
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return dumps(entry)
+
+class SamplingFilter(logging.Filter):
+    """
+    Rate limits high-volume records. Records logged with extra={"sample_key": key}
+    pass at most `per_second` times per second per key; the rest are dropped and
+    counted, and the next record that passes reports how many were suppressed.
+    Records without a sample_key are never limited.
+    """
+
+    def __init__(self, per_second: float = LOG_SAMPLE_PER_SECOND):
+        super().__init__()
+        self.per_second = per_second
+        self._buckets: dict[str, list] = {}  # key -> [tokens, last refill, suppressed]
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        key = getattr(record, "sample_key", None)
+        if key is None:
+            return True
+        if self.per_second <= 0:
+            return False
+        now = time.monotonic()
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = [self.per_second, now, 0]
+        bucket[0] = min(self.per_second, bucket[0] + (now - bucket[1]) * self.per_second)
+        bucket[1] = now
+        if bucket[0] < 1:
+            bucket[2] += 1
+            return False
+        bucket[0] -= 1
+        if bucket[2]:
+            record.msg = f"{record.getMessage()} (+{bucket[2]} similar suppressed)"
+            record.args = None
+            bucket[2] = 0
+        return True
+
+class DroppingQueueHandler(QueueHandler):
+    """Queue handler that never blocks the event loop: when the queue is full the record is dropped."""
+
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+_listener: QueueListener | None = None
+
+def setup_logging():
+    """
+    Configures the subsystem loggers once per process from the LOG_* settings.
+    Records are handed to a bounded queue and written to stdout by a background
+    thread, so logging never waits on the terminal or the container log driver.
+    """
+    global _listener
+    if _listener is not None:
+        return
+    stream_handler = logging.StreamHandler(sys.stdout)
+    stream_handler.setFormatter(JsonFormatter() if LOG_FORMAT == "json" else TaggedFormatter())
+
+    queue_handler = DroppingQueueHandler(queue.Queue(LOG_QUEUE_SIZE))
+    queue_handler.addFilter(SamplingFilter())
+
+    root = logging.getLogger(ROOT_LOGGER)
+    root.handlers[:] = [queue_handler]
+    root.setLevel(LOG_LEVEL)
+    root.propagate = False
+    for subsystem in SUBSYSTEMS:
+        get_logger(subsystem).setLevel(LOG_LEVELS.get(subsystem) or LOG_LEVEL)
+
+    _listener = QueueListener(queue_handler.queue, stream_handler)
+    _listener.start()
+    atexit.register(shutdown_logging)
+
+def shutdown_logging():
+    """Writes out the queued records and stops the logging thread."""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
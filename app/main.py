@@ -5,19 +5,23 @@ from contextlib import asynccontextmanager
 
 import uvicorn
 from fastapi import FastAPI, WebSocket, Request # Import Request
-from fastapi.staticfiles import StaticFiles
-from fastapi.templating import Jinja2Templates # Import Jinja2Templates
 from starlette.exceptions import HTTPException as StarletteHTTPException # Import StarletteHTTPException
 
-from config import TAGS
-from database import init_db
-from websockets_manager import broadcast_active_players, handle_websocket_connection
-from routes import router as http_router # Import the APIRouter instance
+from database import init_db, open_db_pool, close_db_pool
+from backplane import backplane
+from lobby_directory import lobby_directory
+from metrics import monitor_event_loop_lag
+from passwords import password_hasher
+from player_cache import player_cache
+from static_assets import static_assets
+from websockets_manager import broadcast_active_players, handle_websocket_connection, run_presence, leave_backplane
+from routes import router as http_router, templates, compile_templates # Import the APIRouter instance and its templates
+from logs import get_logger, setup_logging
 
-print(">>>servidor corriendo<<<<")
+setup_logging()
+server_logger = get_logger("server")
 
-# Initialize Jinja2Templates here as it's used by the exception handler
-templates = Jinja2Templates(directory="templates")
+server_logger.info(">>>servidor corriendo<<<<")
 
 ## FastAPI Application Setup
 
@@ -25,21 +29,42 @@ templates = Jinja2Templates(directory="templates")
 async def lifespan(app: FastAPI):
     """
     Context manager for application startup and shutdown events.
-    Initializes the database and starts the active players broadcast task.
+    Loads the static assets, compiles the templates, opens the database
+    connection pool, initializes the database, joins the worker backplane,
+    loads the active lobby directory and starts the active players broadcast,
+    player state flush, presence and event-loop lag tasks.
     """
-    print(f"{TAGS['server']} Application startup event: Initializing database...")
+    static_assets.load()
+    compile_templates()
+    server_logger.info("Application startup event: Initializing database...")
+    await open_db_pool()
     await init_db()
+    await backplane.start()
+    await lobby_directory.load()
     # Start the background task for broadcasting active players
-    asyncio.create_task(broadcast_active_players())
+    background_tasks = [
+        asyncio.create_task(broadcast_active_players()),
+        asyncio.create_task(player_cache.run_flusher()),
+        asyncio.create_task(run_presence()),
+        asyncio.create_task(monitor_event_loop_lag()),
+    ]
     yield
     # Code here runs on application shutdown (e.g., closing database connections)
-    print(f"{TAGS['server']} Application shutdown event: Performing cleanup...")
+    server_logger.info("Application shutdown event: Performing cleanup...")
+    await leave_backplane()
+    for task in background_tasks:
+        task.cancel()
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+    await backplane.stop()
+    await player_cache.flush() # Persist any character changes still held in memory
+    await close_db_pool()
+    password_hasher.shutdown()
 
 # Initialize FastAPI app with the new lifespan handler
 app = FastAPI(lifespan=lifespan)
 
-# Mount static files
-app.mount("/static", StaticFiles(directory="static"), name="static")
+# Mount static files (fingerprinted, precompressed and served from memory)
+app.mount("/static", static_assets, name="static")
 
 # Include the HTTP router
 app.include_router(http_router)
@@ -0,0 +1,183 @@
+from typing import Literal, Optional, Union
+
+from codec import loads, unpackb
+
+# Schemas of the messages clients send over the WebSocket.
+# Every message type maps its fields to (type, required); a tuple of strings as
+# the type restricts the field to those values. Fields not listed are dropped,
+# and optional fields that are missing come back as None.
+#
+# Text frames carry JSON and binary frames MessagePack. With msgspec installed the
+# schemas are compiled into one tagged union of Structs and a message is decoded
+# and validated in a single pass. Otherwise it is decoded with the codec module
+# and checked by validators compiled from the same table.
+# To add a message type, add its schema here and register a handler for it in
+# websockets_manager with @message_handler(role, type).
+
+REQUIRED = True
+OPTIONAL = False
+
+MESSAGE_SCHEMAS: dict[str, dict[str, tuple]] = {
+    "connect": {"token": (str, REQUIRED), "role": (("master", "player"), REQUIRED),
+                "player_id": (str, OPTIONAL), "lobby_id": (str, OPTIONAL),
+                "encoding": (str, OPTIONAL)},  # Requested wire format; unknown ones fall back to JSON
+    # Player messages
+    "player_update": {"player_id": (str, REQUIRED), "state": (dict, REQUIRED)},
+    "player_patch": {"player_id": (str, REQUIRED), "version": (int, REQUIRED), "ops": (list, REQUIRED)},
+    "player_ready": {"lobby_id": (str, OPTIONAL)},
+    "player_unready": {"lobby_id": (str, OPTIONAL)},
+    # Master messages
+    "create_lobby": {"lobby_name": (str, OPTIONAL)},
+    "start_game": {"lobby_id": (str, OPTIONAL)},
+    "end_game": {"lobby_id": (str, OPTIONAL)},
+    "delete_lobby": {"lobby_id": (str, OPTIONAL)},
+}
+
+# Fields every character state must carry, as created by /create-character.
+# Extra keys are allowed and kept as they are.
+CHARACTER_STATE_SCHEMA: dict[str, type] = {
+    "player_id": str, "nombre": str, "clase": str,
+    "nivel": int, "fuerza": int, "ingenio": int, "corazon": int,
+    "vida": int, "mana": int, "dinero": int, "defensa": int,
+    "arma_equipada": str, "armadura_equipada": str,
+    "inventario": list[str], "habilidades": list[str], "canciones_aprendidas": list[str],
+}
+
+_TYPE_NAMES = {str: "texto", int: "entero", list: "lista", dict: "objeto"}
+
+class MessageError(ValueError):
+    """Raised when a WebSocket message or a character state does not match its schema."""
+
+def _compile_check(field: str, expected):
+    """Returns a function raising MessageError unless a value matches the expected type."""
+    if isinstance(expected, tuple):
+        def check(value):
+            if value not in expected:
+                raise MessageError(f"El campo '{field}' debe ser uno de: {', '.join(expected)}.")
+        return check
+    if expected == list[str]:
+        def check(value):
+            if not isinstance(value, list) or not all(isinstance(item, str) for item in value):
+                raise MessageError(f"El campo '{field}' debe ser una lista de textos.")
+        return check
+    message = f"El campo '{field}' debe ser de tipo {_TYPE_NAMES[expected]}."
+    if expected is int:
+        def check(value):
+            # bool is a subclass of int but never a valid number here
+            if type(value) is not int:
+                raise MessageError(message)
+        return check
+    def check(value):
+        if not isinstance(value, expected):
+            raise MessageError(message)
+    return check
+
+def _compile_message_validator(message_type: str, schema: dict):
+    """Builds the validator of one message type: it returns a new dict with only the schema's fields."""
+    checks = [(field, required, _compile_check(field, expected)) for field, (expected, required) in schema.items()]
+
+    def validate(data: dict) -> dict:
+        message = {"type": message_type}
+        for field, required, check in checks:
+            value = data.get(field)
+            if value is None:
+                if required:
+                    raise MessageError(f"Falta el campo '{field}'.")
+            else:
+                check(value)
+            message[field] = value
+        return message
+    return validate
+
+_validators = {message_type: _compile_message_validator(message_type, schema) for message_type, schema in MESSAGE_SCHEMAS.items()}
+_state_checks = {field: _compile_check(field, expected) for field, expected in CHARACTER_STATE_SCHEMA.items()}
+
+def _decode_with_validators(frame: str | bytes) -> dict:
+    if isinstance(frame, bytes) and unpackb is None:
+        raise MessageError("Mensaje inválido: este servidor no admite MessagePack.")
+    try:
+        data = unpackb(frame) if isinstance(frame, bytes) else loads(frame)
+    except (ValueError, TypeError):
+        raise MessageError("Mensaje inválido: no se pudo decodificar.")
+    if not isinstance(data, dict):
+        raise MessageError("Mensaje inválido: se esperaba un objeto.")
+    validate = _validators.get(data.get("type"))
+    if validate is None:
+        raise MessageError(f"Tipo de mensaje desconocido: {data.get('type')}")
+    try:
+        return validate(data)
+    except MessageError as e:
+        raise MessageError(f"Mensaje inválido: {e}")
+
+try:
+    import msgspec
+
+    def _struct_field(field: str, expected, required: bool):
+        annotation = Literal[expected] if isinstance(expected, tuple) else expected
+        if required:
+            return (field, annotation)
+        return (field, Optional[annotation], None)
+
+    _structs = {
+        message_type: msgspec.defstruct(
+            f"{message_type}_message",
+            [_struct_field(field, expected, required) for field, (expected, required) in schema.items()],
+            tag=message_type,
+            tag_field="type",
+        )
+        for message_type, schema in MESSAGE_SCHEMAS.items()
+    }
+    _struct_types = {struct: message_type for message_type, struct in _structs.items()}
+    _json_decoder = msgspec.json.Decoder(Union[tuple(_structs.values())])
+    _msgpack_decoder = msgspec.msgpack.Decoder(Union[tuple(_structs.values())])
+
+    def decode_message(frame: str | bytes) -> dict:
+        """
+        Decodes and validates a client message in one pass.
+        Args:
+            frame (str | bytes): A JSON text frame or a MessagePack binary frame.
+        Returns:
+            dict: The message's type and schema fields.
+        Raises:
+            MessageError: If the frame cannot be decoded or does not match its schema.
+        """
+        try:
+            decoded = (_msgpack_decoder if isinstance(frame, bytes) else _json_decoder).decode(frame)
+        except msgspec.ValidationError as e:
+            raise MessageError(f"Mensaje inválido: {e}")
+        except msgspec.DecodeError:
+            raise MessageError("Mensaje inválido: no se pudo decodificar.")
+        message = msgspec.structs.asdict(decoded)
+        message["type"] = _struct_types[type(decoded)]
+        return message
+except ImportError:
+    def decode_message(frame: str | bytes) -> dict:
+        """
+        Decodes and validates a client message.
+        Args:
+            frame (str | bytes): A JSON text frame or a MessagePack binary frame.
+        Returns:
+            dict: The message's type and schema fields.
+        Raises:
+            MessageError: If the frame cannot be decoded or does not match its schema.
+        """
+        return _decode_with_validators(frame)
+
+def validate_state(state, fields=None):
+    """
+    Checks a character state against CHARACTER_STATE_SCHEMA.
+    Args:
+        state: The state to check.
+        fields: If given, only these keys are checked (e.g. the paths touched by a patch).
+    Raises:
+        MessageError: If the state is not an object, or a checked field is missing or has the wrong type.
+    """
+    if not isinstance(state, dict):
+        raise MessageError("El estado del personaje debe ser un objeto.")
+    for field in CHARACTER_STATE_SCHEMA if fields is None else fields:
+        check = _state_checks.get(field)
+        if check is None:
+            continue
+        if field not in state:
+            raise MessageError(f"Falta el campo '{field}' en el estado del personaje.")
+        check(state[field])
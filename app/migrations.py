@@ -0,0 +1,153 @@
+import time
+from logs import get_logger
+
+db_logger = get_logger("db")
+
+
+# Core character stats exposed as columns of the players table: name -> SQL type.
+# Their values are generated by SQLite from the state JSON, so they never drift from it.
+# Adding a stat later needs a new migration calling _add_character_stat_columns again.
+CHARACTER_STAT_COLUMNS = {
+    "nivel": "INTEGER", "vida": "INTEGER", "mana": "INTEGER", "dinero": "INTEGER",
+    "defensa": "INTEGER", "fuerza": "INTEGER", "ingenio": "INTEGER", "corazon": "INTEGER",
+    "clase": "TEXT",
+}
+
+async def _add_missing_columns(db, table: str, columns: dict[str, str]):
+    """Adds each column (name -> definition) that the table does not have yet."""
+    async with db.execute(f"PRAGMA table_xinfo({table})") as cursor:
+        existing = {row[1] for row in await cursor.fetchall()}
+    for column, definition in columns.items():
+        if column not in existing:
+            await db.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+
+async def _add_character_stat_columns(db):
+    """Adds a virtual generated column per core stat, skipping those that already exist."""
+    await _add_missing_columns(db, "players", {
+        column: f"{column_type} GENERATED ALWAYS AS (json_extract(state, '$.{column}')) VIRTUAL"
+        for column, column_type in CHARACTER_STAT_COLUMNS.items()
+    })
+
+# Ordered schema migrations tracked through SQLite's PRAGMA user_version.
+# Each entry is (version, description, statements). Statements must be idempotent
+# so databases created before versioning existed can be brought up to date safely;
+# a step SQL cannot express idempotently is given as a coroutine function taking the connection.
+# Never edit a released migration; append a new one with the next version number.
+MIGRATIONS = [
+    (1, "Base tables", [
+        """
+        CREATE TABLE IF NOT EXISTS players (
+            player_id TEXT PRIMARY KEY,
+            owner_uuid TEXT,
+            state TEXT
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS users (
+            uuid TEXT PRIMARY KEY,
+            username TEXT UNIQUE,
+            password TEXT
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS lobbies (
+            lobby_id TEXT PRIMARY KEY,
+            master_uuid TEXT NOT NULL,
+            lobby_name TEXT NOT NULL DEFAULT 'Partida Sin Nombre',
+            status TEXT DEFAULT 'waiting', -- 'waiting', 'in_progress', 'finished'
+            players_in_lobby TEXT DEFAULT '[]', -- Legacy JSON array of player_ids, superseded by lobby_players
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        """,
+    ]),
+    (2, "Normalized lobby membership", [
+        """
+        CREATE TABLE IF NOT EXISTS lobby_players (
+            lobby_id TEXT NOT NULL,
+            player_id TEXT NOT NULL,
+            joined_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (lobby_id, player_id)
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_lobby_players_player_id ON lobby_players (player_id)",
+        # Move memberships still stored in the legacy JSON column, then empty it.
+        """
+        INSERT OR IGNORE INTO lobby_players (lobby_id, player_id)
+        SELECT lobbies.lobby_id, members.value
+        FROM lobbies, json_each(lobbies.players_in_lobby) AS members
+        WHERE lobbies.players_in_lobby NOT IN ('', '[]')
+        ORDER BY lobbies.lobby_id, members.key
+        """,
+        "UPDATE lobbies SET players_in_lobby = '[]' WHERE players_in_lobby NOT IN ('', '[]')",
+    ]),
+    (3, "Hot-path indexes", [
+        "CREATE INDEX IF NOT EXISTS idx_players_owner_uuid ON players (owner_uuid)",
+        "CREATE INDEX IF NOT EXISTS idx_lobbies_master_uuid_created_at ON lobbies (master_uuid, created_at DESC)",
+        "CREATE INDEX IF NOT EXISTS idx_lobbies_status ON lobbies (status)",
+    ]),
+    (4, "Indexed character stat columns", [
+        _add_character_stat_columns,
+        *(f"CREATE INDEX IF NOT EXISTS idx_players_{column} ON players ({column})" for column in CHARACTER_STAT_COLUMNS),
+    ]),
+    (5, "Character event log", [
+        # Append-only history of state changes. players.state becomes a snapshot that
+        # already includes every event up to players.snapshot_event_id.
+        """
+        CREATE TABLE IF NOT EXISTS character_events (
+            event_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            player_id TEXT NOT NULL,
+            lobby_id TEXT, -- Lobby the character was playing in, if any
+            kind TEXT NOT NULL, -- 'snapshot' (session start), 'replace' (player_update) or 'patch' (player_patch)
+            payload TEXT NOT NULL, -- Full state JSON, or the patch operations
+            created_at REAL NOT NULL -- Unix time of the change
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_character_events_player_id ON character_events (player_id, event_id)",
+        "CREATE INDEX IF NOT EXISTS idx_character_events_lobby_id ON character_events (lobby_id, event_id)",
+        lambda db: _add_missing_columns(db, "players", {"snapshot_event_id": "INTEGER NOT NULL DEFAULT 0"}),
+    ]),
+]
+
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+async def get_schema_version(db) -> int:
+    """Returns the schema version stored in the database file."""
+    async with db.execute("PRAGMA user_version") as cursor:
+        row = await cursor.fetchone()
+        return row[0] if row else 0
+
+async def run_migrations(db):
+    """
+    Applies every migration newer than the database's user_version, in order.
+    Each migration runs in its own transaction together with the version bump,
+    so an interrupted deploy resumes from the last completed step.
+    Returns a list of (version, description, seconds) for the migrations applied.
+    """
+    current_version = await get_schema_version(db)
+    applied = []
+    for version, description, statements in MIGRATIONS:
+        if version <= current_version:
+            continue
+        started = time.perf_counter()
+        await db.execute("BEGIN IMMEDIATE")
+        try:
+            if await get_schema_version(db) >= version:
+                # Another worker applied it while we waited for the write lock
+                await db.rollback()
+                continue
+            for statement in statements:
+                if callable(statement):
+                    await statement(db)
+                else:
+                    await db.execute(statement)
+            await db.execute(f"PRAGMA user_version = {version}")
+            await db.commit()
+        except BaseException:
+            await db.rollback()
+            raise
+        elapsed = time.perf_counter() - started
+        applied.append((version, description, elapsed))
+        db_logger.info("Migration %s (%s) applied in %.1f ms.", version, description, elapsed * 1000)
+    if not applied:
+        db_logger.info("Schema up to date at version %s.", current_version)
+    return applied
@@ -0,0 +1,176 @@
+import asyncio
+from collections import deque
+from typing import Awaitable, Callable
+
+from fastapi import WebSocket
+
+from codec import Frame, encode
+from config import OUTBOX_MAX_MESSAGES
+from logs import get_logger
+
+ws_logger = get_logger("websocket")
+app_logger = get_logger("app")
+
+OUTBOX_POLICIES = ("drop_oldest", "coalesce", "disconnect")
+
+# Server-wide slow-consumer counters
+outbox_metrics = {
+    "dropped": 0,       # Messages discarded by drop_oldest or replaced by a coalesced snapshot
+    "coalesced": 0,     # Times a queue was collapsed into a single snapshot
+    "disconnected": 0,  # Connections closed because their queue was full
+    "send_errors": 0,   # Sends that failed on the socket itself
+}
+
+# Placeholder queued by the coalesce policy; replaced by a fresh snapshot when sent
+_SNAPSHOT = object()
+
+class Outbox:
+    """
+    Bounded outbound queue drained by a dedicated writer task, one per connection.
+    send() never blocks, so broadcasting to a slow or half-dead socket cannot stall
+    the sender. When the queue is full the configured policy applies:
+      - drop_oldest: discard the oldest queued message.
+      - coalesce: discard queued state updates and send one fresh snapshot instead.
+      - disconnect: close the connection.
+    """
+
+    __slots__ = ("ws", "label", "encoding", "maxsize", "policy", "snapshot", "dropped", "closed", "_items", "_wakeup", "_task", "_closer")
+
+    def __init__(
+        self,
+        ws: WebSocket,
+        label: str,
+        policy: str,
+        snapshot: Callable[[], Awaitable[dict]] | None = None,
+        maxsize: int = OUTBOX_MAX_MESSAGES,
+        encoding: str = "json",
+    ):
+        if policy not in OUTBOX_POLICIES:
+            raise ValueError(f"Unknown outbox policy: {policy}")
+        self.ws = ws
+        self.label = label
+        self.encoding = encoding # Wire format negotiated in the connect message
+        self.maxsize = max(1, maxsize)
+        self.policy = policy
+        self.snapshot = snapshot # Builds the latest full state message for the coalesce policy
+        self.dropped = 0
+        self.closed = False
+        self._items: deque = deque()
+        self._wakeup = asyncio.Event()
+        self._task: asyncio.Task | None = None
+        self._closer: asyncio.Task | None = None
+
+    @property
+    def depth(self) -> int:
+        return len(self._items)
+
+    def start(self):
+        """Starts the writer task."""
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Stops the writer task, discarding anything still queued."""
+        self.closed = True
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        self._items.clear()
+
+    def send(self, message: dict | Frame, state_update: bool = False) -> bool:
+        """
+        Queues a message without waiting for the socket.
+        Args:
+            message (dict | Frame): The message to send, or a shared broadcast frame.
+            state_update (bool): True for player state messages that a newer
+                snapshot makes obsolete, which the coalesce policy may discard.
+        Returns:
+            bool: False if the message was not queued.
+        """
+        if self.closed:
+            return False
+        if len(self._items) >= self.maxsize:
+            if self.policy == "drop_oldest":
+                self._items.popleft()
+                self._count_dropped(1)
+            elif self.policy == "coalesce":
+                if not self._coalesce():
+                    self._disconnect()
+                    return False
+                if state_update and self.snapshot is not None:
+                    # The queued snapshot will already include this update
+                    self._count_dropped(1)
+                    return True
+                if len(self._items) >= self.maxsize:
+                    self._disconnect()
+                    return False
+            else:
+                self._disconnect()
+                return False
+        self._items.append((message, state_update))
+        self._wakeup.set()
+        return True
+
+    def send_snapshot(self) -> bool:
+        """Queues a full snapshot that is built only when the writer reaches it."""
+        if self.snapshot is None:
+            raise ValueError("This outbox has no snapshot provider.")
+        return self.send(_SNAPSHOT, state_update=True)
+
+    def _coalesce(self) -> bool:
+        """Replaces queued state updates with one snapshot. Returns False if nothing could be freed."""
+        kept = deque(item for item in self._items if not item[1])
+        discarded = len(self._items) - len(kept)
+        if discarded == 0:
+            return False
+        self._items = kept
+        self._count_dropped(discarded)
+        outbox_metrics["coalesced"] += 1
+        if self.snapshot is not None:
+            self._items.append((_SNAPSHOT, True))
+        return True
+
+    def _count_dropped(self, count: int):
+        self.dropped += count
+        outbox_metrics["dropped"] += count
+
+    def _disconnect(self):
+        """Closes a connection whose consumer cannot keep up."""
+        if self.closed:
+            return
+        self.closed = True
+        self._items.clear()
+        outbox_metrics["disconnected"] += 1
+        ws_logger.warning("Closing slow connection %s: outbound queue full.", self.label)
+        self._closer = asyncio.create_task(self._close_socket(1013))
+
+    async def _close_socket(self, code: int):
+        try:
+            await self.ws.close(code=code)
+        except Exception:
+            pass # Already closed
+
+    async def _run(self):
+        """Writer task: sends queued messages in order."""
+        while True:
+            if not self._items:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            message, _ = self._items.popleft()
+            try:
+                if message is _SNAPSHOT:
+                    message = await self.snapshot()
+                data = encode(message, self.encoding)
+                if isinstance(data, bytes):
+                    await self.ws.send_bytes(data)
+                else:
+                    await self.ws.send_text(data)
+            except Exception as e:
+                outbox_metrics["send_errors"] += 1
+                app_logger.error("Error sending to %s: %s", self.label, e)
+                self.closed = True
+                self._items.clear()
+                await self._close_socket(1011)
+                return
@@ -0,0 +1,124 @@
+import hashlib
+import uuid
+
+from markupsafe import Markup
+
+from backplane import backplane, PAGES_CHANNEL
+from config import PAGE_FRAGMENT_CACHE_SIZE
+from lru import LRUCache
+from metrics import Gauge
+
+# Change counters behind the ETags of the HTML pages and the cached fragments.
+# A scope names something a page is rendered from:
+#   ("character", player_id)  a character's state
+#   ("lobby", lobby_id)       a lobby's status, members and the states of its characters
+#   ("user", user_uuid)       the list of a user's characters
+#   ("lobbies",)              the lobby lifecycle (directory on /player, lobby list on /master)
+# Whatever changes one of these bumps it; a page or fragment built from the same
+# scope versions is still current. Routes read now() before loading the data a
+# page is built from, and anything bumped after that is not cached nor tagged,
+# since the data may predate the change.
+
+class PageCache:
+    """
+    Per-worker version counters plus a bounded cache of rendered HTML fragments.
+    Versions come from one process-wide clock, so a bumped scope never returns
+    to a value some earlier page was built with, and every ETag carries a
+    random epoch so they do not survive a restart.
+    """
+
+    def __init__(self, fragment_cache_size: int = PAGE_FRAGMENT_CACHE_SIZE):
+        self.epoch = uuid.uuid4().hex
+        self._clock = 0
+        self._versions: dict[tuple, int] = {}
+        self._fragments = LRUCache(fragment_cache_size)  # (template, key) -> (scope versions, html)
+        self._user_characters = LRUCache(fragment_cache_size)  # user_uuid -> (user version, player_ids)
+        self.fragment_hits = 0
+        self.fragment_misses = 0
+
+    def now(self) -> int:
+        """Returns the current clock reading: every later bump gets a higher version."""
+        return self._clock
+
+    def versions(self, scopes) -> tuple:
+        """Returns the current version of each scope (0 if it never changed)."""
+        return tuple(self._versions.get(scope, 0) for scope in scopes)
+
+    def bump(self, *scopes):
+        """Marks scopes as changed on this worker."""
+        for scope in scopes:
+            self._clock += 1
+            self._versions[scope] = self._clock
+
+    def changed_since(self, scopes, since: int) -> bool:
+        """True if any of the scopes was bumped after the clock read since."""
+        return any(version > since for version in self.versions(scopes))
+
+    async def invalidate(self, *scopes):
+        """Marks scopes as changed on every worker."""
+        if scopes:
+            await backplane.publish(PAGES_CHANNEL, {"type": "invalidate", "scopes": [list(scope) for scope in scopes]})
+
+    def etag(self, scopes, *values, since: int | None = None) -> str | None:
+        """
+        Builds a strong ETag for a page.
+        Args:
+            scopes: The scopes the page is rendered from.
+            *values: Everything else the page depends on (page name, token, query parameters...).
+            since (int | None): Clock read before loading the page's data.
+        Returns:
+            str | None: The quoted ETag, or None if a scope changed after since.
+        """
+        if since is not None and self.changed_since(scopes, since):
+            return None
+        digest = hashlib.blake2b(self.epoch.encode(), digest_size=16)
+        for value in (*values, *self.versions(scopes)):
+            digest.update(repr(value).encode())
+            digest.update(b"\0")
+        return f'"{digest.hexdigest()}"'
+
+    def fragment(self, template_name: str, key, scopes, since: int, render) -> Markup:
+        """
+        Returns a rendered fragment, calling render() only if one of its scopes changed since it was cached.
+        Args:
+            template_name (str): The fragment's template, part of the cache key.
+            key: What distinguishes instances of the fragment (e.g. a player_id or a page number).
+            scopes: The scopes the fragment is rendered from.
+            since (int): Clock read before loading the data render() uses.
+            render: Callable returning the fragment's HTML.
+        """
+        stamp = self.versions(scopes)
+        cached = self._fragments.get((template_name, key))
+        if cached is not None and cached[0] == stamp:
+            self.fragment_hits += 1
+            return cached[1]
+        self.fragment_misses += 1
+        html = Markup(render())
+        if max(stamp, default=0) <= since:
+            self._fragments.put((template_name, key), (stamp, html))
+        return html
+
+    def user_characters(self, user_uuid: str) -> tuple | None:
+        """Returns the player_ids of a user's characters, or None if unknown or changed since remembered."""
+        cached = self._user_characters.get(user_uuid)
+        if cached is None or cached[0] != self.versions([("user", user_uuid)]):
+            return None
+        return cached[1]
+
+    def remember_user_characters(self, user_uuid: str, player_ids, since: int):
+        """Stores the player_ids of a user's characters as read from the database after the clock read since."""
+        stamp = self.versions([("user", user_uuid)])
+        if stamp[0] <= since:
+            self._user_characters.put(user_uuid, (stamp, tuple(player_ids)))
+
+page_cache = PageCache()
+
+async def on_pages_message(message: dict, origin: str):
+    """Backplane subscriber for the pages channel."""
+    if message.get("type") == "invalidate":
+        page_cache.bump(*(tuple(scope) for scope in message["scopes"]))
+
+backplane.subscribe(PAGES_CHANNEL, on_pages_message)
+
+Gauge("dnd_page_fragment_cache_lookups_total", "Rendered fragment cache lookups by result.",
+      lambda: {("hit",): page_cache.fragment_hits, ("miss",): page_cache.fragment_misses}, ("result",), metric_type="counter")
@@ -0,0 +1,69 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+from passlib.context import CryptContext
+
+from config import BCRYPT_ROUNDS, PASSWORD_HASH_WORKERS, PASSWORD_HASH_MAX_PENDING
+from logs import get_logger
+from metrics import Gauge
+
+app_logger = get_logger("app")
+
+# Configure the password hashing context. Existing hashes keep verifying after
+# BCRYPT_ROUNDS changes because the cost is stored inside every hash.
+pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto", bcrypt__rounds=BCRYPT_ROUNDS)
+
+class PasswordHasherBusy(Exception):
+    """Raised when too many password operations are already waiting for a worker."""
+
+class PasswordHasher:
+    """
+    Runs bcrypt hashing and verification on a small thread pool so a login burst
+    never blocks the event loop (bcrypt releases the GIL while it works).
+    At most `workers` operations run at once; up to `max_pending` more wait in
+    the pool's queue and anything beyond that is rejected with PasswordHasherBusy.
+    """
+
+    def __init__(self, workers: int = PASSWORD_HASH_WORKERS, max_pending: int = PASSWORD_HASH_MAX_PENDING):
+        self.workers = workers
+        self.max_pending = max_pending
+        self._executor: ThreadPoolExecutor | None = None
+        self._in_flight = 0
+
+    @property
+    def in_flight(self) -> int:
+        """Operations running or queued right now."""
+        return self._in_flight
+
+    def _get_executor(self) -> ThreadPoolExecutor:
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="bcrypt")
+        return self._executor
+
+    async def _run(self, func, *args):
+        if self._in_flight >= self.workers + self.max_pending:
+            app_logger.warning("Password hasher saturated (%s operations pending).", self._in_flight)
+            raise PasswordHasherBusy()
+        self._in_flight += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self._get_executor(), func, *args)
+        finally:
+            self._in_flight -= 1
+
+    async def hash(self, password: str) -> str:
+        """Hashes a password off the event loop."""
+        return await self._run(pwd_context.hash, password)
+
+    async def verify(self, password: str, hashed_password: str) -> bool:
+        """Checks a password against its stored hash off the event loop."""
+        return await self._run(pwd_context.verify, password, hashed_password)
+
+    def shutdown(self):
+        """Stops the worker threads. Called once at application shutdown."""
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+password_hasher = PasswordHasher()
+
+Gauge("dnd_password_operations_in_flight", "bcrypt operations running or waiting for a worker.", lambda: password_hasher.in_flight)
@@ -0,0 +1,66 @@
+# Simple field-level patch format for character states.
+# A patch is a list of operations applied in order to the top-level keys of a state:
+#   {"op": "set",    "path": "vida",       "value": 12}      -> state["vida"] = 12
+#   {"op": "unset",  "path": "arma_equipada"}                -> del state["arma_equipada"]
+#   {"op": "append", "path": "inventario", "value": "Cuerda"} -> state["inventario"].append("Cuerda")
+#   {"op": "remove", "path": "inventario", "value": "Cuerda"} -> state["inventario"].remove("Cuerda")
+
+PATCH_OPS = ("set", "unset", "append", "remove")
+
+# Keys that identify the character and can never be changed by a patch
+PROTECTED_PATHS = ("player_id",)
+
+class PatchError(ValueError):
+    """Raised when a patch is malformed or cannot be applied to a state."""
+
+def apply_patch(state: dict, ops: list) -> dict:
+    """
+    Applies a list of patch operations to a character state.
+    The input state is left untouched; a new state is returned.
+    Args:
+        state (dict): The current character state.
+        ops (list): Patch operations, see the module comment for the format.
+    Returns:
+        dict: The patched state.
+    Raises:
+        PatchError: If any operation is invalid. No partial result is returned.
+    """
+    if not isinstance(ops, list) or not ops:
+        raise PatchError("El parche debe ser una lista de operaciones no vacía.")
+
+    new_state = dict(state)
+    copied_lists = set()
+    for op in ops:
+        if not isinstance(op, dict):
+            raise PatchError("Cada operación debe ser un objeto.")
+        kind = op.get("op")
+        path = op.get("path")
+        if kind not in PATCH_OPS:
+            raise PatchError(f"Operación desconocida: {kind}")
+        if not isinstance(path, str) or not path:
+            raise PatchError("Cada operación necesita un 'path'.")
+        if path in PROTECTED_PATHS:
+            raise PatchError(f"El campo '{path}' no se puede modificar.")
+
+        if kind == "set":
+            if "value" not in op:
+                raise PatchError("La operación 'set' necesita un 'value'.")
+            new_state[path] = op["value"]
+        elif kind == "unset":
+            new_state.pop(path, None)
+        else:
+            current = new_state.get(path, [] if kind == "append" else None)
+            if not isinstance(current, list):
+                raise PatchError(f"El campo '{path}' no es una lista.")
+            if path not in copied_lists:
+                # Copy on first write so the previous state's list is never mutated
+                current = list(current)
+                copied_lists.add(path)
+                new_state[path] = current
+            if kind == "append":
+                current.append(op.get("value"))
+            elif op.get("value") in current:
+                current.remove(op.get("value"))
+            else:
+                raise PatchError(f"El valor no existe en '{path}'.")
+    return new_state
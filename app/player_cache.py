@@ -0,0 +1,176 @@
+import asyncio
+import time
+
+from backplane import backplane
+from config import PLAYER_CACHE_FLUSH_SECONDS, PLAYER_SNAPSHOT_EVERY
+from database import load_player_state_by_id, load_player_states, append_character_events
+from logs import get_logger
+from page_cache import page_cache
+
+app_logger = get_logger("app")
+
+class PlayerStateCache:
+    """
+    Authoritative in-memory copy of live character states, keyed by player_id.
+    Updates only touch memory and queue a change event; flush() appends the
+    queued events to the character event log in batched transactions, and
+    rewrites a character's stored snapshot every PLAYER_SNAPSHOT_EVERY events.
+    Characters stay cached while at least one connection holds them and are
+    evicted (after a final flush) once their owner disconnects.
+    Every change bumps a per-character version number used to detect stale patches.
+    """
+
+    def __init__(self, flush_interval: float = PLAYER_CACHE_FLUSH_SECONDS, snapshot_every: int = PLAYER_SNAPSHOT_EVERY):
+        self.flush_interval = flush_interval
+        self.snapshot_every = max(1, snapshot_every)
+        self._states: dict[str, dict] = {}
+        self._pending: dict[str, list] = {} # player_id -> events not yet in the database (the dirty characters)
+        self._since_snapshot: dict[str, int] = {} # player_id -> events logged since its stored snapshot
+        self._versions: dict[str, int] = {}
+        self._holders: dict[str, int] = {}
+        self._flush_lock = asyncio.Lock()
+
+    def peek(self, player_id: str) -> dict | None:
+        """Returns the cached state without touching the database."""
+        return self._states.get(player_id)
+
+    async def get(self, player_id: str) -> dict | None:
+        """
+        Returns a character's state, loading it from the database on a miss.
+        Loaded states are only kept in memory while a connection holds the character.
+        """
+        state = self._states.get(player_id)
+        if state is not None:
+            return state
+        loaded = await load_player_state_by_id(player_id)
+        # Another coroutine may have stored a newer state while we were loading.
+        if player_id in self._states:
+            return self._states[player_id]
+        if loaded is not None and player_id in self._holders:
+            self._states[player_id] = loaded
+        return loaded
+
+    def version(self, player_id: str) -> int:
+        """Returns the current version of a character's state (0 until its first change)."""
+        return self._versions.get(player_id, 0)
+
+    async def get_many(self, player_ids) -> dict[str, dict]:
+        """
+        Returns the states of several characters, loading all misses in one query.
+        Characters that do not exist are left out of the result.
+        """
+        states = {}
+        missing = []
+        for player_id in player_ids:
+            state = self._states.get(player_id)
+            if state is not None:
+                states[player_id] = state
+            else:
+                missing.append(player_id)
+        if missing:
+            loaded = await load_player_states(missing)
+            for player_id, state in loaded.items():
+                # Prefer a state stored while we were loading
+                state = self._states.get(player_id, state)
+                if player_id in self._holders:
+                    self._states.setdefault(player_id, state)
+                states[player_id] = state
+        return states
+
+    def set(self, player_id: str, state: dict, ops: list | None = None, lobby_id: str | None = None) -> int:
+        """
+        Replaces a character's state in memory and queues the change for the event log.
+        Args:
+            player_id (str): The character.
+            state (dict): Its new state.
+            ops (list | None): The patch operations that produced it; None for a full replacement.
+            lobby_id (str | None): Lobby the character is playing in, used to replay the session.
+        Returns:
+            int: The new version of the character's state.
+        """
+        self._states[player_id] = state
+        kind, payload = ("replace", state) if ops is None else ("patch", ops)
+        self._pending.setdefault(player_id, []).append((player_id, lobby_id, kind, payload, time.time()))
+        self._versions[player_id] = self._versions.get(player_id, 0) + 1
+        page_cache.bump(("character", player_id))
+        if lobby_id:
+            page_cache.bump(("lobby", lobby_id))
+        return self._versions[player_id]
+
+    def record_snapshot(self, player_id: str, lobby_id: str):
+        """Logs a cached character's full state as the starting point of a lobby session."""
+        state = self._states.get(player_id)
+        if state is not None:
+            self._pending.setdefault(player_id, []).append((player_id, lobby_id, "snapshot", state, time.time()))
+
+    def acquire(self, player_id: str):
+        """Marks a character as held by a live connection so it is not evicted."""
+        self._holders[player_id] = self._holders.get(player_id, 0) + 1
+
+    async def release(self, player_id: str):
+        """
+        Drops a connection's hold on a character. When no connection holds it
+        anymore, its pending state is flushed and it is evicted from memory.
+        """
+        remaining = self._holders.get(player_id, 0) - 1
+        if remaining > 0:
+            self._holders[player_id] = remaining
+            return
+        self._holders.pop(player_id, None)
+        await self.flush([player_id], compact=True)
+        # The owner may have reconnected while the flush was running.
+        if player_id not in self._holders and player_id not in self._pending:
+            self._states.pop(player_id, None)
+            self._versions.pop(player_id, None)
+            self._since_snapshot.pop(player_id, None)
+
+    async def flush(self, player_ids=None, compact: bool = False):
+        """
+        Appends the queued change events to the database in one transaction.
+        Characters with PLAYER_SNAPSHOT_EVERY events since their last snapshot
+        (or all flushed characters, with compact=True) also get a fresh snapshot.
+        Args:
+            player_ids: Optional iterable restricting the flush to these characters.
+            compact (bool): Snapshot every flushed character, e.g. at the end of a session.
+        """
+        async with self._flush_lock:
+            if player_ids is None:
+                player_ids = [*self._pending, *self._since_snapshot] if compact else self._pending
+            # Compacting also covers characters whose events are already logged but not snapshotted
+            to_flush = [
+                player_id for player_id in dict.fromkeys(player_ids)
+                if player_id in self._pending or (compact and self._since_snapshot.get(player_id))
+            ]
+            if not to_flush:
+                return
+            pending = {player_id: self._pending.pop(player_id, []) for player_id in to_flush}
+            # Ordered by time so the log interleaves characters the way the session happened
+            events = sorted((event for player_events in pending.values() for event in player_events), key=lambda event: event[4])
+            counts = {player_id: self._since_snapshot.get(player_id, 0) + len(player_events) for player_id, player_events in pending.items()}
+            snapshots = {
+                player_id: self._states[player_id] for player_id, count in counts.items()
+                if player_id in self._states and (compact or count >= self.snapshot_every)
+            }
+            try:
+                await append_character_events(events, snapshots)
+            except Exception:
+                for player_id, player_events in pending.items():
+                    self._pending[player_id] = player_events + self._pending.get(player_id, [])
+                raise
+            for player_id, count in counts.items():
+                self._since_snapshot[player_id] = 0 if player_id in snapshots else count
+        if backplane.distributed:
+            # Other workers render these characters from the database, which only now holds the changes
+            scopes = {("character", event[0]) for event in events} | {("lobby", event[1]) for event in events if event[1]}
+            await page_cache.invalidate(*scopes)
+
+    async def run_flusher(self):
+        """Background task that periodically persists dirty states."""
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                app_logger.error("Error flushing player states: %s", e)
+
+player_cache = PlayerStateCache()
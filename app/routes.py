@@ -2,13 +2,13 @@
 
 import json
 import uuid
-import aiosqlite
-from fastapi import APIRouter, Form, Request, HTTPException, Cookie
-from fastapi.responses import RedirectResponse
+from fastapi import APIRouter, Form, Request, HTTPException, Cookie, Query
+from fastapi.responses import RedirectResponse, PlainTextResponse, JSONResponse, Response
 from fastapi.templating import Jinja2Templates
+from markupsafe import Markup
 
-from config import TAGS, ACCESS_TOKEN_EXPIRE_MINUTES
-from auth import pwd_context, create_access_token, verify_token, get_current_user, authenticate_user, get_user_info_for_logout, get_username_by_uuid # Import get_username_by_uuid
+from config import ACCESS_TOKEN_EXPIRE_MINUTES, METRICS_ENABLED, REPLAY_PAGE_SIZE, TEMPLATES_AUTO_RELOAD
+from auth import create_access_token, verify_token, revoke_token_everywhere, get_current_user, authenticate_user, get_user_info_for_logout, get_username_by_uuid # Import get_username_by_uuid
 from database import (
     get_user_by_username,
     create_new_user,
@@ -17,12 +17,60 @@ from database import (
     check_player_ownership,
     get_lobbies_by_master_uuid,
     get_lobby_db,
-    load_player_state_by_id,
-    get_username_for_player_id
+    get_usernames_for_player_ids,
+    get_lobby_stats_db,
+    find_characters_db,
+    get_lobby_events_db
 )
+from lobby_directory import lobby_directory
+import metrics
+from page_cache import page_cache
+from passwords import password_hasher, PasswordHasherBusy
+from player_cache import player_cache
+from static_assets import static_assets
+from websockets_manager import get_remote_player_state
+from logs import get_logger
+
+app_logger = get_logger("app")
 
 router = APIRouter()
 templates = Jinja2Templates(directory="templates")
+templates.env.auto_reload = TEMPLATES_AUTO_RELOAD
+templates.env.globals["static_url"] = static_assets.url  # {{ static_url('style.css') }} -> fingerprinted URL
+
+page_requests_total = metrics.Counter("dnd_page_requests_total", "HTML page requests by page and result ('not_modified' or 'rendered').", ("page", "result"))
+
+def compile_templates():
+    """Loads and compiles every template once, so no request pays for it. Called at startup."""
+    names = templates.env.list_templates()
+    for name in names:
+        templates.get_template(name)
+    app_logger.info("Compiled %s templates.", len(names))
+
+def _fragment(template_name: str, key, scopes, since: int, **context) -> Markup:
+    """Renders a partial template, reusing the cached HTML while its scopes are unchanged (see page_cache.py)."""
+    return page_cache.fragment(template_name, key, scopes, since, lambda: templates.get_template(template_name).render(context))
+
+def _not_modified(request: Request, page: str, etag: str) -> Response | None:
+    """Returns a 304 response if the browser's copy of the page still carries the current ETag."""
+    tags = {tag.strip().removeprefix("W/") for tag in request.headers.get("if-none-match", "").split(",")}
+    if etag not in tags:
+        return None
+    if METRICS_ENABLED:
+        page_requests_total.inc(page, "not_modified")
+    return Response(status_code=304, headers={"ETag": etag, "Cache-Control": "private, no-cache"})
+
+def _page_response(page: str, template_name: str, context: dict, etag: str | None):
+    """
+    Renders a page that browsers keep but must revalidate. Pages embed the
+    access token, so they are private to the browser.
+    """
+    headers = {"Cache-Control": "private, no-cache"}
+    if etag:
+        headers["ETag"] = etag
+    if METRICS_ENABLED:
+        page_requests_total.inc(page, "rendered")
+    return templates.TemplateResponse(template_name, context, headers=headers)
 
 ## General Routes
 
@@ -37,59 +85,81 @@ async def lobby_page(request: Request):
     user_uuid = get_current_user(request)
     return templates.TemplateResponse("lobby.html", {"request": request, "user_uuid": user_uuid})
 
+@router.get("/metrics")
+async def get_metrics():
+    """Exposes server metrics in the Prometheus text format."""
+    if not METRICS_ENABLED:
+        raise HTTPException(status_code=404)
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
 ## Player Routes
 
 @router.get("/player")
 async def get_player_page(
     request: Request,
     access_token: str = Cookie(None),
-    selected_player_id: str = Cookie(None, alias="selected_player_id_cookie")
+    selected_player_id: str = Cookie(None, alias="selected_player_id_cookie"),
+    lobby_page: int = 1
 ):
     """
-    Renders the player page, showing all characters owned by the authenticated user
-    and highlighting the selected one.
+    Renders the player page, showing all characters owned by the authenticated user,
+    highlighting the selected one and listing one page of active lobbies.
+    Answers 304 if none of the user's characters nor the lobby directory changed.
     Requires authentication.
     """
     user_uuid = verify_token(access_token)
     if not user_uuid:
         return RedirectResponse("/login")
 
+    player_ids = page_cache.user_characters(user_uuid)
+    if player_ids is not None:
+        etag = page_cache.etag(_player_page_scopes(user_uuid, player_ids), "player", access_token, selected_player_id, lobby_page)
+        not_modified = _not_modified(request, "player", etag)
+        if not_modified:
+            return not_modified
+
+    return await _render_player_page(request, access_token, user_uuid, selected_player_id, lobby_page)
+
+def _player_page_scopes(user_uuid: str, player_ids) -> list:
+    """Scopes the player page is rendered from (see page_cache.py)."""
+    return [("user", user_uuid), ("lobbies",), *(("character", player_id) for player_id in player_ids)]
+
+async def _render_player_page(request: Request, access_token: str, user_uuid: str, selected_player_id: str | None, lobby_page: int = 1, error: str | None = None):
+    """Loads and renders the player page; error pages are neither tagged nor counted."""
+    since = page_cache.now()
     # Get username for welcome message
     username = await get_username_by_uuid(user_uuid)
 
     user_characters = await get_characters_by_owner_uuid(user_uuid)
+    player_ids = [char["player_id"] for char in user_characters]
+    page_cache.remember_user_characters(user_uuid, player_ids, since)
     selected_character = None
+    for char in user_characters:
+        # Live characters may have changes the write-behind cache has not flushed yet
+        char["state"] = player_cache.peek(char["player_id"]) or char["state"]
+        if selected_player_id and char["player_id"] == selected_player_id:
+            selected_character = char
 
-    if selected_player_id:
-        for char in user_characters:
-            if char["player_id"] == selected_player_id:
-                selected_character = char
-                break
-    
-    # Get active lobbies for player to join
-    active_lobbies = []
-    async with aiosqlite.connect("data/sessions.db") as db:
-        cursor = await db.execute("SELECT lobby_id, master_uuid, lobby_name, status FROM lobbies WHERE status IN ('waiting', 'in_progress')")
-        lobbies_data = await cursor.fetchall()
-
-    for row in lobbies_data:
-        master_username = await get_username_by_uuid(row[1]) # Use get_username_by_uuid for master's name
-        active_lobbies.append({
-            "lobby_id": row[0],
-            "master_uuid": row[1],
-            "lobby_name": row[2],
-            "status": row[3],
-            "master_username": master_username if master_username else "Unknown Master"
-        })
+    # Get active lobbies for player to join (served from memory)
+    active_lobbies, current_page, lobby_pages = await lobby_directory.page(lobby_page)
 
-    return templates.TemplateResponse("player.html", {
+    context = {
         "request": request,
         "token": access_token,
         "username": username, # Pass username to template
         "characters": user_characters,
         "selected_character": selected_character,
-        "active_lobbies": active_lobbies
-    })
+        "lobby_list": _fragment("partials/lobby_list.html", current_page, [("lobbies",)], since,
+                                active_lobbies=active_lobbies, lobby_page=current_page, lobby_pages=lobby_pages),
+        "character_cards": {
+            char["player_id"]: _fragment("partials/character_card.html", char["player_id"], [("character", char["player_id"])], since, character=char)
+            for char in user_characters if char is not selected_character
+        }
+    }
+    if error:
+        return templates.TemplateResponse("player.html", {**context, "error": error})
+    etag = page_cache.etag(_player_page_scopes(user_uuid, player_ids), "player", access_token, selected_player_id, lobby_page, since=since)
+    return _page_response("player", "player.html", context, etag)
 
 @router.post("/select-character")
 async def select_character_post(
@@ -106,37 +176,11 @@ async def select_character_post(
         return RedirectResponse("/login")
 
     if not await check_player_ownership(player_id, user_uuid):
-        username = await get_username_by_uuid(user_uuid)
-        user_characters = await get_characters_by_owner_uuid(user_uuid)
-        active_lobbies = []
-        lobbies_data = []
-        async with aiosqlite.connect("data/sessions.db") as db:
-            cursor = await db.execute("SELECT lobby_id, master_uuid, lobby_name, status FROM lobbies WHERE status IN ('waiting', 'in_progress')")
-            lobbies_data = await cursor.fetchall()
-
-        for row in lobbies_data:
-            master_username = await get_username_by_uuid(row[1])
-            active_lobbies.append({
-                "lobby_id": row[0],
-                "master_uuid": row[1],
-                "lobby_name": row[2],
-                "status": row[3],
-                "master_username": master_username if master_username else "Unknown Master"
-            })
-
-        return templates.TemplateResponse("player.html", {
-            "request": request,
-            "error": "Personaje no encontrado o no pertenece a este usuario.",
-            "username": username,
-            "characters": user_characters,
-            "token": access_token,
-            "selected_character": None,
-            "active_lobbies": active_lobbies
-        })
+        return await _render_player_page(request, access_token, user_uuid, None, error="Personaje no encontrado o no pertenece a este usuario.")
 
     response = RedirectResponse(url="/player", status_code=303)
     response.set_cookie(key="selected_player_id_cookie", value=player_id, httponly=True, samesite="strict", max_age=ACCESS_TOKEN_EXPIRE_MINUTES * 60)
-    print(f"{TAGS['app_log']} User {user_uuid} selected player: {player_id}")
+    app_logger.info("User %s selected player: %s", user_uuid, player_id)
     return response
 
 ## Master Routes
@@ -145,19 +189,26 @@ async def select_character_post(
 async def get_master_page(request: Request, access_token: str = Cookie(None)):
     """
     Renders the master page, showing active lobbies and players ready to join.
+    Answers 304 if no lobby was created, started, ended or deleted since the browser's copy.
     """
     user_uuid = verify_token(access_token)
     if not user_uuid:
         return RedirectResponse("/login")
-    
+
+    scopes = [("lobbies",)]
+    not_modified = _not_modified(request, "master", page_cache.etag(scopes, "master", access_token))
+    if not_modified:
+        return not_modified
+
+    since = page_cache.now()
     master_lobbies = await get_lobbies_by_master_uuid(user_uuid)
 
-    return templates.TemplateResponse("master.html", {
+    return _page_response("master", "master.html", {
         "request": request,
         "token": access_token,
         "master_uuid": user_uuid,
         "master_lobbies": master_lobbies
-    })
+    }, page_cache.etag(scopes, "master", access_token, since=since))
 
 ## Game Routes
 
@@ -170,6 +221,7 @@ async def game_player_page(
 ):
     """
     Renders the in-game page for a player.
+    Answers 304 if neither the character nor the lobby changed since the browser's copy.
     """
     user_uuid = verify_token(access_token)
     if not user_uuid:
@@ -178,7 +230,14 @@ async def game_player_page(
     if not selected_player_id:
         return RedirectResponse("/player", status_code=303)
 
-    player_character_state = await load_player_state_by_id(selected_player_id)
+    scopes = [("character", selected_player_id), ("lobby", lobby_id)]
+    etag_values = ("game-player", access_token, selected_player_id, lobby_id)
+    not_modified = _not_modified(request, "game-player", page_cache.etag(scopes, *etag_values))
+    if not_modified:
+        return not_modified
+
+    since = page_cache.now()
+    player_character_state = await player_cache.get(selected_player_id)
     if not player_character_state or not await check_player_ownership(selected_player_id, user_uuid):
         return RedirectResponse("/player", status_code=303)
 
@@ -192,12 +251,12 @@ async def game_player_page(
             return RedirectResponse("/player", status_code=303)
 
 
-    return templates.TemplateResponse("game_player.html", {
+    return _page_response("game-player", "game_player.html", {
         "request": request,
         "token": access_token,
         "character": player_character_state,
         "lobby_id": lobby_id
-    })
+    }, page_cache.etag(scopes, *etag_values, since=since))
 
 @router.get("/game-master")
 async def game_master_page(
@@ -207,6 +266,7 @@ async def game_master_page(
 ):
     """
     Renders the in-game administration page for the master.
+    Answers 304 if neither the lobby nor any of its characters changed since the browser's copy.
     """
     user_uuid = verify_token(access_token)
     if not user_uuid:
@@ -215,14 +275,24 @@ async def game_master_page(
     if not lobby_id:
         return RedirectResponse("/master", status_code=303)
 
+    scopes = [("lobby", lobby_id)]
+    not_modified = _not_modified(request, "game-master", page_cache.etag(scopes, "game-master", access_token, lobby_id))
+    if not_modified:
+        return not_modified
+
+    since = page_cache.now()
     lobby_info = await get_lobby_db(lobby_id)
     if not lobby_info or lobby_info["master_uuid"] != user_uuid or lobby_info["status"] not in ["in_progress"]:
         return RedirectResponse("/master", status_code=303)
 
+    players_in_lobby = lobby_info["players_in_lobby"]
+    player_states = await player_cache.get_many(players_in_lobby)
+    usernames = await get_usernames_for_player_ids(players_in_lobby)
     players_in_lobby_details = []
-    for player_id in lobby_info["players_in_lobby"]:
-        player_state = await load_player_state_by_id(player_id)
-        username = await get_username_for_player_id(player_id)
+    for player_id in players_in_lobby:
+        # Players connected to another worker: their live state beats the last flushed one
+        player_state = player_cache.peek(player_id) or get_remote_player_state(player_id) or player_states.get(player_id)
+        username = usernames[player_id]
         if player_state:
             players_in_lobby_details.append({
                 "player_id": player_id,
@@ -230,13 +300,97 @@ async def game_master_page(
                 "state": player_state
             })
 
-    return templates.TemplateResponse("game_master.html", {
+    return _page_response("game-master", "game_master.html", {
         "request": request,
         "token": access_token,
         "lobby_id": lobby_id,
         "lobby_info": lobby_info,
-        "players_in_lobby_details": players_in_lobby_details
-    })
+        "players_in_lobby_details": players_in_lobby_details,
+        "player_cards": {
+            player["player_id"]: _fragment("partials/player_card.html", player["player_id"], [("character", player["player_id"])], since, player=player)
+            for player in players_in_lobby_details
+        }
+    }, page_cache.etag(scopes, "game-master", access_token, lobby_id, since=since))
+
+async def _get_master_lobby(access_token: str, lobby_id: str):
+    """
+    Returns the lobby if the token belongs to its master, or a JSON error response.
+    The lobby's pending character events are flushed first so the queries see their live state.
+    """
+    user_uuid = verify_token(access_token)
+    if not user_uuid:
+        return None, JSONResponse({"error": "No autenticado"}, status_code=401)
+    lobby_info = await get_lobby_db(lobby_id) if lobby_id else None
+    if not lobby_info or lobby_info["master_uuid"] != user_uuid:
+        return None, JSONResponse({"error": "Lobby no encontrado o no te pertenece."}, status_code=404)
+    await player_cache.flush(lobby_info["players_in_lobby"])
+    return lobby_info, None
+
+@router.get("/game-master/stats")
+async def game_master_stats(access_token: str = Cookie(None), lobby_id: str = ""):
+    """
+    Dashboard aggregates for a lobby: average, minimum, maximum and total of each
+    core stat, plus the number of characters per class. Computed in SQLite.
+    """
+    _, error = await _get_master_lobby(access_token, lobby_id)
+    if error:
+        return error
+    return {"lobby_id": lobby_id, **await get_lobby_stats_db(lobby_id)}
+
+@router.get("/game-master/characters")
+async def game_master_characters(
+    access_token: str = Cookie(None),
+    lobby_id: str = "",
+    filter: list[str] = Query([]),
+    order_by: str | None = None,
+    desc: bool = False,
+    limit: int = Query(50, ge=1, le=500),
+):
+    """
+    Searches the characters of a lobby by their core stats, loading only the states changed since their snapshot.
+    Filters have the form stat:operator:value, e.g. ?filter=vida:lt:10 or
+    ?order_by=dinero&desc=true&limit=1 for the richest character.
+    """
+    _, error = await _get_master_lobby(access_token, lobby_id)
+    if error:
+        return error
+    filters = []
+    for item in filter:
+        try:
+            stat, operator, value = item.split(":", 2)
+            filters.append((stat, operator, value if stat == "clase" else int(value)))
+        except ValueError:
+            return JSONResponse({"error": f"Filtro no válido: {item}"}, status_code=400)
+    try:
+        characters = await find_characters_db(lobby_id, filters, order_by, desc, limit)
+    except ValueError as e:
+        return JSONResponse({"error": str(e)}, status_code=400)
+    return {"lobby_id": lobby_id, "characters": characters}
+
+@router.get("/game-master/replay")
+async def game_master_replay(
+    access_token: str = Cookie(None),
+    lobby_id: str = "",
+    after: int = 0,
+    limit: int = Query(REPLAY_PAGE_SIZE, ge=1, le=1000),
+):
+    """
+    Replays the history of a finished lobby one page at a time, oldest event first.
+    Each character starts with a 'snapshot' event followed by its 'replace' and
+    'patch' events. Pass the returned next_after as ?after= to get the next page;
+    it is null on the last page.
+    """
+    lobby_info, error = await _get_master_lobby(access_token, lobby_id)
+    if error:
+        return error
+    if lobby_info["status"] != "finished":
+        return JSONResponse({"error": "La partida todavía no ha terminado."}, status_code=409)
+    events = await get_lobby_events_db(lobby_id, after, limit)
+    return {
+        "lobby_id": lobby_id,
+        "events": events,
+        "next_after": events[-1]["event_id"] if len(events) == limit else None
+    }
 
 
 ## Auth Handlers
@@ -254,17 +408,23 @@ async def register_post(
 ):
     """Handles user registration, hashing the password and creating initial player state."""
     if await get_user_by_username(username):
-        print(f"{TAGS['app_error']} El usuario: {username} ya existe.")
+        app_logger.warning("El usuario: %s ya existe.", username)
         return templates.TemplateResponse("register.html", {
             "request": request,
             "error": "¡El usuario ya existe!"
         })
     
-    hashed_password = pwd_context.hash(password)
+    try:
+        hashed_password = await password_hasher.hash(password)
+    except PasswordHasherBusy:
+        return templates.TemplateResponse("register.html", {
+            "request": request,
+            "error": "El servidor está ocupado, inténtalo de nuevo en unos segundos."
+        })
     user_uuid = str(uuid.uuid4())
     await create_new_user(username, hashed_password, user_uuid)
 
-    print(f"{TAGS['app_log']} Usuario: {username} creado con exito. UUID: {user_uuid}")
+    app_logger.info("Usuario: %s creado con exito. UUID: %s", username, user_uuid)
     return RedirectResponse(url="/login", status_code=303)
 
 @router.get("/login")
@@ -285,18 +445,19 @@ async def login_post(request: Request, username: str = Form(...), password: str
     token = create_access_token({"sub": user_uuid})
     response = RedirectResponse(url="/lobby", status_code=303)
     response.set_cookie("access_token", token, httponly=True, samesite="strict")
-    print(f"{TAGS['app_log']} User: {username} UUID: {user_uuid} Logged sucessfully.")
+    app_logger.info("User: %s UUID: %s Logged sucessfully.", username, user_uuid)
     return response
 
 @router.get("/logout")
 async def logout(request: Request):
     """Logs out the user by deleting the access token cookie."""
     user_uuid, username = await get_user_info_for_logout(request)
+    await revoke_token_everywhere(request.cookies.get("access_token"))
     
     if user_uuid:
-        print(f"{TAGS['app_log']} User: {username} UUID: {user_uuid} Logged out successfully.")
+        app_logger.info("User: %s UUID: %s Logged out successfully.", username, user_uuid)
     else:
-        print(f"{TAGS['app_error']} Logout attempt with invalid token or no token.")
+        app_logger.warning("Logout attempt with invalid token or no token.")
 
     response = RedirectResponse(url="/", status_code=303)
     response.delete_cookie("access_token")
@@ -365,14 +526,15 @@ async def create_character_post(
 
     try:
         await create_initial_player_character(player_id, user_uuid, character_state)
-        print(f"{TAGS['app_log']} Personaje '{nombre}' creado por usuario {user_uuid} (Player ID: {player_id}).")
+        await page_cache.invalidate(("user", user_uuid))
+        app_logger.info("Personaje '%s' creado por usuario %s (Player ID: %s).", nombre, user_uuid, player_id)
         
         response = RedirectResponse(url="/player", status_code=303)
         response.set_cookie(key="selected_player_id_cookie", value=player_id, httponly=True, samesite="strict", max_age=ACCESS_TOKEN_EXPIRE_MINUTES * 60)
         return response
 
     except Exception as e:
-        print(f"{TAGS['app_error']} Error al crear personaje: {e}")
+        app_logger.error("Error al crear personaje: %s", e)
         return templates.TemplateResponse("create_character.html", {
             "request": request,
             "error": f"Error al crear personaje: {e}"
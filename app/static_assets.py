@@ -0,0 +1,153 @@
+import gzip
+import hashlib
+import mimetypes
+import os
+import posixpath
+
+from starlette.datastructures import Headers
+from starlette.exceptions import HTTPException
+from starlette.responses import Response
+
+from config import STATIC_DIR, STATIC_MAX_AGE_SECONDS
+from logs import get_logger
+
+try:
+    import brotli
+except ImportError:
+    brotli = None  # Assets are then precompressed with gzip only
+
+server_logger = get_logger("server")
+
+# Static asset pipeline. At startup every file under STATIC_DIR is read once,
+# content-hashed and precompressed, then served from memory:
+#   /static/style.3f2a9c1b0d4e.css  fingerprinted URL, cached by browsers for a year
+#   /static/style.css               plain URL, revalidated with its ETag
+# Templates build fingerprinted URLs with {{ static_url('style.css') }}.
+# Responses are negotiated on Accept-Encoding between br, gzip and the raw file.
+
+# Encodings in order of preference when the client accepts several equally
+COMPRESSORS = {"gzip": lambda data: gzip.compress(data, compresslevel=9, mtime=0)}
+if brotli is not None:
+    COMPRESSORS = {"br": lambda data: brotli.compress(data, quality=11), **COMPRESSORS}
+
+# A compressed copy is only kept if it saves at least this fraction of the file
+MIN_SAVING = 0.1
+
+class Asset:
+    """One static file held in memory, with its precompressed copies."""
+
+    __slots__ = ("path", "url_path", "media_type", "bodies", "etags")
+
+    def __init__(self, path: str, data: bytes):
+        digest = hashlib.sha256(data).hexdigest()
+        stem, ext = posixpath.splitext(path)
+        self.path = path
+        self.url_path = f"{stem}.{digest[:12]}{ext}"
+        self.media_type = mimetypes.guess_type(path)[0] or "application/octet-stream"
+        self.bodies = {"identity": data}  # Content-Encoding -> body
+        for encoding, compress in COMPRESSORS.items():
+            compressed = compress(data)
+            if len(compressed) <= len(data) * (1 - MIN_SAVING):
+                self.bodies[encoding] = compressed
+        # Each encoding is a different representation, so each gets its own strong ETag
+        self.etags = {encoding: f'"{digest[:32]}"' if encoding == "identity" else f'"{digest[:32]}-{encoding}"' for encoding in self.bodies}
+
+def negotiate_encoding(accept_encoding: str, available) -> str:
+    """
+    Picks the Content-Encoding to send from an Accept-Encoding header.
+    Args:
+        accept_encoding (str): The request's Accept-Encoding header.
+        available: Encodings the asset has, in order of preference.
+    Returns:
+        str: The accepted encoding with the highest q-value, or 'identity'.
+    """
+    accepted = {}
+    for item in accept_encoding.split(","):
+        name, _, params = item.strip().partition(";")
+        quality = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                continue
+        accepted[name.strip().lower()] = quality
+    best, best_quality = "identity", 0.0
+    for encoding in available:
+        if encoding == "identity":
+            continue
+        quality = accepted.get(encoding, accepted.get("*", 0.0))
+        if quality > best_quality:
+            best, best_quality = encoding, quality
+    return best
+
+def route_path(scope) -> str:
+    """Returns the request path relative to where the app is mounted (its root_path)."""
+    path, root_path = scope["path"], scope.get("root_path", "")
+    return path[len(root_path):] if root_path and path.startswith(root_path) else path
+
+class StaticAssets:
+    """
+    ASGI app serving the static directory from memory, in place of StaticFiles.
+    Call load() at startup; until then url() returns the plain paths.
+    """
+
+    def __init__(self, directory: str = STATIC_DIR, mount_path: str = "/static", max_age: int = STATIC_MAX_AGE_SECONDS):
+        self.directory = directory
+        self.mount_path = mount_path
+        self.max_age = max_age
+        self._assets: dict[str, Asset] = {}  # path relative to the directory -> asset
+        self._routes: dict[str, tuple[Asset, bool]] = {}  # URL path -> (asset, fingerprinted)
+
+    def load(self):
+        """Reads, fingerprints and precompresses every file in the directory."""
+        assets = {}
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                full_path = os.path.join(root, name)
+                path = os.path.relpath(full_path, self.directory).replace(os.sep, "/")
+                with open(full_path, "rb") as f:
+                    assets[path] = Asset(path, f.read())
+        routes = {}
+        for asset in assets.values():
+            routes[asset.path] = (asset, False)
+            routes[asset.url_path] = (asset, True)
+        self._assets, self._routes = assets, routes
+        raw = sum(len(asset.bodies["identity"]) for asset in assets.values())
+        smallest = sum(min(len(body) for body in asset.bodies.values()) for asset in assets.values())
+        server_logger.info("Loaded %s static assets: %s bytes, %s compressed (%s).",
+                           len(assets), raw, smallest, "/".join(COMPRESSORS))
+
+    def url(self, path: str) -> str:
+        """Returns the fingerprinted URL of a static file, or its plain URL if it is not known."""
+        path = path.lstrip("/")
+        asset = self._assets.get(path)
+        return f"{self.mount_path}/{asset.url_path if asset else path}"
+
+    async def __call__(self, scope, receive, send):
+        assert scope["type"] == "http"
+        if scope["method"] not in ("GET", "HEAD"):
+            raise HTTPException(status_code=405)
+        route = self._routes.get(route_path(scope).lstrip("/"))
+        if route is None:
+            raise HTTPException(status_code=404)
+        asset, fingerprinted = route
+        request_headers = Headers(scope=scope)
+        encoding = negotiate_encoding(request_headers.get("accept-encoding", ""), asset.bodies)
+        headers = {
+            "ETag": asset.etags[encoding],
+            "Vary": "Accept-Encoding",
+            # A fingerprinted URL always names the same bytes; plain URLs must be revalidated
+            "Cache-Control": f"public, max-age={self.max_age}, immutable" if fingerprinted else "no-cache",
+        }
+        if asset.etags[encoding] in {tag.strip().removeprefix("W/") for tag in request_headers.get("if-none-match", "").split(",")}:
+            response = Response(status_code=304, headers=headers)
+        else:
+            if encoding != "identity":
+                headers["Content-Encoding"] = encoding
+            body = asset.bodies[encoding]
+            response = Response(b"" if scope["method"] == "HEAD" else body, headers=headers, media_type=asset.media_type)
+            response.headers["Content-Length"] = str(len(body))
+        await response(scope, receive, send)
+
+static_assets = StaticAssets()
@@ -1,26 +1,83 @@
 import asyncio
-import json
+import time
+from typing import Awaitable, Callable
 from fastapi import WebSocket, WebSocketDisconnect
 
-from config import TAGS
+from codec import ENCODINGS, Frame, encode
+
+from config import MASTER_RESYNC_SECONDS, BACKPLANE_PRESENCE_SECONDS, METRICS_ENABLED
 from auth import verify_token
+from backplane import backplane, MASTERS_CHANNEL, LOBBIES_CHANNEL
+from connection_registry import Connection, ConnectionRegistry
+from lobby_directory import lobby_directory
+from messages import MESSAGE_SCHEMAS, MessageError, decode_message, validate_state
+from metrics import Counter, Gauge, Histogram, SIZE_BUCKETS
+from outbox import outbox_metrics
+from page_cache import page_cache
+from player_cache import player_cache
+from patches import apply_patch, PatchError
 from database import (
     delete_lobby_db,
-    load_player_state_by_id,
-    save_player_state,
     check_player_ownership,
     create_lobby_db,
     get_lobby_db,
     update_lobby_status_db,
     add_player_to_lobby_db,
     remove_player_from_lobby_db,
+    get_username_by_uuid,
     get_username_for_player_id,
+    get_usernames_for_player_ids,
     clear_lobby_players_db # New import
 )
+from logs import get_logger
+
+ws_logger = get_logger("websocket")
+app_logger = get_logger("app")
+
+# Stores active WebSocket connections, indexed by user, character, role and lobby
+connections = ConnectionRegistry()
 
-# Stores active WebSocket connections:
-# {user_uuid: {"ws": WebSocket, "role": "player/master", "selected_player_id": "...", "player_status": "...", "current_lobby_id": "..."}}
-connections = {}
+# Player statuses that are shown in the masters' active player panels
+ACTIVE_PLAYER_STATUSES = ("ready", "in_game")
+
+ws_messages_total = Counter("dnd_ws_messages_total", "WebSocket messages received, by sender role and message type ('invalid' if rejected).", ("role", "type"))
+ws_handler_seconds = Histogram("dnd_ws_handler_seconds", "Time spent handling a WebSocket message, by message type.", ("type",))
+broadcast_recipients = Histogram("dnd_broadcast_recipients", "Masters reached by each broadcast, by message type.", ("type",), buckets=SIZE_BUCKETS)
+broadcast_seconds = Histogram("dnd_broadcast_seconds", "Time to encode and queue a broadcast for every master, by message type.", ("type",))
+Gauge("dnd_ws_connections", "Open WebSocket connections by role.",
+      lambda: {("master",): len(connections.masters()), ("player",): len(connections.players())}, ("role",))
+Gauge("dnd_outbox_events_total", "Slow-consumer events on outbound queues.",
+      lambda: {(event,): count for event, count in outbox_metrics.items()}, ("event",), metric_type="counter")
+Gauge("dnd_outbox_queue_depth", "Messages waiting in outbound queues, by role.",
+      lambda: {(role,): sum(depths) for role, depths in connections.outbox_depths().items()}, ("role",))
+Gauge("dnd_outbox_max_queue_depth", "Deepest outbound queue of a single connection, by role.",
+      lambda: {(role,): max(depths, default=0) for role, depths in connections.outbox_depths().items()}, ("role",))
+
+# Master panel entries of players connected to other workers: worker_id -> player_id -> entry
+remote_players: dict[str, dict[str, dict]] = {}
+remote_seen: dict[str, float] = {}  # worker_id -> monotonic time of its last message
+
+async def get_active_player_entry(conn: Connection):
+    """
+    Builds the master panel entry for a player connection.
+    Returns None if the connection is not a player in 'ready' or 'in_game' status.
+    """
+    if conn.role != "player" or conn.player_status not in ACTIVE_PLAYER_STATUSES:
+        return None
+    player_id: str = conn.selected_player_id
+    player_state = await player_cache.get(player_id)
+    if not player_state:
+        return None
+    if conn.username is None:
+        # Fetched once per connection for display in master panel
+        conn.username = await get_username_for_player_id(player_id)
+    return {
+        "state": player_state,
+        "version": player_cache.version(player_id),
+        "status": conn.player_status,
+        "username": conn.username,
+        "current_lobby_id": conn.current_lobby_id
+    }
 
 async def get_active_players_state():
     """
@@ -30,303 +87,595 @@ async def get_active_players_state():
         dict: A dictionary where keys are player_ids and values are their states.
     """
     active_players_data = {}
-    for user_uuid, conn_info in connections.items():
-        if conn_info["role"] == "player" and "selected_player_id" in conn_info:
-            player_id: str = conn_info["selected_player_id"]
-            player_status: str = conn_info.get("player_status", "disconnected") # Get current player status
-            
-            # Only include players who are ready or in-game for the master's view
-            if player_status in ["ready", "in_game"]:
-                player_state = await load_player_state_by_id(player_id)
-                if player_state:
-                    # Fetch username for display in master panel
-                    username = await get_username_for_player_id(player_id)
-                    active_players_data[player_id] = {
-                        "state": player_state,
-                        "status": player_status,
-                        "username": username,
-                        "current_lobby_id": conn_info.get("current_lobby_id")
-                    }
+    conns = connections.players()
+    # Resolve every missing username in one query instead of one per player
+    unnamed = [conn for conn in conns if conn.username is None and conn.player_status in ACTIVE_PLAYER_STATUSES]
+    if unnamed:
+        usernames = await get_usernames_for_player_ids([conn.selected_player_id for conn in unnamed])
+        for conn in unnamed:
+            conn.username = usernames[conn.selected_player_id]
+    for conn in conns:
+        entry = await get_active_player_entry(conn)
+        if entry:
+            active_players_data[conn.selected_player_id] = entry
     return active_players_data
 
+async def get_players_snapshot():
+    """Builds the full players_state message sent to masters, including players on other workers."""
+    players = {}
+    for worker_players in remote_players.values():
+        players.update(worker_players)
+    players.update(await get_active_players_state())
+    return {
+        "type": "players_state",
+        "players": players
+    }
+
+def get_remote_player_state(player_id: str) -> dict | None:
+    """Returns the live state of a player connected to another worker, if known."""
+    for worker_players in remote_players.values():
+        entry = worker_players.get(player_id)
+        if entry is not None:
+            return entry["state"]
+    return None
+
+def send_to_masters(message: dict, state_update: bool = True):
+    """
+    Queues a message for every connected master. Never waits on a socket:
+    each master's writer task delivers it at its own pace.
+    The message is serialized once per wire format in use and the same frame is
+    shared by all masters.
+    """
+    masters = connections.masters()
+    if not masters:
+        return
+    started = time.perf_counter()
+    frame = Frame(message)
+    for encoding in {conn.encoding for conn in masters}:
+        encode(frame, encoding)
+    for conn in masters:
+        conn.send(frame, state_update)
+    if METRICS_ENABLED:
+        broadcast_seconds.observe(time.perf_counter() - started, message["type"])
+        broadcast_recipients.observe(len(masters), message["type"])
+
+async def publish_to_masters(message: dict):
+    """Sends a player panel update to the masters connected to every worker."""
+    await backplane.publish(MASTERS_CHANNEL, message)
+
+async def publish_players(conns, removed_player_ids=()):
+    """
+    Pushes a players_delta message to masters for the given player connections.
+    Connections that are no longer ready/in game are sent as removals, together
+    with any player_ids in removed_player_ids (e.g. players that disconnected).
+    """
+    if not connections.has_masters() and not backplane.distributed:
+        return
+    players = {}
+    removed = list(removed_player_ids)
+    for conn in conns:
+        entry = await get_active_player_entry(conn)
+        if entry:
+            players[conn.selected_player_id] = entry
+        else:
+            removed.append(conn.selected_player_id)
+    if players or removed:
+        await publish_to_masters({"type": "players_delta", "players": players, "removed": removed})
+
+def enter_game(conn: Connection, lobby_id: str):
+    """
+    Marks a player connection as in game. Its character's current state is logged
+    as the starting point of the session replay, so the lobby's event log always
+    begins with a snapshot, whether the player was there at the start, joined late
+    or reconnected.
+    """
+    conn.player_status = "in_game"
+    player_cache.record_snapshot(conn.selected_player_id, lobby_id)
+
+def session_lobby(conn: Connection) -> str | None:
+    """
+    Lobby a player's changes are logged under: only while in game, after the
+    session snapshot. Changes made while waiting in a lobby are not part of its replay.
+    """
+    return conn.current_lobby_id if conn.player_status == "in_game" else None
+
+def _forget_worker(worker_id: str):
+    """Drops the players of a worker that stopped, removing them from local master panels."""
+    remote_seen.pop(worker_id, None)
+    gone = list(remote_players.pop(worker_id, {}))
+    if gone:
+        send_to_masters({"type": "players_delta", "players": {}, "removed": gone})
+
+async def on_masters_message(message: dict, origin: str):
+    """
+    Backplane subscriber for the masters channel.
+    Updates from other workers are mirrored into remote_players so local master
+    snapshots include them; panel updates are then delivered to local masters.
+    """
+    kind = message.get("type")
+    if origin != backplane.worker_id:
+        remote_seen[origin] = time.monotonic()
+        worker_players = remote_players.setdefault(origin, {})
+        if kind == "players_delta":
+            worker_players.update(message["players"])
+            for player_id in message["removed"]:
+                worker_players.pop(player_id, None)
+            # Pages on this worker show remote players' live states
+            page_cache.bump(*(("character", player_id) for player_id in message["players"]))
+            page_cache.bump(*(("lobby", entry["current_lobby_id"]) for entry in message["players"].values() if entry["current_lobby_id"]))
+        elif kind == "player_patch":
+            entry = worker_players.get(message["player_id"])
+            page_cache.bump(("character", message["player_id"]))
+            if entry is not None:
+                if entry["current_lobby_id"]:
+                    page_cache.bump(("lobby", entry["current_lobby_id"]))
+                try:
+                    state = apply_patch(entry["state"], message["ops"])
+                except PatchError:
+                    state = entry["state"]
+                worker_players[message["player_id"]] = {**entry, "state": state, "version": message["version"]}
+        elif kind == "presence":
+            gone = [player_id for player_id in worker_players if player_id not in message["players"]]
+            remote_players[origin] = message["players"]
+            if gone:
+                send_to_masters({"type": "players_delta", "players": {}, "removed": gone})
+        elif kind == "presence_request":
+            await publish_presence()
+        elif kind == "worker_stopped":
+            _forget_worker(origin)
+    if kind in ("players_delta", "player_patch"):
+        send_to_masters(message)
+
+async def publish_presence():
+    """Announces this worker's active players to the other workers."""
+    await publish_to_masters({"type": "presence", "players": await get_active_players_state()})
+
+async def run_presence():
+    """
+    Background task for multi-worker deployments: periodically republishes this
+    worker's active players (correcting any missed delta) and forgets workers
+    that have gone silent.
+    """
+    if not backplane.distributed:
+        return
+    await publish_to_masters({"type": "presence_request"})
+    while True:
+        await publish_presence()
+        await asyncio.sleep(BACKPLANE_PRESENCE_SECONDS)
+        deadline = time.monotonic() - 3 * BACKPLANE_PRESENCE_SECONDS
+        for worker_id in [worker_id for worker_id, seen in remote_seen.items() if seen < deadline]:
+            ws_logger.info("Worker %s went silent; dropping its players.", worker_id)
+            _forget_worker(worker_id)
+
+async def leave_backplane():
+    """Tells the other workers this worker's players are gone. Called at shutdown."""
+    if backplane.distributed:
+        await publish_to_masters({"type": "worker_stopped"})
+
+async def on_lobby_event(message: dict, origin: str):
+    """
+    Backplane subscriber for the lobbies channel.
+    Keeps the lobby directory current and notifies the players connected to
+    this worker, whichever worker the master who triggered the event is on.
+    """
+    kind = message.get("type")
+    lobby_id = message["lobby_id"]
+    page_cache.bump(("lobbies",), ("lobby", lobby_id))
+    if kind == "lobby_created":
+        lobby_directory.add(lobby_id, message["master_uuid"], message["lobby_name"], message["master_username"])
+
+    elif kind == "game_started":
+        lobby_directory.set_status(lobby_id, "in_progress")
+        # Notify all players in this lobby to redirect
+        started_players = []
+        for p_id in message["player_ids"]:
+            player_conn = connections.by_player(p_id)
+            if player_conn is not None:
+                enter_game(player_conn, lobby_id)
+                started_players.append(player_conn)
+                player_conn.send({"type": "game_started", "lobby_id": lobby_id})
+                ws_logger.debug("Sent game_started to player %s", p_id)
+        await publish_players(started_players)
+
+    elif kind == "game_ended":
+        lobby_directory.set_status(lobby_id, "finished")
+        await player_cache.flush(message["player_ids"], compact=True) # Persist the final state of the session
+        # Notify all players who were in this lobby to redirect to lobby page
+        ended_players = connections.room_players(lobby_id)
+        for player_conn in ended_players:
+            p_id = player_conn.selected_player_id
+            player_conn.player_status = "connected" # Reset player status
+            connections.set_lobby(player_conn, None)
+            player_conn.send({"type": "game_ended", "message": "La partida ha terminado. Volviendo al lobby."})
+            ws_logger.debug("Sent game_ended to player %s", p_id)
+        await publish_players(ended_players)
+
+    elif kind == "lobby_deleted":
+        lobby_directory.remove(lobby_id)
+        # Ensure no players are left marked as ready in this lobby
+        released_players = connections.room_players(lobby_id)
+        for player_conn in released_players:
+            player_conn.player_status = "connected"
+            connections.set_lobby(player_conn, None)
+            player_conn.send({"type": "lobby_deleted", "message": "El lobby al que estabas listo ha sido eliminado. Volviendo a la selección de personaje."})
+        await publish_players(released_players)
+
+backplane.subscribe(MASTERS_CHANNEL, on_masters_message)
+backplane.subscribe(LOBBIES_CHANNEL, on_lobby_event)
+
 async def broadcast_active_players():
     """
-    Periodically broadcasts the state of active players to all connected masters.
+    Periodically resends the full active players snapshot to all connected masters.
+    Masters are kept current by players_delta events; this low-frequency resync only
+    corrects drift and can be disabled by setting MASTER_RESYNC_SECONDS to 0.
     """
+    if MASTER_RESYNC_SECONDS <= 0:
+        return
     while True:
-        active_players = await get_active_players_state()
-        # print(f"{TAGS['websocket']} Active players for broadcast: {active_players}") # Uncomment for verbose logging
-        to_remove = []
-        for user_uuid, conn_info in connections.items():
-            if conn_info["role"] == "master":
-                ws = conn_info["ws"]
-                try:
-                    await ws.send_json({
-                        "type": "players_state",
-                        "players": active_players
-                    })
-                except Exception as e:
-                    print(f"{TAGS['app_error']} Error enviando a master {user_uuid}: {e}")
-                    to_remove.append(user_uuid)
-        
-        # Remove closed master connections
-        for user_uuid in to_remove:
-            if user_uuid in connections: # Check again in case it was already removed
-                del connections[user_uuid]
-                print(f"{TAGS['websocket']} Removed disconnected master: {user_uuid}")
-                
-        await asyncio.sleep(3) # Broadcast every 3 seconds for more responsiveness
+        await asyncio.sleep(MASTER_RESYNC_SECONDS)
+        if connections.has_masters():
+            send_to_masters(await get_players_snapshot())
+
+# Handlers of client messages, keyed by (role, message type). Each one receives the
+# sender's connection and a message already validated against its schema in messages.py.
+MESSAGE_HANDLERS: dict[tuple[str, str], Callable[[Connection, dict], Awaitable[None]]] = {}
+
+def message_handler(role: str, message_type: str):
+    """Registers a coroutine as the handler of a message type sent by connections of the given role."""
+    if message_type not in MESSAGE_SCHEMAS:
+        raise ValueError(f"No schema for message type {message_type!r}")
+
+    def decorator(func):
+        MESSAGE_HANDLERS[(role, message_type)] = func
+        return func
+    return decorator
+
+def _reject_foreign_player(conn: Connection, message: dict) -> bool:
+    """Answers with an error if a player message targets a character other than the connection's."""
+    if message["player_id"] == conn.selected_player_id:
+        return False
+    conn.send({"type": "error", "message": "El personaje no corresponde a esta conexión."})
+    return True
+
+# --- Player specific messages ---
+
+@message_handler("player", "player_update")
+async def handle_player_update(conn: Connection, message: dict):
+    """Replaces the whole state of the connection's character."""
+    if _reject_foreign_player(conn, message):
+        return
+    new_state = message["state"]
+    try:
+        validate_state(new_state)
+        if new_state["player_id"] != conn.selected_player_id:
+            raise MessageError("El campo 'player_id' no se puede modificar.")
+    except MessageError as e:
+        conn.send({"type": "error", "message": str(e)})
+        return
+    player_cache.set(conn.selected_player_id, new_state, lobby_id=session_lobby(conn)) # Logged by the write-behind flusher
+    app_logger.debug("Player %s state updated by %s", conn.selected_player_id, conn.user_uuid, extra={"sample_key": "player.state_updated"})
+
+    # Push the updated player to all masters if it is shown in their panels
+    if conn.player_status in ACTIVE_PLAYER_STATUSES:
+        await publish_players([conn])
+
+@message_handler("player", "player_patch")
+async def handle_player_patch(conn: Connection, message: dict):
+    """Incremental update: only the changed fields, checked against the character's version."""
+    if _reject_foreign_player(conn, message):
+        return
+    player_id = conn.selected_player_id
+    current_state = await player_cache.get(player_id)
+    current_version = player_cache.version(player_id)
+    if message["version"] != current_version:
+        # Stale client: send the authoritative state so it can rebase
+        conn.send({
+            "type": "patch_rejected",
+            "player_id": player_id,
+            "message": "Versión desactualizada.",
+            "state": current_state,
+            "version": current_version
+        })
+        return
+    ops = message["ops"]
+    try:
+        new_state = apply_patch(current_state or {}, ops)
+        validate_state(new_state, {op["path"] for op in ops})
+    except (PatchError, MessageError) as e:
+        conn.send({
+            "type": "patch_rejected",
+            "player_id": player_id,
+            "message": str(e),
+            "state": current_state,
+            "version": current_version
+        })
+        return
+    new_version = player_cache.set(player_id, new_state, ops, session_lobby(conn))
+    conn.send({"type": "patch_ack", "player_id": player_id, "version": new_version})
+
+    # Forward only the operations to masters that are showing this player
+    if conn.player_status in ACTIVE_PLAYER_STATUSES:
+        await publish_to_masters({
+            "type": "player_patch",
+            "player_id": player_id,
+            "version": new_version,
+            "ops": ops
+        })
+
+@message_handler("player", "player_ready")
+async def handle_player_ready(conn: Connection, message: dict):
+    """Marks the player as ready in a lobby, or sends it straight into the game if already in progress."""
+    player_id_ready = conn.selected_player_id
+    lobby_id_to_join = message["lobby_id"]
+
+    if lobby_id_to_join:
+        lobby = await get_lobby_db(lobby_id_to_join)
+        # Allow joining if waiting or in_progress
+        if lobby and lobby["status"] in ["waiting", "in_progress"]:
+            await add_player_to_lobby_db(lobby_id_to_join, player_id_ready)
+            await page_cache.invalidate(("lobby", lobby_id_to_join))
+            conn.player_status = "ready" # Set status to ready
+            connections.set_lobby(conn, lobby_id_to_join)
+            conn.send({"type": "ready_ack", "message": f"Listo en lobby {lobby['lobby_name']}!"})
+            app_logger.info("Player %s is READY for lobby %s", player_id_ready, lobby_id_to_join)
+            # If lobby is already in progress, redirect player immediately
+            if lobby["status"] == "in_progress":
+                enter_game(conn, lobby_id_to_join)
+                conn.send({"type": "game_started", "lobby_id": lobby_id_to_join})
+            await publish_players([conn])
+        else:
+            conn.send({"type": "error", "message": "Lobby no encontrado o no está disponible para unirse."})
+    else:
+        conn.send({"type": "error", "message": "No se proporcionó ID de lobby."})
+
+@message_handler("player", "player_unready")
+async def handle_player_unready(conn: Connection, message: dict):
+    """Takes the player out of the lobby it is waiting in."""
+    player_id_unready = conn.selected_player_id
+    current_lobby_id = conn.current_lobby_id
+
+    if current_lobby_id:
+        lobby = await get_lobby_db(current_lobby_id)
+        if lobby and lobby["status"] == "waiting": # Only unready if lobby is waiting
+            await remove_player_from_lobby_db(current_lobby_id, player_id_unready)
+            await page_cache.invalidate(("lobby", current_lobby_id))
+            conn.player_status = "connected"
+            connections.set_lobby(conn, None)
+            conn.send({"type": "unready_ack", "message": "Ya no estás listo para la partida."})
+            app_logger.info("Player %s is UNREADY for lobby %s", player_id_unready, current_lobby_id)
+            await publish_players([conn])
+        else:
+            conn.send({"type": "error", "message": "No puedes dejar de estar listo en un lobby que ya ha comenzado."})
+    else:
+        conn.send({"type": "error", "message": "No estás en ningún lobby para dejar de estar listo."})
+
+# --- Master specific messages ---
+
+@message_handler("master", "create_lobby")
+async def handle_create_lobby(conn: Connection, message: dict):
+    """Creates a lobby owned by the master and announces it on every worker."""
+    user_uuid = conn.user_uuid
+    lobby_name = message["lobby_name"] or "Partida Sin Nombre"
+    lobby_id = await create_lobby_db(str(user_uuid), lobby_name)
+    conn.current_lobby_id = lobby_id # Master is now tied to this lobby
+    await backplane.publish(LOBBIES_CHANNEL, {
+        "type": "lobby_created",
+        "lobby_id": lobby_id,
+        "master_uuid": user_uuid,
+        "lobby_name": lobby_name,
+        "master_username": await get_username_by_uuid(user_uuid)
+    })
+    conn.send({"type": "lobby_created", "lobby_id": lobby_id, "lobby_name": lobby_name})
+    app_logger.info("Master %s created lobby: %s with name '%s'", user_uuid, lobby_id, lobby_name)
+
+@message_handler("master", "start_game")
+async def handle_start_game(conn: Connection, message: dict):
+    """Starts a waiting lobby owned by the master."""
+    user_uuid = conn.user_uuid
+    lobby_id_to_start = message["lobby_id"]
+    if lobby_id_to_start:
+        lobby = await get_lobby_db(lobby_id_to_start)
+        if lobby and lobby["master_uuid"] == user_uuid and lobby["status"] == "waiting":
+            await update_lobby_status_db(lobby_id_to_start, "in_progress")
+            app_logger.info("Master %s started game for lobby: %s", user_uuid, lobby_id_to_start)
+
+            # Notify all players in this lobby to redirect, on every worker
+            await backplane.publish(LOBBIES_CHANNEL, {
+                "type": "game_started",
+                "lobby_id": lobby_id_to_start,
+                "player_ids": lobby["players_in_lobby"]
+            })
+
+            # Notify the master to redirect
+            conn.send({"type": "game_started", "lobby_id": lobby_id_to_start})
+        else:
+            conn.send({"type": "error", "message": "Lobby no encontrado, no está en estado de espera, o no te pertenece."})
+    else:
+        conn.send({"type": "error", "message": "No se proporcionó ID de lobby para iniciar."})
+
+@message_handler("master", "end_game")
+async def handle_end_game(conn: Connection, message: dict):
+    """Ends an in-progress lobby owned by the master."""
+    user_uuid = conn.user_uuid
+    lobby_id_to_end = message["lobby_id"]
+    if lobby_id_to_end:
+        lobby = await get_lobby_db(lobby_id_to_end)
+        if lobby and lobby["master_uuid"] == user_uuid and lobby["status"] == "in_progress":
+            await update_lobby_status_db(lobby_id_to_end, "finished")
+            await clear_lobby_players_db(lobby_id_to_end) # Clear players from lobby DB
+            app_logger.info("Master %s ended game for lobby: %s", user_uuid, lobby_id_to_end)
+
+            # Persist the final states and send the players back to the lobby page, on every worker
+            await backplane.publish(LOBBIES_CHANNEL, {
+                "type": "game_ended",
+                "lobby_id": lobby_id_to_end,
+                "player_ids": lobby["players_in_lobby"]
+            })
+
+            # Notify the master to redirect
+            conn.send({"type": "game_ended", "message": "Has terminado la partida. Volviendo al panel de máster."})
+        else:
+            conn.send({"type": "error", "message": "Lobby no encontrado, no está en curso, o no te pertenece."})
+    else:
+        conn.send({"type": "error", "message": "No se proporcionó ID de lobby para terminar."})
+
+@message_handler("master", "delete_lobby")
+async def handle_delete_lobby(conn: Connection, message: dict):
+    """Deletes a waiting lobby owned by the master, releasing its ready players."""
+    user_uuid = conn.user_uuid
+    lobby_id_to_delete = message["lobby_id"]
+    if lobby_id_to_delete:
+        lobby = await get_lobby_db(lobby_id_to_delete)
+        if lobby and lobby["master_uuid"] == user_uuid and lobby["status"] == "waiting":
+            # Before deleting, release the players marked as ready in this lobby on every worker
+            await backplane.publish(LOBBIES_CHANNEL, {"type": "lobby_deleted", "lobby_id": lobby_id_to_delete})
+
+            await clear_lobby_players_db(lobby_id_to_delete) # Clear players from lobby DB
+            await delete_lobby_db(lobby_id_to_delete)
+            await page_cache.invalidate(("lobbies",), ("lobby", lobby_id_to_delete)) # Pages rendered since lobby_deleted may still list it
+            conn.send({"type": "lobby_deleted_ack", "message": "Lobby eliminado exitosamente."})
+            app_logger.info("Master %s deleted lobby: %s", user_uuid, lobby_id_to_delete)
+        else:
+            conn.send({"type": "error", "message": "Lobby no encontrado, no está en estado de espera, o no te pertenece."})
+    else:
+        conn.send({"type": "error", "message": "No se proporcionó ID de lobby para eliminar."})
+
+async def receive_frame(websocket: WebSocket) -> str | bytes:
+    """Waits for the next client frame: text for JSON, bytes for MessagePack."""
+    message = await websocket.receive()
+    if message["type"] == "websocket.disconnect":
+        raise WebSocketDisconnect(message.get("code", 1000), message.get("reason"))
+    return message["text"] if message.get("text") is not None else message["bytes"]
 
 async def handle_websocket_connection(websocket: WebSocket):
     """Handles individual WebSocket connections."""
     await websocket.accept()
     user_uuid: str | None = None
     selected_player_id: str | None = None
+    conn: Connection | None = None
 
     try:
-        data = await websocket.receive_json()
-        if data["type"] == "connect":
-            user_uuid = verify_token(data["token"])
-            if not user_uuid:
-                await websocket.send_json({"error": "Token inválido"})
+        try:
+            data = decode_message(await receive_frame(websocket))
+            if data["type"] != "connect":
+                raise MessageError("Se esperaba un mensaje 'connect'.")
+        except MessageError as e:
+            await websocket.send_json({"type": "error", "message": str(e)})
+            await websocket.close()
+            ws_logger.warning("Connection rejected: %s", e)
+            return
+
+        user_uuid = verify_token(data["token"])
+        if not user_uuid:
+            await websocket.send_json({"error": "Token inválido"})
+            await websocket.close()
+            ws_logger.warning("Connection rejected: Invalid token.")
+            return
+
+        role = data["role"]
+        encoding = data["encoding"] if data["encoding"] in ENCODINGS else "json" # Wire format from now on; unknown or unavailable ones fall back to JSON
+
+        if role == "master":
+            ws_logger.info("connected: %s as: master (%s)", user_uuid, encoding)
+            conn = Connection(user_uuid, websocket, "master", snapshot=get_players_snapshot, encoding=encoding)
+            connections.add(conn)
+            conn.outbox.start()
+            conn.outbox.send_snapshot() # Built when sent, so no later delta can precede it
+
+        elif role == "player":
+            player_id_from_data = data["player_id"]
+            if not player_id_from_data:
+                await websocket.send_json({"type": "redirect", "url": "/player", "message": "No player_id provided or invalid type for player connection. Redirecting to character selection."})
                 await websocket.close()
-                print(f"{TAGS['websocket']} Connection rejected: Invalid token.")
+                ws_logger.warning("Player connection rejected: No player_id or invalid type. Redirecting.")
                 return
 
-            role = data.get("role")
-            
-            if role == "master":
-                print(f"{TAGS['websocket']} connected: {user_uuid} as: master")
-                connections[user_uuid] = {"ws": websocket, "role": "master"}
-                players_state = await get_active_players_state()
-                await websocket.send_json({
-                    "type": "players_state",
-                    "players": players_state
-                })
-
-            elif role == "player":
-                player_id_from_data = data.get("player_id")
-                if not isinstance(player_id_from_data, str) or not player_id_from_data:
-                    await websocket.send_json({"type": "redirect", "url": "/player", "message": "No player_id provided or invalid type for player connection. Redirecting to character selection."})
-                    await websocket.close()
-                    print(f"{TAGS['websocket']} Player connection rejected: No player_id or invalid type. Redirecting.")
-                    return
-
-                selected_player_id = player_id_from_data
+            selected_player_id = player_id_from_data
 
-                if not await check_player_ownership(selected_player_id, user_uuid):
-                    await websocket.send_json({"type": "redirect", "url": "/player", "message": "Player ID does not belong to this user. Redirecting to character selection."})
-                    await websocket.close()
-                    print(f"{TAGS['websocket']} Player connection rejected: Unauthorized player_id. Redirecting.")
-                    return
+            if not await check_player_ownership(selected_player_id, user_uuid):
+                await websocket.send_json({"type": "redirect", "url": "/player", "message": "Player ID does not belong to this user. Redirecting to character selection."})
+                await websocket.close()
+                ws_logger.warning("Player connection rejected: Unauthorized player_id. Redirecting.")
+                return
 
-                # Check if player was already in a game lobby
-                current_lobby_id = data.get("lobby_id")
-                if current_lobby_id:
-                    lobby = await get_lobby_db(current_lobby_id)
-                    if lobby and lobby["status"] == "in_progress" and selected_player_id in lobby["players_in_lobby"]:
-                        # Player is rejoining an in-progress game
-                        player_status = "in_game"
-                        print(f"{TAGS['websocket']} Player {selected_player_id} rejoining in-progress lobby {current_lobby_id}")
-                    else:
-                        # Lobby not found, not in progress, or player not in lobby
-                        # Default to connected status if not a valid re-join
-                        player_status = "connected"
-                        current_lobby_id = None # Clear invalid lobby ID
-                        await websocket.send_json({"type": "alert", "message": "No se pudo re-unir a la partida. Volviendo a la selección de personaje."})
-                        await websocket.send_json({"type": "redirect", "url": "/player"})
-                        await websocket.close()
-                        return
+            # Check if player was already in a game lobby
+            current_lobby_id = data["lobby_id"]
+            if current_lobby_id:
+                lobby = await get_lobby_db(current_lobby_id)
+                if lobby and lobby["status"] == "in_progress" and selected_player_id in lobby["players_in_lobby"]:
+                    # Player is rejoining an in-progress game
+                    player_status = "in_game"
+                    ws_logger.info("Player %s rejoining in-progress lobby %s", selected_player_id, current_lobby_id)
                 else:
-                    player_status = "connected" # Default for new connection
-
-                connections[user_uuid] = {
-                    "ws": websocket,
-                    "role": "player",
-                    "selected_player_id": selected_player_id,
-                    "player_status": player_status,
-                    "current_lobby_id": current_lobby_id
-                }
-                print(f"{TAGS['websocket']} connected: {user_uuid} as: player with character: {selected_player_id}, status: {player_status}")
-                
-                initial_state = await load_player_state_by_id(selected_player_id)
-                if initial_state:
-                    await websocket.send_json({
-                        "type": "player_state_update",
-                        "player_id": selected_player_id,
-                        "state": initial_state
-                    })
-                    # If rejoining game, redirect immediately
-                    if player_status == "in_game" and current_lobby_id:
-                        await websocket.send_json({"type": "game_started", "lobby_id": current_lobby_id})
-                else:
-                    await websocket.send_json({"type": "redirect", "url": "/player", "message": "Selected character state not found. Redirecting to character selection."})
+                    # Lobby not found, not in progress, or player not in lobby
+                    # Default to connected status if not a valid re-join
+                    player_status = "connected"
+                    current_lobby_id = None # Clear invalid lobby ID
+                    await websocket.send_json({"type": "alert", "message": "No se pudo re-unir a la partida. Volviendo a la selección de personaje."})
+                    await websocket.send_json({"type": "redirect", "url": "/player"})
                     await websocket.close()
                     return
+            else:
+                player_status = "connected" # Default for new connection
 
-        # Main loop for receiving messages
+            player_cache.acquire(selected_player_id) # Keep the character cached while this connection is open
+            initial_state = await player_cache.get(selected_player_id)
+            if not initial_state:
+                await player_cache.release(selected_player_id)
+                await websocket.send_json({"type": "redirect", "url": "/player", "message": "Selected character state not found. Redirecting to character selection."})
+                await websocket.close()
+                return
+
+            conn = Connection(user_uuid, websocket, "player", selected_player_id, player_status, current_lobby_id, encoding=encoding)
+            connections.add(conn)
+            conn.outbox.start()
+            ws_logger.info("connected: %s as: player with character: %s, status: %s (%s)", user_uuid, selected_player_id, player_status, encoding)
+
+            conn.send({
+                "type": "player_state_update",
+                "player_id": selected_player_id,
+                "state": initial_state,
+                "version": player_cache.version(selected_player_id)
+            })
+            # If rejoining game, start a new stretch of the session replay and redirect immediately
+            if player_status == "in_game" and current_lobby_id:
+                enter_game(conn, current_lobby_id)
+                conn.send({"type": "game_started", "lobby_id": current_lobby_id})
+                await publish_players([conn])
+
+        # Main loop: decode and validate each message, then dispatch it by (role, type)
         while True:
-            received_data = await websocket.receive_json()
-            print(f"{TAGS['websocket']} Received data from {user_uuid} (Role: {connections.get(user_uuid, {}).get('role')}): {received_data}")
-
-            # --- Player specific messages ---
-            if connections.get(user_uuid, {}).get("role") == "player":
-                current_selected_player_id_from_conn: str = connections[user_uuid]["selected_player_id"]
-
-                if received_data.get("type") == "player_update":
-                    if received_data.get("player_id") == current_selected_player_id_from_conn:
-                        new_state = received_data.get("state")
-                        if new_state:
-                            await save_player_state(current_selected_player_id_from_conn, new_state)
-                            print(f"{TAGS['app_log']} Player {current_selected_player_id_from_conn} state updated by {user_uuid}")
-                            
-                            # Broadcast updated state to all masters
-                            updated_player_data = {current_selected_player_id_from_conn: new_state}
-                            for master_uuid, master_conn in connections.items():
-                                if master_conn["role"] == "master":
-                                    try:
-                                        await master_conn["ws"].send_json({
-                                            "type": "players_state",
-                                            "players": updated_player_data # Send only the updated player
-                                        })
-                                    except Exception as e:
-                                        print(f"{TAGS['app_error']} Error broadcasting update to master {master_uuid}: {e}")
-                
-                elif received_data.get("type") == "player_ready":
-                    player_id_ready = current_selected_player_id_from_conn
-                    lobby_id_to_join = received_data.get("lobby_id")
-
-                    if lobby_id_to_join:
-                        lobby = await get_lobby_db(lobby_id_to_join)
-                        # Allow joining if waiting or in_progress
-                        if lobby and lobby["status"] in ["waiting", "in_progress"]:
-                            await add_player_to_lobby_db(lobby_id_to_join, player_id_ready)
-                            connections[user_uuid]["player_status"] = "ready" # Set status to ready
-                            connections[user_uuid]["current_lobby_id"] = lobby_id_to_join
-                            await websocket.send_json({"type": "ready_ack", "message": f"Listo en lobby {lobby['lobby_name']}!"})
-                            print(f"{TAGS['app_log']} Player {player_id_ready} is READY for lobby {lobby_id_to_join}")
-                            # If lobby is already in progress, redirect player immediately
-                            if lobby["status"] == "in_progress":
-                                connections[user_uuid]["player_status"] = "in_game"
-                                await websocket.send_json({"type": "game_started", "lobby_id": lobby_id_to_join})
-                        else:
-                            await websocket.send_json({"type": "error", "message": "Lobby no encontrado o no está disponible para unirse."})
-                    else:
-                        await websocket.send_json({"type": "error", "message": "No se proporcionó ID de lobby."})
-
-                elif received_data.get("type") == "player_unready":
-                    player_id_unready = current_selected_player_id_from_conn
-                    current_lobby_id = connections[user_uuid].get("current_lobby_id")
-
-                    if current_lobby_id:
-                        lobby = await get_lobby_db(current_lobby_id)
-                        if lobby and lobby["status"] == "waiting": # Only unready if lobby is waiting
-                            await remove_player_from_lobby_db(current_lobby_id, player_id_unready)
-                            connections[user_uuid]["player_status"] = "connected"
-                            connections[user_uuid]["current_lobby_id"] = None
-                            await websocket.send_json({"type": "unready_ack", "message": "Ya no estás listo para la partida."})
-                            print(f"{TAGS['app_log']} Player {player_id_unready} is UNREADY for lobby {current_lobby_id}")
-                        else:
-                            await websocket.send_json({"type": "error", "message": "No puedes dejar de estar listo en un lobby que ya ha comenzado."})
-                    else:
-                        await websocket.send_json({"type": "error", "message": "No estás en ningún lobby para dejar de estar listo."})
-
-
-            # --- Master specific messages ---
-            elif connections.get(user_uuid, {}).get("role") == "master":
-                if received_data.get("type") == "create_lobby":
-                    lobby_name = received_data.get("lobby_name", "Partida Sin Nombre")
-                    lobby_id = await create_lobby_db(str(user_uuid), lobby_name)
-                    connections[user_uuid]["current_lobby_id"] = lobby_id # Master is now tied to this lobby
-                    await websocket.send_json({"type": "lobby_created", "lobby_id": lobby_id, "lobby_name": lobby_name})
-                    print(f"{TAGS['app_log']} Master {user_uuid} created lobby: {lobby_id} with name '{lobby_name}'")
-                
-                elif received_data.get("type") == "start_game":
-                    lobby_id_to_start = received_data.get("lobby_id")
-                    if lobby_id_to_start:
-                        lobby = await get_lobby_db(lobby_id_to_start)
-                        if lobby and lobby["master_uuid"] == user_uuid and lobby["status"] == "waiting":
-                            await update_lobby_status_db(lobby_id_to_start, "in_progress")
-                            print(f"{TAGS['app_log']} Master {user_uuid} started game for lobby: {lobby_id_to_start}")
-
-                            # Notify all players in this lobby to redirect
-                            for p_id in lobby["players_in_lobby"]:
-                                for u_uuid, conn_info in connections.items():
-                                    if conn_info["role"] == "player" and conn_info.get("selected_player_id") == p_id:
-                                        conn_info["player_status"] = "in_game" # Update player status
-                                        try:
-                                            await conn_info["ws"].send_json({"type": "game_started", "lobby_id": lobby_id_to_start})
-                                            print(f"{TAGS['websocket']} Sent game_started to player {p_id}")
-                                        except Exception as e:
-                                            print(f"{TAGS['app_error']} Error sending game_started to player {p_id}: {e}")
-                                            # Consider removing player from lobby if connection is broken
-                            
-                            # Notify the master to redirect
-                            await websocket.send_json({"type": "game_started", "lobby_id": lobby_id_to_start})
-                        else:
-                            await websocket.send_json({"type": "error", "message": "Lobby no encontrado, no está en estado de espera, o no te pertenece."})
-                    else:
-                        await websocket.send_json({"type": "error", "message": "No se proporcionó ID de lobby para iniciar."})
-
-                elif received_data.get("type") == "end_game":
-                    lobby_id_to_end = received_data.get("lobby_id")
-                    if lobby_id_to_end:
-                        lobby = await get_lobby_db(lobby_id_to_end)
-                        if lobby and lobby["master_uuid"] == user_uuid and lobby["status"] == "in_progress":
-                            await update_lobby_status_db(lobby_id_to_end, "finished")
-                            await clear_lobby_players_db(lobby_id_to_end) # Clear players from lobby DB
-                            print(f"{TAGS['app_log']} Master {user_uuid} ended game for lobby: {lobby_id_to_end}")
-
-                            # Notify all players who were in this lobby to redirect to lobby page
-                            for p_id in lobby["players_in_lobby"]:
-                                for u_uuid, conn_info in connections.items():
-                                    if conn_info["role"] == "player" and conn_info.get("selected_player_id") == p_id and conn_info.get("current_lobby_id") == lobby_id_to_end:
-                                        conn_info["player_status"] = "connected" # Reset player status
-                                        conn_info["current_lobby_id"] = None
-                                        try:
-                                            await conn_info["ws"].send_json({"type": "game_ended", "message": "La partida ha terminado. Volviendo al lobby."})
-                                            print(f"{TAGS['websocket']} Sent game_ended to player {p_id}")
-                                        except Exception as e:
-                                            print(f"{TAGS['app_error']} Error sending game_ended to player {p_id}: {e}")
-                            
-                            # Notify the master to redirect
-                            await websocket.send_json({"type": "game_ended", "message": "Has terminado la partida. Volviendo al panel de máster."})
-                        else:
-                            await websocket.send_json({"type": "error", "message": "Lobby no encontrado, no está en curso, o no te pertenece."})
-                    else:
-                        await websocket.send_json({"type": "error", "message": "No se proporcionó ID de lobby para terminar."})
-
-                elif received_data.get("type") == "delete_lobby":
-                    lobby_id_to_delete = received_data.get("lobby_id")
-                    if lobby_id_to_delete:
-                        lobby = await get_lobby_db(lobby_id_to_delete)
-                        if lobby and lobby["master_uuid"] == user_uuid and lobby["status"] == "waiting":
-                            # Before deleting, ensure no players are marked as ready in this lobby
-                            players_in_lobby = lobby["players_in_lobby"]
-                            for p_id in players_in_lobby:
-                                for u_uuid, conn_info in connections.items():
-                                    if conn_info["role"] == "player" and conn_info.get("selected_player_id") == p_id and conn_info.get("current_lobby_id") == lobby_id_to_delete:
-                                        conn_info["player_status"] = "connected"
-                                        conn_info["current_lobby_id"] = None
-                                        try:
-                                            await conn_info["ws"].send_json({"type": "lobby_deleted", "message": "El lobby al que estabas listo ha sido eliminado. Volviendo a la selección de personaje."})
-                                        except Exception as e:
-                                            print(f"{TAGS['app_error']} Error notifying player {p_id} about lobby deletion: {e}")
-
-                            await clear_lobby_players_db(lobby_id_to_delete) # Clear players from lobby DB
-                            await delete_lobby_db(lobby_id_to_delete)
-                            await websocket.send_json({"type": "lobby_deleted_ack", "message": "Lobby eliminado exitosamente."})
-                            print(f"{TAGS['app_log']} Master {user_uuid} deleted lobby: {lobby_id_to_delete}")
-                        else:
-                            await websocket.send_json({"type": "error", "message": "Lobby no encontrado, no está en estado de espera, o no te pertenece."})
-                    else:
-                        await websocket.send_json({"type": "error", "message": "No se proporcionó ID de lobby para eliminar."})
-            
+            try:
+                message = decode_message(await receive_frame(websocket))
+                handler = MESSAGE_HANDLERS.get((conn.role, message["type"]))
+                if handler is None:
+                    raise MessageError(f"Mensaje no permitido: {message['type']}")
+            except MessageError as e:
+                message, handler = {"type": "invalid", "error": str(e)}, None
+            if METRICS_ENABLED:
+                ws_messages_total.inc(conn.role, message["type"])
+            # Per-message log: only at DEBUG level and sampled so bursts cannot flood the output
+            ws_logger.debug("Received data from %s (Role: %s): %s", user_uuid, conn.role, message, extra={"sample_key": "ws.received"})
+
+            if handler is None:
+                # Rejected before any database work
+                conn.send({"type": "error", "message": message["error"]})
+                continue
+            # Timed around the call itself, so handlers that raise or end the connection are recorded too
+            started = time.perf_counter()
+            try:
+                await handler(conn, message)
+            finally:
+                if METRICS_ENABLED:
+                    ws_handler_seconds.observe(time.perf_counter() - started, message["type"])
+
     except WebSocketDisconnect:
-        if user_uuid and user_uuid in connections:
-            role = connections[user_uuid]["role"]
-            player_id = connections[user_uuid].get("selected_player_id")
-            current_lobby_id = connections[user_uuid].get("current_lobby_id")
+        # Only clean up if this socket is still the user's registered connection
+        if conn is not None and connections.is_registered(conn):
+            role = conn.role
+            player_id = conn.selected_player_id
+            current_lobby_id = conn.current_lobby_id
+            was_active = conn.player_status in ACTIVE_PLAYER_STATUSES
 
             # If player disconnects while in a lobby, remove them from the lobby's player list
             if role == "player":
@@ -334,7 +683,8 @@ async def handle_websocket_connection(websocket: WebSocket):
                     lobby = await get_lobby_db(current_lobby_id)
                     if lobby and lobby["status"] in ["waiting", "in_progress"]:
                         await remove_player_from_lobby_db(current_lobby_id, player_id)
-                        print(f"{TAGS['app_log']} Player {player_id} removed from lobby {current_lobby_id} due to disconnect.")
+                        await page_cache.invalidate(("lobby", current_lobby_id))
+                        app_logger.info("Player %s removed from lobby %s due to disconnect.", player_id, current_lobby_id)
                 # Always send player back to character selection on disconnect
                 # This message is sent before deleting the connection, so it should be received by the client
                 # if the client is still listening before the connection fully closes.
@@ -342,9 +692,19 @@ async def handle_websocket_connection(websocket: WebSocket):
                 # WebSocket `onclose` to trigger a redirect to `/player`.
                 # await websocket.send_json({"type": "redirect", "url": "/player", "message": "Has sido desconectado. Volviendo a la selección de personaje."})
 
-            del connections[user_uuid]
-            print(f"{TAGS['websocket']} Disconnected: {user_uuid} (Role: {role})")
+            connections.remove(conn)
+            if role == "player" and player_id and was_active:
+                await publish_players([], removed_player_ids=[player_id])
+            ws_logger.info("Disconnected: %s (Role: %s)", user_uuid, role)
+        if conn is not None and conn.role == "player":
+            await player_cache.release(conn.selected_player_id) # Flush and evict the character once its owner is gone
     except Exception as e:
-        print(f"{TAGS['app_error']} WebSocket error for {user_uuid}: {e}")
-        if user_uuid and user_uuid in connections:
-            del connections[user_uuid]
+        app_logger.error("WebSocket error for %s: %s", user_uuid, e)
+        if conn is not None:
+            if connections.remove(conn) and conn.role == "player" and conn.player_status in ACTIVE_PLAYER_STATUSES:
+                await publish_players([], removed_player_ids=[conn.selected_player_id])
+            if conn.role == "player":
+                await player_cache.release(conn.selected_player_id)
+    finally:
+        if conn is not None:
+            await conn.outbox.stop()
@@ -0,0 +1,79 @@
+"""
+Encode cost of a players_state broadcast against the number of recipients.
+
+Compares re-serializing the message for every recipient with the stdlib
+(what send_json did) against encoding it once with the app codec and
+sharing the frame (what send_to_masters does now).
+
+Run from the repository root:
+    python benchmarks/bench_broadcast_encoding.py [--players 20] [--items 60]
+"""
+import argparse
+import json
+import os
+import sys
+import time
+import uuid
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "app"))
+
+from codec import JSON_BACKEND, Frame
+
+def build_players_state(players: int, items: int) -> dict:
+    """Builds a players_state message with characters carrying long lists."""
+    entries = {}
+    for index in range(players):
+        player_id = str(uuid.uuid4())
+        entries[player_id] = {
+            "state": {
+                "player_id": player_id,
+                "nombre": f"Personaje {index}",
+                "clase": "Bardo",
+                "nivel": 5, "fuerza": 3, "ingenio": 4, "corazon": 2,
+                "vida": 18, "mana": 9, "dinero": 120, "defensa": 2,
+                "arma_equipada": "Laúd afilado",
+                "armadura_equipada": "Cuero tachonado",
+                "inventario": [f"Objeto {i}" for i in range(items)],
+                "habilidades": [f"Habilidad {i}" for i in range(items // 2)],
+                "canciones_aprendidas": [f"Canción {i}" for i in range(items // 4)],
+            },
+            "version": 3,
+            "status": "in_game",
+            "username": f"jugador{index}",
+            "current_lobby_id": str(uuid.uuid4()),
+        }
+    return {"type": "players_state", "players": entries}
+
+def time_per_recipient(message: dict, recipients: int, rounds: int) -> float:
+    started = time.perf_counter()
+    for _ in range(rounds):
+        for _ in range(recipients):
+            json.dumps(message)
+    return (time.perf_counter() - started) / rounds
+
+def time_encode_once(message: dict, recipients: int, rounds: int) -> float:
+    started = time.perf_counter()
+    for _ in range(rounds):
+        frame = Frame(message)
+        for _ in range(recipients):
+            frame.text # Every recipient reuses the same encoded text
+    return (time.perf_counter() - started) / rounds
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--players", type=int, default=20, help="characters in the snapshot")
+    parser.add_argument("--items", type=int, default=60, help="inventory items per character")
+    parser.add_argument("--rounds", type=int, default=20, help="broadcasts timed per measurement")
+    args = parser.parse_args()
+
+    message = build_players_state(args.players, args.items)
+    size = len(json.dumps(message).encode())
+    print(f"Payload: {args.players} players, {size / 1024:.1f} KiB. Codec backend: {JSON_BACKEND}")
+    print(f"{'recipients':>10} {'stdlib per recipient (ms)':>26} {'encode once (ms)':>17} {'speedup':>8}")
+    for recipients in (1, 5, 10, 25, 50, 100, 250):
+        baseline = time_per_recipient(message, recipients, args.rounds)
+        shared = time_encode_once(message, recipients, args.rounds)
+        print(f"{recipients:>10} {baseline * 1000:>26.3f} {shared * 1000:>17.3f} {baseline / shared:>7.1f}x")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,331 @@
+"""
+Micro-benchmarks for every function in app/database.py at realistic scale.
+
+Seeds a separate SQLite file through the application's own migrations
+(default target: 100k users, 500k characters, 1M lobbies, mostly finished),
+then times each database function at several concurrency levels and writes
+machine-readable JSON. Comparing against a baseline file shows the effect
+of schema, index and pool changes in numbers.
+
+Run from the repository root:
+    python benchmarks/bench_database.py --scale 0.1 --out before.json
+    ... change the schema or the queries ...
+    python benchmarks/bench_database.py --scale 0.1 --reuse-db --out after.json --baseline before.json
+    python benchmarks/bench_database.py --compare before.json after.json
+
+Seeding the full scale (--scale 1) takes a few minutes and about 1 GB of disk;
+the seeded file is kept so later runs can pass --reuse-db.
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import sqlite3
+import statistics
+import sys
+import time
+import uuid
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "app"))
+
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+import database
+from database import ConnectionPool
+from logs import setup_logging
+
+FULL_SCALE = {"users": 100_000, "characters": 500_000, "lobbies": 1_000_000}
+ACTIVE_LOBBY_SHARE = 0.02  # Lobbies still waiting or in progress; the rest are finished
+REPLAYABLE_LOBBY_SHARE = 0.01  # Finished lobbies with a character event history
+EVENTS_PER_SESSION = 30    # Patch events logged per replayable lobby
+BATCH = 50                 # Ids per call for the bulk functions
+
+def character_state(player_id: str, index: int) -> dict:
+    return {
+        "player_id": player_id, "nombre": f"Personaje {index}", "clase": random.choice(("Guerrero", "Bardo", "Mago", "Pícaro")),
+        "nivel": random.randint(1, 20), "fuerza": random.randint(1, 5), "ingenio": random.randint(1, 5), "corazon": random.randint(1, 5),
+        "vida": random.randint(1, 40), "mana": random.randint(0, 20), "dinero": random.randint(0, 500), "defensa": random.randint(0, 5),
+        "arma_equipada": "Espada", "armadura_equipada": "Cuero",
+        "inventario": [f"Objeto {i}" for i in range(random.randint(0, 15))],
+        "habilidades": ["Golpe", "Bloqueo"], "canciones_aprendidas": [],
+    }
+
+def seed(path: str, users: int, characters: int, lobbies: int):
+    """Fills a migrated database with synthetic data using plain sqlite3 for speed."""
+    started = time.perf_counter()
+    db = sqlite3.connect(path)
+    db.execute("PRAGMA synchronous = OFF")
+    user_ids = [str(uuid.uuid4()) for _ in range(users)]
+    db.executemany("INSERT INTO users (uuid, username, password) VALUES (?, ?, ?)",
+                   ((user_id, f"bench_user_{i}", "x") for i, user_id in enumerate(user_ids)))
+    db.commit()
+
+    def players():
+        for i in range(characters):
+            player_id = str(uuid.uuid4())
+            yield player_id, user_ids[i % users], json.dumps(character_state(player_id, i), ensure_ascii=False)
+    db.executemany("INSERT INTO players (player_id, owner_uuid, state) VALUES (?, ?, ?)", players())
+    db.commit()
+
+    base = time.time() - lobbies
+    def lobby_rows():
+        for i in range(lobbies):
+            status = "finished" if random.random() >= ACTIVE_LOBBY_SHARE else random.choice(("waiting", "in_progress"))
+            created_at = time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(base + i))
+            yield str(uuid.uuid4()), random.choice(user_ids), f"Partida {i}", status, created_at
+    db.executemany("INSERT INTO lobbies (lobby_id, master_uuid, lobby_name, status, created_at) VALUES (?, ?, ?, ?, ?)", lobby_rows())
+    db.commit()
+
+    # A few members in every active lobby
+    player_ids = [row[0] for row in db.execute("SELECT player_id FROM players")]
+    active = [row[0] for row in db.execute("SELECT lobby_id FROM lobbies WHERE status IN ('waiting', 'in_progress')")]
+    db.executemany("INSERT OR IGNORE INTO lobby_players (lobby_id, player_id) VALUES (?, ?)",
+                   ((lobby_id, random.choice(player_ids)) for lobby_id in active for _ in range(random.randint(0, 5))))
+    db.commit()
+
+    # A session history for some finished lobbies: a snapshot per member, then patches
+    replayable = [row[0] for row in db.execute("SELECT lobby_id FROM lobbies WHERE status = 'finished' LIMIT ?",
+                                               (max(1, int(lobbies * REPLAYABLE_LOBBY_SHARE)),))]
+    def event_rows():
+        for lobby_id in replayable:
+            members = random.sample(player_ids, min(3, len(player_ids)))
+            started_at = time.time()
+            for player_id in members:
+                yield player_id, lobby_id, "snapshot", json.dumps(character_state(player_id, 0), ensure_ascii=False), started_at
+            for i in range(EVENTS_PER_SESSION):
+                yield (random.choice(members), lobby_id, "patch",
+                       json.dumps([{"op": "set", "path": "vida", "value": random.randint(1, 40)}]), started_at + i)
+    db.executemany("INSERT INTO character_events (player_id, lobby_id, kind, payload, created_at) VALUES (?, ?, ?, ?, ?)", event_rows())
+    # Finished sessions end compacted, so the stored snapshots already include their events
+    db.execute("""
+        UPDATE players SET snapshot_event_id = (SELECT MAX(event_id) FROM character_events AS E WHERE E.player_id = players.player_id)
+        WHERE player_id IN (SELECT player_id FROM character_events)
+    """)
+    db.commit()
+    db.execute("ANALYZE")
+    db.close()
+    print(f"Seeded {users} users, {characters} characters and {lobbies} lobbies in {time.perf_counter() - started:.1f}s")
+
+async def migrate(path: str):
+    """Creates the schema with the application's own migrations."""
+    database.pool = ConnectionPool(path)
+    await database.init_db()
+    await database.close_db_pool()
+
+class Fixtures:
+    """Ids sampled from the seeded database, used to build realistic arguments."""
+
+    def __init__(self, path: str, sample: int = 20_000):
+        db = sqlite3.connect(path)
+        self.players = db.execute("SELECT player_id, owner_uuid FROM players ORDER BY random() LIMIT ?", (sample,)).fetchall()
+        self.users = db.execute("SELECT uuid, username FROM users ORDER BY random() LIMIT ?", (sample,)).fetchall()
+        self.masters = [row[0] for row in db.execute("SELECT DISTINCT master_uuid FROM lobbies ORDER BY random() LIMIT ?", (sample,))]
+        self.lobbies = [row[0] for row in db.execute("SELECT lobby_id FROM lobbies ORDER BY random() LIMIT ?", (sample,))]
+        self.active_lobbies = [row[0] for row in db.execute("SELECT lobby_id FROM lobbies WHERE status IN ('waiting', 'in_progress') LIMIT ?", (sample,))]
+        self.memberships = db.execute("SELECT lobby_id, player_id FROM lobby_players LIMIT ?", (sample,)).fetchall()
+        # Databases seeded before the event log have no history; their lobbies replay as empty pages
+        self.replayable_lobbies = [row[0] for row in db.execute("SELECT DISTINCT lobby_id FROM character_events LIMIT ?", (sample,))] or self.lobbies
+        self.states = {player_id: json.loads(state) for player_id, state in
+                       db.execute("SELECT player_id, state FROM players LIMIT 1000")}
+        db.close()
+        self.path = path
+        self.disposable_lobbies = []
+        self.counter = 0
+
+    def add_disposable_lobbies(self, count: int, members: int = 3):
+        """Inserts finished lobbies with a few members each, consumed by the functions that delete lobbies."""
+        lobby_ids = [str(uuid.uuid4()) for _ in range(count)]
+        db = sqlite3.connect(self.path)
+        db.executemany("INSERT INTO lobbies (lobby_id, master_uuid, lobby_name, status) VALUES (?, ?, ?, 'finished')",
+                       ((lobby_id, random.choice(self.masters), "Partida desechable") for lobby_id in lobby_ids))
+        db.executemany("INSERT OR IGNORE INTO lobby_players (lobby_id, player_id) VALUES (?, ?)",
+                       ((lobby_id, random.choice(self.players)[0]) for lobby_id in lobby_ids for _ in range(members)))
+        db.commit()
+        db.close()
+        self.disposable_lobbies.extend(lobby_ids)
+
+    def disposable_lobby(self) -> str:
+        return self.disposable_lobbies.pop() if self.disposable_lobbies else str(uuid.uuid4())
+
+    def unique(self) -> int:
+        self.counter += 1
+        return self.counter
+
+def cold(func):
+    """Runs a cached lookup with empty username caches so the database is actually hit."""
+    async def call(*args):
+        database.username_cache.clear()
+        database.player_owner_cache.clear()
+        return await func(*args)
+    return call
+
+def build_operations(fx: Fixtures) -> dict:
+    """Maps each benchmarked function to a factory returning a fresh coroutine."""
+    run_id = uuid.uuid4().hex[:6]
+    state_items = list(fx.states.items())
+
+    def player():
+        return random.choice(fx.players)
+
+    def membership():
+        return fx.memberships.pop() if fx.memberships else (random.choice(fx.active_lobbies), player()[0])
+
+    def compaction():
+        # A flush that also rewrites the snapshots, as at the end of a session
+        batch = dict(random.sample(state_items, BATCH))
+        return database.append_character_events(
+            [(player_id, None, "replace", state, time.time()) for player_id, state in batch.items()], batch)
+
+    return {
+        # Reads
+        "check_player_ownership": lambda: database.check_player_ownership(*player()),
+        "get_characters_by_owner_uuid": lambda: database.get_characters_by_owner_uuid(player()[1]),
+        "get_lobbies_by_master_uuid": lambda: database.get_lobbies_by_master_uuid(random.choice(fx.masters)),
+        "get_lobby_db": lambda: database.get_lobby_db(random.choice(fx.lobbies)),
+        "get_active_lobbies_db": lambda: database.get_active_lobbies_db(),
+        "load_player_state_by_id": lambda: database.load_player_state_by_id(player()[0]),
+        "load_player_states": lambda: database.load_player_states([player()[0] for _ in range(BATCH)]),
+        "get_user_by_username": lambda: database.get_user_by_username(random.choice(fx.users)[1]),
+        "get_username_by_uuid": lambda: cold(database.get_username_by_uuid)(random.choice(fx.users)[0]),
+        "get_username_for_player_id": lambda: cold(database.get_username_for_player_id)(player()[0]),
+        "get_usernames_for_player_ids": lambda: cold(database.get_usernames_for_player_ids)([player()[0] for _ in range(BATCH)]),
+        "get_lobby_events_db": lambda: database.get_lobby_events_db(random.choice(fx.replayable_lobbies)),
+        "get_lobby_stats_db": lambda: database.get_lobby_stats_db(random.choice(fx.active_lobbies)),
+        "find_characters_db": lambda: database.find_characters_db(random.choice(fx.active_lobbies), [("vida", "lt", 10)], "dinero", True, 20),
+        # Writes
+        "append_character_events": lambda: database.append_character_events(
+            [(player()[0], None, "patch", [{"op": "set", "path": "vida", "value": 10}], time.time()) for _ in range(BATCH)]),
+        "append_character_events_compact": compaction,
+        "add_player_to_lobby_db": lambda: database.add_player_to_lobby_db(random.choice(fx.active_lobbies), player()[0]),
+        "remove_player_from_lobby_db": lambda: database.remove_player_from_lobby_db(*membership()),
+        "create_lobby_db": lambda: database.create_lobby_db(random.choice(fx.masters), "Partida de prueba"),
+        "update_lobby_status_db": lambda: database.update_lobby_status_db(random.choice(fx.active_lobbies), random.choice(("waiting", "in_progress"))),
+        "clear_lobby_players_db": lambda: database.clear_lobby_players_db(fx.disposable_lobby()),
+        "delete_lobby_db": lambda: database.delete_lobby_db(fx.disposable_lobby()),
+        "create_new_user": lambda: database.create_new_user(f"bench_new_{run_id}_{fx.unique()}", "x", str(uuid.uuid4())),
+        "create_initial_player_character": lambda: (lambda player_id: database.create_initial_player_character(
+            player_id, player()[1], character_state(player_id, 0)))(str(uuid.uuid4())),
+    }
+
+async def measure(factory, concurrency: int, ops: int) -> dict:
+    """Runs `ops` calls spread over `concurrency` concurrent workers."""
+    latencies = []
+    remaining = ops
+
+    async def worker():
+        nonlocal remaining
+        while remaining > 0:
+            remaining -= 1
+            started = time.perf_counter()
+            await factory()
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+    latencies.sort()
+    return {
+        "ops": len(latencies),
+        "throughput_ops_s": round(len(latencies) / elapsed, 1),
+        "mean_ms": round(statistics.fmean(latencies) * 1000, 3),
+        "p50_ms": round(latencies[len(latencies) // 2] * 1000, 3),
+        "p99_ms": round(latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] * 1000, 3),
+    }
+
+async def run_benchmarks(args, counts: dict) -> dict:
+    database.pool = ConnectionPool(args.db)
+    await database.open_db_pool()
+    try:
+        fx = Fixtures(args.db)
+        operations = build_operations(fx)
+        selected = args.functions.split(",") if args.functions else list(operations)
+        levels = [int(level) for level in args.concurrency.split(",")]
+        # Every call of the destructive functions gets its own lobby, with members to remove
+        destructive = [name for name in selected if name in ("clear_lobby_players_db", "delete_lobby_db")]
+        if destructive:
+            fx.add_disposable_lobbies(len(destructive) * len(levels) * args.ops)
+        results = {}
+        for name in selected:
+            results[name] = {}
+            for level in levels:
+                results[name][str(level)] = row = await measure(operations[name], level, args.ops)
+                print(f"{name:<32} c={level:<4} {row['throughput_ops_s']:>10} ops/s  p50 {row['p50_ms']:>8} ms  p99 {row['p99_ms']:>8} ms")
+    finally:
+        await database.close_db_pool()
+    return {
+        "meta": {
+            **counts,
+            "ops_per_level": args.ops,
+            "sqlite_version": sqlite3.sqlite_version,
+            "python": platform.python_version(),
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        },
+        "results": results,
+    }
+
+def compare(baseline: dict, current: dict, threshold: float) -> bool:
+    """Prints per-function changes against a baseline. Returns True if anything regressed beyond threshold %."""
+    regressed = False
+    print(f"\n{'function':<32} {'c':>4} {'ops/s':>18} {'p50 ms':>20} {'p99 ms':>20}")
+    for name, levels in current["results"].items():
+        for level, row in levels.items():
+            base = baseline.get("results", {}).get(name, {}).get(level)
+            if base is None:
+                continue
+            cells = []
+            flagged = False
+            for key, higher_is_better in (("throughput_ops_s", True), ("p50_ms", False), ("p99_ms", False)):
+                before, after = base[key], row[key]
+                change = (after - before) / before * 100 if before else 0.0
+                if (change < -threshold) if higher_is_better else (change > threshold):
+                    flagged = True
+                cells.append(f"{after:>9} ({change:+6.1f}%)")
+            regressed |= flagged
+            print(f"{name:<32} {level:>4} {cells[0]:>18} {cells[1]:>20} {cells[2]:>20}{'  <-- regression' if flagged else ''}")
+    return regressed
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--db", default="data/bench_sessions.db", help="Database file to seed and benchmark (never the live one)")
+    parser.add_argument("--scale", type=float, default=1.0, help="Fraction of the full seed size (100k users, 500k characters, 1M lobbies)")
+    parser.add_argument("--reuse-db", action="store_true", help="Skip seeding and benchmark the existing --db file")
+    parser.add_argument("--concurrency", default="1,4,16,64,256", help="Comma-separated concurrency levels")
+    parser.add_argument("--ops", type=int, default=500, help="Calls per function and concurrency level")
+    parser.add_argument("--functions", help="Comma-separated subset of functions to run")
+    parser.add_argument("--out", default="bench_database.json", help="Where to write the JSON results")
+    parser.add_argument("--baseline", help="Compare the results against this earlier JSON file")
+    parser.add_argument("--threshold", type=float, default=10.0, help="Percent change reported as a regression")
+    parser.add_argument("--compare", nargs=2, metavar=("BASELINE", "CURRENT"), help="Only compare two result files")
+    parser.add_argument("--fail-on-regression", action="store_true", help="Exit with status 1 when a regression is found")
+    args = parser.parse_args()
+    setup_logging()
+
+    if args.compare:
+        with open(args.compare[0]) as before, open(args.compare[1]) as after:
+            regressed = compare(json.load(before), json.load(after), args.threshold)
+        sys.exit(1 if regressed and args.fail_on_regression else 0)
+
+    counts = {key: max(1, int(value * args.scale)) for key, value in FULL_SCALE.items()}
+    if not args.reuse_db:
+        if os.path.exists(args.db):
+            os.remove(args.db)
+        os.makedirs(os.path.dirname(os.path.abspath(args.db)), exist_ok=True)
+        asyncio.run(migrate(args.db))
+        seed(args.db, counts["users"], counts["characters"], counts["lobbies"])
+    else:
+        asyncio.run(migrate(args.db)) # Bring a file seeded by an older version up to the current schema
+
+    report = asyncio.run(run_benchmarks(args, counts))
+    with open(args.out, "w") as output:
+        json.dump(report, output, indent=2)
+    print(f"\nResults written to {args.out}")
+
+    if args.baseline:
+        with open(args.baseline) as baseline:
+            regressed = compare(json.load(baseline), report, args.threshold)
+        if regressed and args.fail_on_regression:
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
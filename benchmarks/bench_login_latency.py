@@ -0,0 +1,132 @@
+"""
+WebSocket latency while the server is busy with logins.
+
+Connects one player over /ws and measures the round trip of small
+player_patch messages (patch -> patch_ack), first on an idle server and
+then while many concurrent clients hammer POST /login. With bcrypt running
+on the event loop the second phase stalls for the full cost of every hash;
+with the password worker pool it should stay flat.
+
+Needs a running server and the httpx and websockets packages
+(pip install -r benchmarks/requirements.txt):
+    uvicorn main:app --port 8000            (from app/)
+    python benchmarks/bench_login_latency.py --url http://127.0.0.1:8000 [--logins 32] [--duration 10]
+"""
+import argparse
+import asyncio
+import json
+import statistics
+import time
+import uuid
+
+import httpx
+import websockets
+
+CHARACTER_FORM = {
+    "nombre": "Banco", "clase": "Bardo", "nivel": 1, "fuerza": 1, "ingenio": 1, "corazon": 1,
+    "vida": 10, "mana": 5, "dinero": 0, "defensa": 1,
+    "arma_equipada": "Laúd", "armadura_equipada": "Cuero",
+    "inventario": "", "habilidades": "", "canciones_aprendidas": "",
+}
+
+async def register_and_login(client: httpx.AsyncClient, username: str, password: str) -> str:
+    """Registers a user and returns its access token."""
+    await client.post("/register", data={"username": username, "password": password})
+    response = await client.post("/login", data={"username": username, "password": password})
+    token = response.cookies.get("access_token")
+    if not token:
+        raise SystemExit(f"Login failed for {username}: HTTP {response.status_code}")
+    return token
+
+async def create_character(client: httpx.AsyncClient, token: str) -> str:
+    """Creates a character for the token's user and returns its player_id."""
+    response = await client.post("/create-character", data=CHARACTER_FORM, cookies={"access_token": token})
+    player_id = response.cookies.get("selected_player_id_cookie")
+    if not player_id:
+        raise SystemExit(f"Character creation failed: HTTP {response.status_code}")
+    return player_id
+
+async def measure_patches(ws_url: str, token: str, player_id: str, duration: float) -> list[float]:
+    """Sends patches back to back for `duration` seconds and returns round trips in ms."""
+    samples = []
+    async with websockets.connect(ws_url) as ws:
+        await ws.send(json.dumps({"type": "connect", "token": token, "role": "player", "player_id": player_id}))
+        version = None
+        while version is None:
+            message = json.loads(await ws.recv())
+            if message.get("type") == "player_state_update":
+                version = message["version"]
+
+        deadline = time.perf_counter() + duration
+        vida = 10
+        while time.perf_counter() < deadline:
+            vida = 11 if vida == 10 else 10
+            started = time.perf_counter()
+            await ws.send(json.dumps({
+                "type": "player_patch", "player_id": player_id, "version": version,
+                "ops": [{"op": "set", "path": "vida", "value": vida}],
+            }))
+            while True:
+                message = json.loads(await ws.recv())
+                if message.get("type") in ("patch_ack", "patch_rejected"):
+                    break
+            samples.append((time.perf_counter() - started) * 1000)
+            version = message["version"]
+            await asyncio.sleep(0.01)
+    return samples
+
+async def login_storm(client: httpx.AsyncClient, username: str, password: str, stop: asyncio.Event, counter: list):
+    """Logs in repeatedly until stopped."""
+    while not stop.is_set():
+        await client.post("/login", data={"username": username, "password": password})
+        counter[0] += 1
+
+def summarize(label: str, samples: list[float]) -> dict:
+    samples = sorted(samples)
+    if not samples:
+        return {"phase": label, "samples": 0}
+    return {
+        "phase": label,
+        "samples": len(samples),
+        "p50_ms": round(statistics.median(samples), 2),
+        "p95_ms": round(samples[int(len(samples) * 0.95) - 1], 2),
+        "p99_ms": round(samples[int(len(samples) * 0.99) - 1], 2),
+        "max_ms": round(samples[-1], 2),
+    }
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default="http://127.0.0.1:8000", help="Base URL of a running server")
+    parser.add_argument("--logins", type=int, default=32, help="Concurrent clients logging in during the second phase")
+    parser.add_argument("--duration", type=float, default=10, help="Seconds per phase")
+    args = parser.parse_args()
+
+    ws_url = args.url.replace("http", "ws", 1) + "/ws"
+    suffix = uuid.uuid4().hex[:8]
+    password = "bench-password"
+
+    async with httpx.AsyncClient(base_url=args.url, timeout=120) as client:
+        token = await register_and_login(client, f"bench_player_{suffix}", password)
+        player_id = await create_character(client, token)
+        login_user = f"bench_login_{suffix}"
+        await register_and_login(client, login_user, password)
+
+        idle = await measure_patches(ws_url, token, player_id, args.duration)
+
+        stop = asyncio.Event()
+        counter = [0]
+        storm = [asyncio.create_task(login_storm(client, login_user, password, stop, counter)) for _ in range(args.logins)]
+        await asyncio.sleep(0.5)  # let the storm ramp up
+        busy = await measure_patches(ws_url, token, player_id, args.duration)
+        stop.set()
+        await asyncio.gather(*storm, return_exceptions=True)
+
+    results = [summarize("idle", idle), summarize(f"{args.logins} concurrent logins", busy)]
+    results[1]["logins_per_second"] = round(counter[0] / (args.duration + 0.5), 1)
+    print(f"{'phase':<24} {'samples':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'max ms':>8}")
+    for row in results:
+        print(f"{row['phase']:<24} {row['samples']:>8} {row.get('p50_ms', 0):>8} {row.get('p95_ms', 0):>8} {row.get('p99_ms', 0):>8} {row.get('max_ms', 0):>8}")
+    print(f"logins/s during the second phase: {results[1]['logins_per_second']}")
+
+if __name__ == "__main__":
+    asyncio.run(main())
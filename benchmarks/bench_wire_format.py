@@ -0,0 +1,67 @@
+"""
+Payload size and encode/decode time of the two WebSocket wire formats.
+
+Encodes and decodes players_state snapshots of growing size with the app
+codec in JSON (the default) and MessagePack (negotiated with
+encoding: "msgpack" in the connect message). Sizes are also shown after
+zlib compression, roughly what permessage-deflate puts on the wire.
+
+Run from the repository root:
+    python benchmarks/bench_wire_format.py [--items 60] [--rounds 50]
+"""
+import argparse
+import os
+import sys
+import time
+import zlib
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "app"))
+
+from bench_broadcast_encoding import build_players_state
+from codec import JSON_BACKEND, MSGPACK_BACKEND, dumps, loads, packb, unpackb
+
+def time_call(func, arg, rounds: int) -> float:
+    started = time.perf_counter()
+    for _ in range(rounds):
+        func(arg)
+    return (time.perf_counter() - started) / rounds
+
+def measure(name: str, encode, decode, message: dict, rounds: int) -> dict:
+    payload = encode(message)
+    raw = payload.encode() if isinstance(payload, str) else payload
+    assert decode(payload) == message, f"{name} round trip changed the message"
+    return {
+        "format": name,
+        "bytes": len(raw),
+        "deflated": len(zlib.compress(raw)),
+        "encode_ms": time_call(encode, message, rounds) * 1000,
+        "decode_ms": time_call(decode, payload, rounds) * 1000,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--items", type=int, default=60, help="inventory items per character")
+    parser.add_argument("--rounds", type=int, default=50, help="encodes/decodes timed per measurement")
+    args = parser.parse_args()
+
+    if MSGPACK_BACKEND is None:
+        sys.exit("MessagePack is not available: install msgspec (or msgpack).")
+    print(f"JSON backend: {JSON_BACKEND}. MessagePack backend: {MSGPACK_BACKEND}")
+    print(f"{'players':>7} {'format':>8} {'KiB':>8} {'deflated KiB':>13} {'encode (ms)':>12} {'decode (ms)':>12}")
+    for players in (1, 10, 50, 200):
+        message = build_players_state(players, args.items)
+        results = [
+            measure("json", dumps, loads, message, args.rounds),
+            measure("msgpack", packb, unpackb, message, args.rounds),
+        ]
+        for result in results:
+            print(f"{players:>7} {result['format']:>8} {result['bytes'] / 1024:>8.1f} {result['deflated'] / 1024:>13.1f}"
+                  f" {result['encode_ms']:>12.3f} {result['decode_ms']:>12.3f}")
+        json_result, msgpack_result = results
+        print(f"{'':>7} {'ratio':>8} {msgpack_result['bytes'] / json_result['bytes']:>8.2f}"
+              f" {msgpack_result['deflated'] / json_result['deflated']:>13.2f}"
+              f" {msgpack_result['encode_ms'] / json_result['encode_ms']:>12.2f}"
+              f" {msgpack_result['decode_ms'] / json_result['decode_ms']:>12.2f}")
+
+if __name__ == "__main__":
+    main()
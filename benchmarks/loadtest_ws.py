@@ -0,0 +1,321 @@
+"""
+End-to-end WebSocket load test.
+
+Registers users and creates characters through the HTTP routes, connects M
+masters and P players over /ws and drives a full session:
+
+    connect -> create_lobby -> player_ready -> start_game
+            -> sustained player_update (or player_patch) -> end_game
+
+Players are spread over the masters' lobbies. Every update carries a send
+timestamp inside the character state; masters take it back out of the
+players_delta / player_patch they receive, which gives the update -> master
+latency (client and server share the host clock). Also reports messages
+per second and the server's CPU usage.
+
+Needs the httpx and websockets packages (pip install -r benchmarks/requirements.txt).
+Either point it at a running server (pass --server-pid to get CPU figures)
+or let it start a throwaway one:
+
+    python benchmarks/loadtest_ws.py --spawn --masters 2 --players 50 --duration 20
+    python benchmarks/loadtest_ws.py --url http://127.0.0.1:8000 --server-pid 1234 --json results.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+
+import httpx
+import websockets
+
+REPO_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+BENCH_KEY = "_bench_sent"  # State field carrying the send timestamp
+
+def character_form(index: int) -> dict:
+    return {
+        "nombre": f"Carga {index}", "clase": "Guerrero", "nivel": 1, "fuerza": 3, "ingenio": 1, "corazon": 2,
+        "vida": 20, "mana": 0, "dinero": 10, "defensa": 2,
+        "arma_equipada": "Espada", "armadura_equipada": "Cota de malla",
+        "inventario": ", ".join(f"Objeto {i}" for i in range(20)),
+        "habilidades": "Golpe, Bloqueo, Carga",
+        "canciones_aprendidas": "",
+    }
+
+class ProcessCPU:
+    """Reads a process's user+system CPU time from /proc (Linux only)."""
+
+    def __init__(self, pid: int | None):
+        self.pid = pid
+        self.ticks = os.sysconf("SC_CLK_TCK") if hasattr(os, "sysconf") else 100
+
+    def seconds(self) -> float | None:
+        if not self.pid:
+            return None
+        try:
+            with open(f"/proc/{self.pid}/stat") as stat:
+                fields = stat.read().rsplit(")", 1)[1].split()
+        except OSError:
+            return None
+        return (int(fields[11]) + int(fields[12])) / self.ticks
+
+async def recv_until(ws, message_type: str, timeout: float = 30) -> dict:
+    """Reads messages until one of the given type arrives."""
+    deadline = time.monotonic() + timeout
+    while True:
+        message = json.loads(await asyncio.wait_for(ws.recv(), max(0.1, deadline - time.monotonic())))
+        if message.get("type") == message_type:
+            return message
+
+async def create_account(client: httpx.AsyncClient, limiter: asyncio.Semaphore, name: str, with_character: int | None = None):
+    """Registers and logs in a user; optionally creates a character. Returns (token, player_id)."""
+    async with limiter:
+        password = "carga-password"
+        await client.post("/register", data={"username": name, "password": password})
+        response = await client.post("/login", data={"username": name, "password": password})
+        token = response.cookies.get("access_token")
+        if not token:
+            raise SystemExit(f"Login failed for {name}: HTTP {response.status_code}")
+        player_id = None
+        if with_character is not None:
+            response = await client.post("/create-character", data=character_form(with_character), cookies={"access_token": token})
+            player_id = response.cookies.get("selected_player_id_cookie")
+            if not player_id:
+                raise SystemExit(f"Character creation failed for {name}: HTTP {response.status_code}")
+        return token, player_id
+
+class Master:
+    """A master bot: owns one lobby and records update latencies from its panel messages."""
+
+    def __init__(self, ws_url: str, token: str):
+        self.ws_url = ws_url
+        self.token = token
+        self.ws = None
+        self.lobby_id = None
+        self.latencies: list[float] = []
+        self.received = 0
+        self.reader: asyncio.Task | None = None
+        self.events: dict[str, asyncio.Queue] = {"game_started": asyncio.Queue(), "game_ended": asyncio.Queue()}
+
+    async def connect(self, lobby_name: str):
+        self.ws = await websockets.connect(self.ws_url, max_size=None)
+        await self.ws.send(json.dumps({"type": "connect", "token": self.token, "role": "master"}))
+        await recv_until(self.ws, "players_state")
+        await self.ws.send(json.dumps({"type": "create_lobby", "lobby_name": lobby_name}))
+        self.lobby_id = (await recv_until(self.ws, "lobby_created"))["lobby_id"]
+        self.reader = asyncio.create_task(self._read())
+
+    async def _read(self):
+        async for raw in self.ws:
+            received_at = time.time()
+            self.received += 1
+            message = json.loads(raw)
+            kind = message.get("type")
+            if kind == "players_delta":
+                for entry in message["players"].values():
+                    sent = entry["state"].get(BENCH_KEY)
+                    if isinstance(sent, (int, float)):
+                        self.latencies.append((received_at - sent) * 1000)
+            elif kind == "player_patch":
+                for op in message["ops"]:
+                    if op.get("path") == BENCH_KEY and isinstance(op.get("value"), (int, float)):
+                        self.latencies.append((received_at - op["value"]) * 1000)
+            elif kind in self.events:
+                self.events[kind].put_nowait(message)
+
+    async def start_game(self):
+        await self.ws.send(json.dumps({"type": "start_game", "lobby_id": self.lobby_id}))
+        await asyncio.wait_for(self.events["game_started"].get(), 30)
+
+    async def end_game(self):
+        await self.ws.send(json.dumps({"type": "end_game", "lobby_id": self.lobby_id}))
+        await asyncio.wait_for(self.events["game_ended"].get(), 30)
+
+    async def close(self):
+        await self.ws.close()
+        if self.reader is not None:
+            await asyncio.gather(self.reader, return_exceptions=True)
+
+class Player:
+    """A player bot: joins a lobby and sends character updates at a fixed rate."""
+
+    def __init__(self, ws_url: str, token: str, player_id: str):
+        self.ws_url = ws_url
+        self.token = token
+        self.player_id = player_id
+        self.ws = None
+        self.state = None
+        self.version = 0
+        self.sent = 0
+        self.game_started = asyncio.Event()
+        self.reader: asyncio.Task | None = None
+
+    async def connect(self, lobby_id: str):
+        self.ws = await websockets.connect(self.ws_url, max_size=None)
+        await self.ws.send(json.dumps({"type": "connect", "token": self.token, "role": "player", "player_id": self.player_id}))
+        initial = await recv_until(self.ws, "player_state_update")
+        self.state, self.version = initial["state"], initial["version"]
+        await self.ws.send(json.dumps({"type": "player_ready", "lobby_id": lobby_id}))
+        await recv_until(self.ws, "ready_ack")
+        self.reader = asyncio.create_task(self._read())
+
+    async def _read(self):
+        async for raw in self.ws:
+            message = json.loads(raw)
+            kind = message.get("type")
+            if kind == "game_started":
+                self.game_started.set()
+            elif kind in ("patch_ack", "patch_rejected"):
+                self.version = message["version"]
+                if kind == "patch_rejected":
+                    self.state = message["state"]
+
+    async def drive(self, mode: str, rate: float, stop_at: float):
+        interval = 1 / rate
+        next_send = time.monotonic()
+        while time.monotonic() < stop_at:
+            now = time.time()
+            self.state = {**self.state, "vida": (self.state.get("vida", 0) + 1) % 50, BENCH_KEY: now}
+            if mode == "patch":
+                message = {"type": "player_patch", "player_id": self.player_id, "version": self.version,
+                           "ops": [{"op": "set", "path": "vida", "value": self.state["vida"]},
+                                   {"op": "set", "path": BENCH_KEY, "value": now}]}
+            else:
+                message = {"type": "player_update", "player_id": self.player_id, "state": self.state}
+            await self.ws.send(json.dumps(message))
+            self.sent += 1
+            next_send += interval
+            await asyncio.sleep(max(0, next_send - time.monotonic()))
+
+    async def close(self):
+        await self.ws.close()
+        if self.reader is not None:
+            await asyncio.gather(self.reader, return_exceptions=True)
+
+def percentile(samples: list[float], fraction: float) -> float:
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+def spawn_server(port: int):
+    """Starts uvicorn in a throwaway working directory with its own database."""
+    workdir = tempfile.mkdtemp(prefix="dnd-loadtest-")
+    for folder in ("templates", "static"):
+        os.symlink(os.path.join(REPO_ROOT, folder), os.path.join(workdir, folder))
+    os.makedirs(os.path.join(workdir, "data"))
+    env = {**os.environ, "LOG_LEVEL": os.environ.get("LOG_LEVEL", "WARNING")}
+    process = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--app-dir", os.path.join(REPO_ROOT, "app"),
+         "--port", str(port), "--log-level", "warning"],
+        cwd=workdir, env=env,
+    )
+    return process
+
+async def wait_for_server(url: str, timeout: float = 30):
+    async with httpx.AsyncClient(base_url=url) as client:
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            try:
+                await client.get("/")
+                return
+            except httpx.TransportError:
+                await asyncio.sleep(0.2)
+    raise SystemExit(f"Server at {url} did not come up")
+
+async def run(args) -> dict:
+    ws_url = args.url.replace("http", "ws", 1) + "/ws"
+    run_id = uuid.uuid4().hex[:6]
+    limiter = asyncio.Semaphore(args.concurrency)
+
+    async with httpx.AsyncClient(base_url=args.url, timeout=120) as client:
+        print(f"Creating {args.masters} masters and {args.players} players...")
+        master_accounts = await asyncio.gather(*(create_account(client, limiter, f"lt_{run_id}_m{i}") for i in range(args.masters)))
+        player_accounts = await asyncio.gather(*(create_account(client, limiter, f"lt_{run_id}_p{i}", with_character=i) for i in range(args.players)))
+
+    masters = [Master(ws_url, token) for token, _ in master_accounts]
+    await asyncio.gather(*(master.connect(f"Carga {run_id} {i}") for i, master in enumerate(masters)))
+    players = [Player(ws_url, token, player_id) for token, player_id in player_accounts]
+    await asyncio.gather(*(player.connect(masters[i % len(masters)].lobby_id) for i, player in enumerate(players)))
+
+    await asyncio.gather(*(master.start_game() for master in masters))
+    await asyncio.wait_for(asyncio.gather(*(player.game_started.wait() for player in players)), 30)
+    for master in masters:
+        master.latencies.clear()
+        master.received = 0
+
+    cpu = ProcessCPU(args.server_pid)
+    cpu_before, wall_before = cpu.seconds(), time.monotonic()
+    print(f"Driving {args.mode} traffic at {args.rate}/s per player for {args.duration}s...")
+    stop_at = time.monotonic() + args.duration
+    await asyncio.gather(*(player.drive(args.mode, args.rate, stop_at) for player in players))
+    await asyncio.sleep(args.drain)  # let in-flight deliveries arrive
+    elapsed = time.monotonic() - wall_before
+    cpu_after = cpu.seconds()
+
+    await asyncio.gather(*(master.end_game() for master in masters))
+    await asyncio.gather(*(player.close() for player in players), *(master.close() for master in masters))
+
+    latencies = [sample for master in masters for sample in master.latencies]
+    sent = sum(player.sent for player in players)
+    received = sum(master.received for master in masters)
+    return {
+        "masters": args.masters,
+        "players": args.players,
+        "mode": args.mode,
+        "rate_per_player": args.rate,
+        "duration_s": args.duration,
+        "updates_sent": sent,
+        "updates_per_second": round(sent / args.duration, 1),
+        "master_messages_received": received,
+        "master_messages_per_second": round(received / elapsed, 1),
+        "latency_samples": len(latencies),
+        "latency_p50_ms": round(statistics.median(latencies), 2) if latencies else None,
+        "latency_p99_ms": round(percentile(latencies, 0.99), 2) if latencies else None,
+        "latency_max_ms": round(max(latencies), 2) if latencies else None,
+        "server_cpu_percent": round((cpu_after - cpu_before) / elapsed * 100, 1) if cpu_before is not None and cpu_after is not None else None,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default="http://127.0.0.1:8000", help="Base URL of the server under test")
+    parser.add_argument("--spawn", action="store_true", help="Start a throwaway uvicorn on --port instead of using --url")
+    parser.add_argument("--port", type=int, default=8790, help="Port for --spawn")
+    parser.add_argument("--server-pid", type=int, help="PID of the server process, for CPU usage")
+    parser.add_argument("--masters", type=int, default=2)
+    parser.add_argument("--players", type=int, default=20)
+    parser.add_argument("--mode", choices=("update", "patch"), default="update", help="Send full player_update states or player_patch operations")
+    parser.add_argument("--rate", type=float, default=2, help="Updates per second per player")
+    parser.add_argument("--duration", type=float, default=15, help="Seconds of sustained traffic")
+    parser.add_argument("--drain", type=float, default=1, help="Seconds to wait for in-flight messages after sending stops")
+    parser.add_argument("--concurrency", type=int, default=8, help="Concurrent registrations during setup")
+    parser.add_argument("--json", help="Also write the results to this file")
+    args = parser.parse_args()
+
+    process = None
+    if args.spawn:
+        args.url = f"http://127.0.0.1:{args.port}"
+        process = spawn_server(args.port)
+        args.server_pid = process.pid
+    try:
+        if process is not None:
+            asyncio.run(wait_for_server(args.url))
+        results = asyncio.run(run(args))
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait(timeout=10)
+
+    for key, value in results.items():
+        print(f"{key:<28} {value}")
+    if args.json:
+        with open(args.json, "w") as output:
+            json.dump(results, output, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -1,34 +1,58 @@
 // WebSocket logic for in-game updates (player side)
 let ws;
-const token = "{{ token }}";
-const selectedPlayerId = "{{ character.player_id }}";
-const currentLobbyId = "{{ lobby_id }}";
+// Set by game_player.html, since static files are not rendered by Jinja
+const token = window.TOKEN || null;
+const selectedPlayerId = window.PLAYER_ID;
+const currentLobbyId = window.LOBBY_ID;
+let character = null; // Local copy of our character's state, as last sent by the server
+let characterVersion = 0; // Server version of our character, required by player_patch
+let sentPatches = []; // Ops of the patches sent and not yet acknowledged, oldest first
+// Ask for compact MessagePack frames when msgpack.js is loaded; JSON otherwise
+const wireEncoding = window.decodeFrame ? "msgpack" : "json";
 
 function connectWebSocket() {
-    ws = new WebSocket(`ws://localhost:8000/ws`);
+    ws = new WebSocket("ws://" + window.location.host + "/ws");
+    ws.binaryType = "arraybuffer";
 
     ws.onopen = (event) => {
         console.log("WebSocket connected (in-game player)!");
+        sentPatches = []; // Unanswered patches died with the old socket; the server resends our state
         ws.send(JSON.stringify({
             type: "connect",
             token: token,
             role: "player",
             player_id: selectedPlayerId,
-            lobby_id: currentLobbyId // Send current lobby ID on connect
+            lobby_id: currentLobbyId, // Send current lobby ID on connect
+            encoding: wireEncoding
         }));
     };
 
     ws.onmessage = (event) => {
-        const data = JSON.parse(event.data);
+        // The server may still answer in JSON (e.g. if it has no MessagePack support)
+        const data = window.decodeFrame ? window.decodeFrame(event.data) : JSON.parse(event.data);
         console.log("Received (in-game player):", data);
         // Handle in-game specific messages from master or other players
         // e.g., updates to character stats, game events, etc.
         if (data.type === "player_state_update" && data.player_id === selectedPlayerId) {
             // Update UI with new character state
             console.log("My character state updated:", data.state);
+            character = data.state;
+            characterVersion = data.version || 0;
             // You would update specific DOM elements here, e.g.:
             // document.getElementById('vida-span').textContent = data.state.vida;
         }
+        if (data.type === "patch_ack" && data.player_id === selectedPlayerId) {
+            const ops = sentPatches.shift();
+            if (character && ops) character = applyPatch(character, ops);
+            characterVersion = data.version;
+        }
+        if (data.type === "patch_rejected" && data.player_id === selectedPlayerId) {
+            // Our version was stale or the patch invalid: adopt the server state and retry from there
+            console.warn("Patch rejected:", data.message);
+            sentPatches.shift();
+            character = data.state;
+            characterVersion = data.version;
+        }
         // If master ends game or kicks player, redirect back to lobby
         // if (data.type === "game_ended" || data.type === "kicked") {
         //     alert("La partida ha terminado o has sido expulsado. Redirigiendo al lobby.");
@@ -58,4 +82,33 @@ window.onload = connectWebSocket;
 //             state: { ...character_data_from_jinja, vida: newHealth } // Assuming you have character data
 //         }));
 //     }
-// }
\ No newline at end of file
+// }
+
+// Sends only the changed fields of our character, e.g.
+// sendCharacterPatch([{ op: "set", path: "vida", value: 8 }, { op: "append", path: "inventario", value: "Cuerda" }]);
+function sendCharacterPatch(ops) {
+    if (ws && ws.readyState === WebSocket.OPEN) {
+        sentPatches.push(ops);
+        ws.send(JSON.stringify({
+            type: "player_patch",
+            player_id: selectedPlayerId,
+            version: characterVersion,
+            ops: ops
+        }));
+    }
+}
+
+// Applies patch operations to a copy of a state, like app/patches.py does on the server
+function applyPatch(state, ops) {
+    const patched = structuredClone(state);
+    for (const op of ops) {
+        if (op.op === "set") patched[op.path] = op.value;
+        else if (op.op === "unset") delete patched[op.path];
+        else if (op.op === "append") patched[op.path] = [...(patched[op.path] || []), op.value];
+        else if (op.op === "remove") {
+            const index = (patched[op.path] || []).indexOf(op.value);
+            if (index !== -1) patched[op.path].splice(index, 1);
+        }
+    }
+    return patched;
+}
@@ -1,20 +1,31 @@
 // master.js
 const ws = new WebSocket("ws://" + window.location.host + "/ws");
+ws.binaryType = "arraybuffer";
+// Ask for compact MessagePack frames when msgpack.js is loaded; JSON otherwise
+const wireEncoding = window.decodeFrame ? "msgpack" : "json";
+let activePlayers = {}; // player_id -> entry, kept in sync by players_state / players_delta
 
 ws.onopen = () => {
     const token = window.TOKEN || null;
     ws.send(JSON.stringify({
         type: "connect",
         role: "master",
-        token: token
+        token: token,
+        encoding: wireEncoding
     }));
 };
 
 ws.onmessage = (event) => {
-    const data = JSON.parse(event.data);
+    // The server may still answer in JSON (e.g. if it has no MessagePack support)
+    const data = window.decodeFrame ? window.decodeFrame(event.data) : JSON.parse(event.data);
 
     if (data.type === "players_state") {
-        renderPlayers(data.players);
+        activePlayers = data.players;
+        renderPlayers(activePlayers);
+    } else if (data.type === "players_delta") {
+        Object.assign(activePlayers, data.players);
+        (data.removed || []).forEach(playerId => delete activePlayers[playerId]);
+        renderPlayers(activePlayers);
     } else if (data.error) {
         console.error("Error:", data.error);
         ws.close();
@@ -33,7 +44,7 @@ function renderPlayers(players) {
     container.textContent = "No hay jugadores activos conectados.";
     }
 
-    Object.entries(players).forEach(([player_id, state]) => {
+    Object.entries(players).forEach(([player_id, { state }]) => {
         const div = document.createElement("div");
         div.textContent = `ID: ${player_id} - Vida: ${state.vida} - Mana: ${state.mana} - Dinero: ${state.dinero}`;
         container.appendChild(div);
@@ -0,0 +1,83 @@
+// msgpack.js
+// Minimal MessagePack decoder for the binary WebSocket frames sent to clients
+// that connect with encoding: "msgpack". Pages load it before their inline script,
+// which asks for MessagePack only if window.decodeFrame is defined.
+(function (global) {
+    const textDecoder = new TextDecoder("utf-8");
+
+    function decodeMsgpack(buffer) {
+        const bytes = buffer instanceof Uint8Array ? buffer : new Uint8Array(buffer);
+        const view = new DataView(bytes.buffer, bytes.byteOffset, bytes.byteLength);
+        let offset = 0;
+
+        function str(length) {
+            const value = textDecoder.decode(bytes.subarray(offset, offset + length));
+            offset += length;
+            return value;
+        }
+        function bin(length) {
+            const value = bytes.slice(offset, offset + length);
+            offset += length;
+            return value;
+        }
+        function array(length) {
+            const value = new Array(length);
+            for (let i = 0; i < length; i++) value[i] = read();
+            return value;
+        }
+        function map(length) {
+            const value = {};
+            for (let i = 0; i < length; i++) {
+                const key = read();
+                value[key] = read();
+            }
+            return value;
+        }
+
+        function read() {
+            const byte = bytes[offset++];
+            if (byte <= 0x7f) return byte;                        // positive fixint
+            if (byte >= 0xe0) return byte - 0x100;                // negative fixint
+            if ((byte & 0xf0) === 0x80) return map(byte & 0x0f);  // fixmap
+            if ((byte & 0xf0) === 0x90) return array(byte & 0x0f); // fixarray
+            if ((byte & 0xe0) === 0xa0) return str(byte & 0x1f);  // fixstr
+            let value;
+            switch (byte) {
+                case 0xc0: return null;
+                case 0xc2: return false;
+                case 0xc3: return true;
+                case 0xc4: value = view.getUint8(offset); offset += 1; return bin(value);
+                case 0xc5: value = view.getUint16(offset); offset += 2; return bin(value);
+                case 0xc6: value = view.getUint32(offset); offset += 4; return bin(value);
+                case 0xca: value = view.getFloat32(offset); offset += 4; return value;
+                case 0xcb: value = view.getFloat64(offset); offset += 8; return value;
+                case 0xcc: value = view.getUint8(offset); offset += 1; return value;
+                case 0xcd: value = view.getUint16(offset); offset += 2; return value;
+                case 0xce: value = view.getUint32(offset); offset += 4; return value;
+                case 0xcf: value = Number(view.getBigUint64(offset)); offset += 8; return value;
+                case 0xd0: value = view.getInt8(offset); offset += 1; return value;
+                case 0xd1: value = view.getInt16(offset); offset += 2; return value;
+                case 0xd2: value = view.getInt32(offset); offset += 4; return value;
+                case 0xd3: value = Number(view.getBigInt64(offset)); offset += 8; return value;
+                case 0xd9: value = view.getUint8(offset); offset += 1; return str(value);
+                case 0xda: value = view.getUint16(offset); offset += 2; return str(value);
+                case 0xdb: value = view.getUint32(offset); offset += 4; return str(value);
+                case 0xdc: value = view.getUint16(offset); offset += 2; return array(value);
+                case 0xdd: value = view.getUint32(offset); offset += 4; return array(value);
+                case 0xde: value = view.getUint16(offset); offset += 2; return map(value);
+                case 0xdf: value = view.getUint32(offset); offset += 4; return map(value);
+            }
+            throw new Error("MessagePack: tipo no soportado 0x" + byte.toString(16));
+        }
+
+        return read();
+    }
+
+    // Decodes a WebSocket message event: text frames are JSON, binary frames MessagePack
+    function decodeFrame(data) {
+        return typeof data === "string" ? JSON.parse(data) : decodeMsgpack(data);
+    }
+
+    global.decodeMsgpack = decodeMsgpack;
+    global.decodeFrame = decodeFrame;
+})(window);